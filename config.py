@@ -1,9 +1,15 @@
+import os
+
 class Configuration:
 
 	WORKING_DIR = '/home/epimetheus/Downloads/2024-06-16/grb240615a/align/'
 	
 	MAIN_DIR = '/home/epimetheus/Downloads/hades-dev/'
+	CACHE_DIR = '/home/epimetheus/Downloads/hades-dev/cache/'
 	CATALOG_DIR = '/home/epimetheus/Downloads/catalogs/'
+	INDEX_DIR = '/usr/share/astrometry/'
+	LIBRARY_DIR = '/home/epimetheus/Downloads/hades-dev/library/'
+	MASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'masks')
 
 	OBJECT = 'grb240615a'
 	FIELD_RA = 326.1413
@@ -16,20 +22,35 @@ class Configuration:
 	FIELD_SIZE = 0.6
 
 	AIRMASS_METHOD = 'ky1998'
+	ALIGN_BLOCK_ROWS = 1024
+	ALIGN_METHOD = 'auto'
+	ALIGN_REFERENCE = 'first'
+	ALIGN_TOLERANCE = 0.05
+	BKG_ESTIMATOR = 'background2d'
 	BKG_METHOD = 'flat'
+	BKG_WARM_START = False
 	BOX_SIZE = (50, 50)
+	BPM_DEAD = 0.5
+	BPM_SIGMA = 5.0
 	CATALOG = 'gaia-cone'
 	CATALOG_TARGET = 'glade24' # glade24, glade+
 	CATALOG_F1 = 'r'
 	CATALOG_F2 = 'i'
 	COMBINE_METHOD = 'median'
 	DILATE_SIZE = 25
+	DRIZZLE_BLOCK_ROWS = 1024
+	DRIZZLE_PIXFRAC = 0.8
+	DRIZZLE_SCALE = 0.5
 	DTYPE = 'float32'
 	FILTER_SIZE = (3, 3)
+	LIBRARY_MAX_AGE = 30
+	MATCH_RADIUS = 1.0
 	MEM_LIMIT = 32e9
 	NPIXELS = 3
 	PHOT_F1 = 'r'
 	PHOT_F2 = 'i'
+	PIPELINE_KEEP = [] # cal, wcs, align
+	PIPELINE_STREAM = False
 	RAD_AN_IN = 17
 	RAD_AN_OUT = 20
 	RAD_AP = 14
@@ -37,6 +58,20 @@ class Configuration:
 	RAD_QUERY = 1
 	SIGMA_BKG = 3.0
 	SIGMA_SRC = 5.0
+	SOLVE_CACHE_GRID = 0.1
+	SOLVE_CACHE_TOLERANCE = 0.02
+	SOLVE_CPU_LIMIT = 60
+	SOLVE_MODE = 'image'
+	SOLVE_SCALE_TOLERANCE = 0.1
+	SOLVE_SOURCES = 200
+	SOLVE_TIMEOUT = 120
+	SOLVE_TRACK = False
+	SOLVE_TRACK_RADIUS = 10
+	SOLVE_TRACK_TOLERANCE = 1.0
+	STACK_REJECT = 3.0
+	STACK_WEIGHTING = 'none' # none, variance, seeing
+	TEMP_TOLERANCE = 2.0
+	WORKERS = 1
 
 	CLIENT_ID = 'client_id'
 	CLIENT_SECRET = 'client_secret'
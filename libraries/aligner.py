@@ -0,0 +1,314 @@
+from config import Configuration
+from libraries.reader import Reader
+
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from photutils.segmentation import detect_sources, SourceCatalog
+from reproject import reproject_interp
+from scipy import ndimage
+import numpy as np
+import os
+import warnings
+
+class Aligner:
+
+	# --- Keys an aligned frame takes from its own header instead of the reference header
+	FRAME_KEYS = ('BKGMED', 'BKGRMS', 'EXPOSURE', 'EXPTIME', 'FWHM')
+
+	# --- Number of grid points along each axis used to compare two WCSs
+	GRID_SIZE = 16
+
+	@staticmethod
+	def align(target_data, target_header, reference_header, method=None, block_rows=None):
+		''' This function resamples a frame onto the pixel grid of the reference frame. The transform between the two WCSs is measured first: a pure translation is applied with a separable shift, an affine transform with a single affine warp, and only real distortion falls back to reproject_interp. Every path uses bilinear interpolation and leaves NaN outside the frame.
+
+		:parameter target_data [array] - The pixel values of the frame
+		:parameter target_header [Header] - The header of the frame
+		:parameter reference_header [Header] - The header of the reference frame
+		:parameter method [string] - The alignment method (auto or reproject); the default is Configuration.ALIGN_METHOD
+		:parameter block_rows [int] - The number of rows reprojected at a time; the default is Configuration.ALIGN_BLOCK_ROWS
+
+		:return aligned_data [array] - The aligned pixel values, of type Configuration.DTYPE
+		:return kind [string] - The transform that was applied (shift, affine or reproject)
+
+		'''
+
+		method = method or Configuration.ALIGN_METHOD
+
+		if method not in ('auto', 'reproject'):
+			raise ValueError('Unknown alignment method {} (must be one of auto, reproject)'.format(method))
+
+		shape = (reference_header['NAXIS2'], reference_header['NAXIS1'])
+		kind = 'reproject'
+
+		if method == 'auto':
+			kind, matrix, offset = Aligner.fit_transform(Aligner.read_wcs(target_header), Aligner.read_wcs(reference_header), shape)
+
+		if kind == 'shift':
+			aligned_data = np.empty(shape, dtype=Configuration.DTYPE)
+			ndimage.shift(np.asarray(target_data, dtype=Configuration.DTYPE), -offset[::-1], output=aligned_data, order=1, mode='constant', cval=np.nan, prefilter=False)
+
+		elif kind == 'affine':
+			aligned_data = np.empty(shape, dtype=Configuration.DTYPE)
+			ndimage.affine_transform(np.asarray(target_data, dtype=Configuration.DTYPE), matrix[::-1, ::-1], offset=offset[::-1], output_shape=shape, output=aligned_data, order=1, mode='constant', cval=np.nan, prefilter=False)
+
+		else:
+			target_hdu = fits.PrimaryHDU(target_data, header=target_header)
+			aligned_data = Aligner.reproject(target_hdu, reference_header, block_rows=block_rows)
+
+		return aligned_data, kind
+
+	@staticmethod
+	def aligned_header(target_header, reference_header):
+		''' This function returns the header of an aligned frame: the header of the reference, with the exposure time and the quality keys of the frame itself, which the stack weights it by.
+
+		:parameter target_header [Header] - The header of the frame
+		:parameter reference_header [Header] - The header of the reference frame
+
+		:return aligned_header [Header] - The header of the aligned frame
+
+		'''
+
+		aligned_header = reference_header.copy()
+
+		for key in Aligner.FRAME_KEYS:
+			if key in target_header:
+				aligned_header[key] = target_header[key]
+
+			else:
+				aligned_header.remove(key, ignore_missing=True)
+
+		return aligned_header
+
+	@staticmethod
+	def align_frame(target_path, align_path, reference_header, method=None, block_rows=None):
+		''' This function aligns one frame with the reference frame and writes it with the header of the reference frame, keeping the exposure time and the quality keys of the frame itself.
+
+		:parameter target_path [string] - The path of the frame
+		:parameter align_path [string] - The path of the aligned frame
+		:parameter reference_header [Header] - The header of the reference frame
+		:parameter method [string] - The alignment method (auto or reproject); the default is Configuration.ALIGN_METHOD
+		:parameter block_rows [int] - The number of rows reprojected at a time; the default is Configuration.ALIGN_BLOCK_ROWS
+
+		:return kind [string] - The transform that was applied (shift, affine or reproject)
+
+		'''
+
+		target_data, target_header = Reader.load_frame(target_path)
+		aligned_data, kind = Aligner.align(target_data, target_header, reference_header, method, block_rows)
+		print('Aligned frame', os.path.basename(target_path), 'with reference frame', '(' + kind + ')')
+
+		aligned_header = Aligner.aligned_header(target_header, reference_header)
+
+		aligned_hdu = fits.PrimaryHDU(aligned_data, header=aligned_header)
+		aligned_hdu.writeto(align_path)
+
+		return kind
+
+	@staticmethod
+	def field_header(header, fields):
+		''' This function builds the header of a survey field that frames can be aligned to: the header of a frame with its WCS replaced by a north-up TAN projection centred on the nearest field centre, with the pixel scale of the frame.
+
+		:parameter header [Header] - The header of a solved frame
+		:parameter fields [DataFrame] - The survey fields, as returned by Priority.field_generator
+
+		:return field_header [Header] - The header of the survey field
+		:return field_id [string] - The identifier of the nearest field
+
+		'''
+
+		wcs = Aligner.read_wcs(header)
+		shape = (header['NAXIS2'], header['NAXIS1'])
+
+		centre = wcs.pixel_to_world((shape[1] - 1) / 2, (shape[0] - 1) / 2)
+		field_centres = SkyCoord(fields['ra'].to_numpy(), fields['dec'].to_numpy(), unit='deg')
+		nearest = int(centre.separation(field_centres).argmin())
+
+		scale = float(np.mean(proj_plane_pixel_scales(wcs)))
+
+		field_wcs = WCS(naxis=2)
+		field_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+		field_wcs.wcs.crval = [field_centres[nearest].ra.deg, field_centres[nearest].dec.deg]
+		field_wcs.wcs.crpix = [(shape[1] + 1) / 2, (shape[0] + 1) / 2]
+		field_wcs.wcs.cd = [[-scale, 0.], [0., scale]]
+
+		field_header = header.copy()
+
+		for key in wcs.to_header(relax=True):
+			field_header.remove(key, ignore_missing=True, remove_all=True)
+
+		field_header.extend(field_wcs.to_header(), update=True)
+
+		return field_header, str(fields['field_id'].iloc[nearest])
+
+	@staticmethod
+	def fit_transform(target_wcs, reference_wcs, shape):
+		''' This function measures the transform from the pixels of the reference frame to the pixels of a frame. A grid of reference pixels is mapped to the sky with the reference WCS and back to pixels with the WCS of the frame, and an affine transform is fitted to the grid. The transform is a shift if the linear part stays within Configuration.ALIGN_TOLERANCE of the identity across the frame, affine if the fit residuals do, and needs a full reprojection otherwise.
+
+		:parameter target_wcs [WCS] - The WCS of the frame
+		:parameter reference_wcs [WCS] - The WCS of the reference frame
+		:parameter shape [tuple] - The shape of the reference frame
+
+		:return kind [string] - The kind of transform (shift, affine or reproject)
+		:return matrix [array] - The linear part of the transform, acting on (x, y)
+		:return offset [array] - The offset of the transform, in (x, y)
+
+		'''
+
+		x = np.linspace(0, shape[1] - 1, Aligner.GRID_SIZE)
+		y = np.linspace(0, shape[0] - 1, Aligner.GRID_SIZE)
+		x, y = [axis.ravel() for axis in np.meshgrid(x, y)]
+
+		target_x, target_y = target_wcs.world_to_pixel(reference_wcs.pixel_to_world(x, y))
+
+		design = np.column_stack([x, y, np.ones_like(x)])
+		solution, residuals, rank, singular = np.linalg.lstsq(design, np.column_stack([target_x, target_y]), rcond=None)
+
+		matrix = solution[:2].T
+		offset = solution[2]
+
+		residual = np.max(np.hypot(*(design @ solution - np.column_stack([target_x, target_y])).T))
+		tolerance = Configuration.ALIGN_TOLERANCE
+
+		if not np.isfinite(residual) or residual > tolerance:
+			return 'reproject', matrix, offset
+
+		# --- Largest displacement across the frame caused by the linear part
+		deviation = np.max(np.abs(matrix - np.eye(2))) * max(shape)
+
+		if deviation <= tolerance:
+			return 'shift', matrix, offset
+
+		return 'affine', matrix, offset
+
+	@staticmethod
+	def measure_fwhm(frame_data):
+		''' This function measures the seeing of a frame as the median FWHM of its sources.
+
+		:parameter frame_data [array] - The pixel values of the frame
+
+		:return fwhm [float] - The median FWHM of the sources [pixels], or infinity if no source is detected
+
+		'''
+
+		mean, median, std = sigma_clipped_stats(frame_data, sigma=Configuration.SIGMA_BKG)
+
+		# --- Aligned frames are NaN outside their footprint
+		data = np.nan_to_num(frame_data - median, nan=0.)
+		segment_img = detect_sources(data, Configuration.SIGMA_SRC * std, npixels=Configuration.NPIXELS)
+
+		if segment_img is None:
+			return np.inf
+
+		fwhm = SourceCatalog(data, segment_img).fwhm.value
+		fwhm = fwhm[np.isfinite(fwhm)]
+
+		if len(fwhm) == 0:
+			return np.inf
+
+		return float(np.median(fwhm))
+
+	@staticmethod
+	def read_wcs(header):
+		''' This function returns the celestial WCS of a header.
+
+		:parameter header [Header] - The header of the frame
+
+		:return wcs [WCS] - The celestial WCS
+
+		'''
+
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')
+			wcs = WCS(header).celestial
+
+		return wcs
+
+	@staticmethod
+	def reproject(target_hdu, reference_header, block_rows=None, return_footprint=False):
+		''' This function reprojects a frame onto the reference frame in blocks of rows. Every block is reprojected against the reference WCS sliced to the block, so the coordinate arrays of reproject_interp never exceed one block. The footprint is only computed if it is asked for.
+
+		:parameter target_hdu [PrimaryHDU] - The frame
+		:parameter reference_header [Header] - The header of the reference frame
+		:parameter block_rows [int] - The number of rows reprojected at a time; the default is Configuration.ALIGN_BLOCK_ROWS
+		:parameter return_footprint [bool] - Whether to return the footprint too
+
+		:return aligned_data [array] - The reprojected pixel values, of type Configuration.DTYPE
+		:return footprint [array] - The footprint, only if return_footprint is True
+
+		'''
+
+		block_rows = block_rows or Configuration.ALIGN_BLOCK_ROWS
+
+		shape = (reference_header['NAXIS2'], reference_header['NAXIS1'])
+		reference_wcs = Aligner.read_wcs(reference_header)
+
+		aligned_data = np.empty(shape, dtype=Configuration.DTYPE)
+		footprint = np.empty(shape, dtype=Configuration.DTYPE) if return_footprint else None
+
+		for y0 in range(0, shape[0], block_rows):
+			y1 = min(y0 + block_rows, shape[0])
+			block_wcs = reference_wcs[y0:y1, :]
+
+			if return_footprint:
+				aligned_data[y0:y1], footprint[y0:y1] = reproject_interp(target_hdu, block_wcs, shape_out=(y1 - y0, shape[1]))
+
+			else:
+				aligned_data[y0:y1] = reproject_interp(target_hdu, block_wcs, shape_out=(y1 - y0, shape[1]), return_footprint=False)
+
+		if return_footprint:
+			return aligned_data, footprint
+
+		return aligned_data
+
+	@staticmethod
+	def select_reference(wcs_dir, obj_list, strategy=None, fields=None):
+		''' This function picks the reference that the frames of an object are aligned to. The 'first' strategy takes the first frame, 'seeing' the frame with the smallest median FWHM, and 'field' the survey field nearest to the first frame, so that every night of a field shares one pixel grid.
+
+		:parameter wcs_dir [string] - The directory of the solved frames
+		:parameter obj_list [list] - The names of the solved frames
+		:parameter strategy [string] - The reference strategy (first, seeing or field); the default is Configuration.ALIGN_REFERENCE
+		:parameter fields [DataFrame] - The survey fields, as returned by Priority.field_generator, for the field strategy
+
+		:return reference_name [string] - The name of the reference frame, or None for a survey field
+		:return reference_header [Header] - The header of the reference, with REFFRAME naming it
+
+		'''
+
+		strategy = strategy or Configuration.ALIGN_REFERENCE
+
+		if strategy not in ('first', 'seeing', 'field'):
+			raise ValueError('Unknown reference strategy {} (must be one of first, seeing, field)'.format(strategy))
+
+		if strategy == 'field':
+			if fields is None:
+				raise ValueError('The field reference strategy needs the survey fields')
+
+			reference_header, field_id = Aligner.field_header(Reader.read_header(os.path.join(wcs_dir, obj_list[0])), fields)
+			reference_header['REFFRAME'] = ('field ' + field_id, 'Reference of the alignment')
+			print('Aligning to survey field', field_id)
+
+			return None, reference_header
+
+		reference_name = obj_list[0]
+
+		if strategy == 'seeing':
+			best_fwhm = np.inf
+
+			for obj in obj_list:
+				frame_data, frame_header = Reader.load_frame(os.path.join(wcs_dir, obj))
+				fwhm = Aligner.measure_fwhm(frame_data)
+				print('Frame', obj, 'has a median FWHM of', '%.2f' % fwhm, 'pixels')
+
+				if fwhm < best_fwhm:
+					best_fwhm = fwhm
+					reference_name = obj
+
+		print('Reference frame', reference_name)
+		reference_header = Reader.read_header(os.path.join(wcs_dir, reference_name))
+		reference_header['REFFRAME'] = (reference_name, 'Reference of the alignment')
+
+		return reference_name, reference_header
@@ -0,0 +1,258 @@
+from config import Configuration
+
+from astropy.stats import SigmaClip
+from astropy.utils.exceptions import AstropyUserWarning
+from photutils.background import Background2D, MedianBackground
+from photutils.segmentation import detect_threshold, detect_sources
+from photutils.utils import circular_footprint
+from scipy import ndimage
+from scipy.spatial import cKDTree
+import numpy as np
+import warnings
+
+class Background:
+	''' This class holds the coarse background mesh of a frame, estimated from sigma-clipped medians of boxes of Configuration.BOX_SIZE pixels. The full-resolution background is only interpolated from the mesh when it is asked for.
+
+	:parameter background_mesh [array] - The background of every box
+	:parameter background_rms_mesh [array] - The background rms of every box
+	:parameter shape [tuple] - The shape of the frame
+
+	'''
+
+	# --- Background of the last frame reduced by this process, used as a warm start for the next one. It is process-global and not shared with worker processes, so parallel reductions start every frame cold
+	previous = None
+
+	# --- Largest shift of the median level from the previous background, in units of its rms, for which the warm start is used
+	LEVEL_TOLERANCE = 1.0
+
+	# --- Stride of the sample of pixels that measures the median level of a frame
+	SAMPLE_STRIDE = 8
+
+	# --- Boxes with a larger percentage of masked pixels are replaced by their neighbours
+	EXCLUDE_PERCENTILE = 50
+
+	# --- Number of valid boxes whose inverse distance weighted mean replaces an excluded box
+	FILL_NEIGHBOURS = 10
+
+	# --- Radius of the dilation of detected sources [pixels]
+	MASK_RADIUS = 10
+
+	def __init__(self, background_mesh, background_rms_mesh, shape):
+
+		self.background_mesh = background_mesh
+		self.background_rms_mesh = background_rms_mesh
+		self.shape = tuple(shape)
+
+		self.background_median = float(np.median(background_mesh))
+		self.background_rms_median = float(np.median(background_rms_mesh))
+
+	@property
+	def background(self):
+		''' This property returns the full-resolution background, interpolated bilinearly from the mesh.
+
+		'''
+
+		return self.interpolate(self.background_mesh)
+
+	@property
+	def background_rms(self):
+		''' This property returns the full-resolution background rms, interpolated bilinearly from the mesh.
+
+		'''
+
+		return self.interpolate(self.background_rms_mesh)
+
+	@staticmethod
+	def estimate(frame_data, estimator=None, previous=None):
+		''' This function masks the sources of a frame and estimates its background with the masked pixels excluded. The 'background2d' estimator is photutils.Background2D; the 'mesh' estimator bins the frame into boxes and takes their sigma-clipped medians in one vectorized pass. With a previous background of the same shape and a median level within LEVEL_TOLERANCE rms of it, the detection threshold comes from its mesh instead of a sigma-clipped pass over the whole frame, and the mesh estimator clips every box once around the previous mesh instead of iterating. If the warm start still leaves no usable box, the background is estimated again without it.
+
+		:parameter frame_data [array] - The pixel values of the calibrated frame
+		:parameter estimator [string] - The background estimator (background2d or mesh); the default is Configuration.BKG_ESTIMATOR
+		:parameter previous [Background] - The background of the previous frame of a dithered sequence, or None
+
+		:return bkg [Background2D or Background] - The background of the frame
+		:return mask [array] - The source mask, True where a pixel belongs to a source
+
+		'''
+
+		estimator = estimator or Configuration.BKG_ESTIMATOR
+
+		if estimator not in ('background2d', 'mesh'):
+			raise ValueError('Unknown background estimator {} (must be one of background2d, mesh)'.format(estimator))
+
+		if (previous is not None) and (Background.mesh_shape(frame_data.shape) != previous.background_mesh.shape):
+			previous = None
+
+		if previous is not None:
+			level = np.nanmedian(frame_data[::Background.SAMPLE_STRIDE, ::Background.SAMPLE_STRIDE])
+
+			if not (abs(level - previous.background_median) <= Background.LEVEL_TOLERANCE * previous.background_rms_median):
+				print('Background level moved from', '%.1f' % previous.background_median, 'to', '%.1f' % level + ', estimating without warm start')
+				previous = None
+
+		if previous is not None:
+			try:
+				return Background.fit(frame_data, estimator, previous)
+
+			except ValueError:
+				print('Warm start masked the whole background mesh, estimating without it')
+
+		return Background.fit(frame_data, estimator)
+
+	@staticmethod
+	def fill_excluded(mesh, excluded):
+		''' This function replaces the excluded boxes of a mesh with the inverse distance weighted mean of the nearest valid boxes, as Background2D does, so a gradient carries on under masked regions.
+
+		:parameter mesh [array] - The values of the boxes, updated in place
+		:parameter excluded [array] - The boxes to replace, True where a box is excluded
+
+		'''
+
+		valid_y, valid_x = np.nonzero(~excluded)
+		excluded_y, excluded_x = np.nonzero(excluded)
+
+		if len(excluded_y) == 0:
+			return
+
+		n_neighbours = min(Background.FILL_NEIGHBOURS, len(valid_y))
+		distance, index = cKDTree(np.column_stack([valid_y, valid_x])).query(np.column_stack([excluded_y, excluded_x]), k=n_neighbours)
+
+		weights = 1. / distance.reshape(len(excluded_y), n_neighbours)
+		values = mesh[valid_y, valid_x][index.reshape(len(excluded_y), n_neighbours)]
+
+		mesh[excluded_y, excluded_x] = np.sum(weights * values, axis=1) / np.sum(weights, axis=1)
+
+	@staticmethod
+	def fit(frame_data, estimator, previous=None):
+		''' This function masks the sources of a frame and fits its background with the given estimator.
+
+		:parameter frame_data [array] - The pixel values of the calibrated frame
+		:parameter estimator [string] - The background estimator (background2d or mesh)
+		:parameter previous [Background] - The background of the previous frame, or None
+
+		:return bkg [Background2D or Background] - The background of the frame
+		:return mask [array] - The source mask, True where a pixel belongs to a source
+
+		'''
+
+		mask = Background.source_mask(frame_data, previous)
+
+		if estimator == 'background2d':
+			sigma_clip = SigmaClip(sigma=Configuration.SIGMA_BKG)
+			bkg = Background2D(frame_data, box_size=Configuration.BOX_SIZE, mask=mask, filter_size=Configuration.FILTER_SIZE, sigma_clip=sigma_clip, bkg_estimator=MedianBackground(), exclude_percentile=Background.EXCLUDE_PERCENTILE)
+
+		else:
+			bkg = Background.mesh(frame_data, mask, previous)
+
+		return bkg, mask
+
+	def interpolate(self, mesh):
+		''' This function interpolates a mesh bilinearly to the shape of the frame.
+
+		:parameter mesh [array] - The values of the boxes
+
+		:return image [array] - The interpolated values of the pixels
+
+		'''
+
+		zoom = (self.shape[0] / mesh.shape[0], self.shape[1] / mesh.shape[1])
+		image = ndimage.zoom(mesh, zoom, order=1, mode='nearest', grid_mode=True)
+
+		return image[:self.shape[0], :self.shape[1]].astype(Configuration.DTYPE, copy=False)
+
+	@staticmethod
+	def mesh(frame_data, mask=None, previous=None):
+		''' This function estimates the background mesh of a frame from the sigma-clipped medians of its boxes. Partial boxes at the edges are padded with masked pixels, and boxes with too many masked pixels are interpolated from their valid neighbours by fill_excluded before the mesh is median-filtered.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter mask [array] - The source mask, True where a pixel is excluded
+		:parameter previous [Background] - The background of the previous frame, whose mesh centres a single clipping pass
+
+		:return bkg [Background] - The background of the frame
+
+		'''
+
+		box_y, box_x = Configuration.BOX_SIZE
+		mesh_y, mesh_x = Background.mesh_shape(frame_data.shape)
+
+		boxes = np.full((mesh_y * box_y, mesh_x * box_x), np.nan, dtype=Configuration.DTYPE)
+		boxes[:frame_data.shape[0], :frame_data.shape[1]] = frame_data
+
+		if mask is not None:
+			boxes[:frame_data.shape[0], :frame_data.shape[1]][mask] = np.nan
+
+		boxes[~np.isfinite(boxes)] = np.nan
+		boxes = boxes.reshape(mesh_y, box_y, mesh_x, box_x).transpose(0, 2, 1, 3).reshape(mesh_y, mesh_x, box_y * box_x)
+
+		excluded = np.mean(np.isnan(boxes), axis=2) * 100 > Background.EXCLUDE_PERCENTILE
+
+		# --- Masked and padded pixels are NaN, and fully masked boxes give all-NaN slices
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)
+			warnings.simplefilter('ignore', AstropyUserWarning)
+
+			if previous is not None:
+				centre = previous.background_mesh[..., np.newaxis]
+				width = Configuration.SIGMA_BKG * previous.background_rms_mesh[..., np.newaxis]
+				boxes[np.abs(boxes - centre) > width] = np.nan
+
+			else:
+				boxes = SigmaClip(sigma=Configuration.SIGMA_BKG)(boxes, axis=2, masked=False, copy=False)
+
+			background_mesh = np.nanmedian(boxes, axis=2)
+			background_rms_mesh = np.nanstd(boxes, axis=2)
+
+		excluded |= ~np.isfinite(background_mesh)
+
+		if np.all(excluded):
+			raise ValueError('Every box of the background mesh is masked')
+
+		Background.fill_excluded(background_mesh, excluded)
+		Background.fill_excluded(background_rms_mesh, excluded)
+
+		background_mesh = ndimage.median_filter(background_mesh, size=Configuration.FILTER_SIZE, mode='nearest')
+		background_rms_mesh = ndimage.median_filter(background_rms_mesh, size=Configuration.FILTER_SIZE, mode='nearest')
+
+		return Background(background_mesh, background_rms_mesh, frame_data.shape)
+
+	@staticmethod
+	def mesh_shape(shape):
+		''' This function returns the shape of the background mesh of a frame.
+
+		:parameter shape [tuple] - The shape of the frame
+
+		:return mesh_shape [tuple] - The number of boxes along each axis
+
+		'''
+
+		box_y, box_x = Configuration.BOX_SIZE
+
+		return (-(-shape[0] // box_y), -(-shape[1] // box_x))
+
+	@staticmethod
+	def source_mask(frame_data, previous=None):
+		''' This function detects the sources of a frame and dilates them into a mask.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter previous [Background] - The background of the previous frame, whose background and rms give the detection threshold
+
+		:return mask [array] - The source mask, or None if no source is detected
+
+		'''
+
+		if previous is not None:
+			threshold = previous.background + Configuration.SIGMA_BKG * previous.background_rms
+
+		else:
+			sigma_clip = SigmaClip(sigma=Configuration.SIGMA_BKG)
+			threshold = detect_threshold(frame_data, nsigma=Configuration.SIGMA_BKG, sigma_clip=sigma_clip)
+
+		segment_img = detect_sources(frame_data, threshold, npixels=Configuration.NPIXELS)
+
+		if segment_img is None:
+			return None
+
+		footprint = circular_footprint(radius=Background.MASK_RADIUS)
+		mask = segment_img.make_source_mask(footprint=footprint)
+
+		return mask
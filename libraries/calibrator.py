@@ -0,0 +1,222 @@
+from config import Configuration
+from libraries.masker import Masker
+
+from astropy.io import fits
+from multiprocessing import shared_memory
+import numpy as np
+import warnings
+
+class Calibrator:
+	''' This class holds the master dark and flatfield of a night in memory so that every science frame is calibrated against the same arrays.
+
+	:parameter dark_path [string] - The path of the master dark
+	:parameter flat_path [string] - The path of the flatfield
+
+	'''
+
+	# --- Calibrator attached to the shared memory of a worker process
+	shared = None
+	# --- Number of scaled darks kept in memory; the oldest exposure time is dropped first
+	SCALED_DARKS = 4
+
+	def __init__(self, dark_path, flat_path):
+
+		self.dark_path = dark_path
+		self.flat_path = flat_path
+		self.blocks = []
+
+		print('Loading calibration frames')
+		self.dark_data, self.dark_header = Calibrator.load_frame(dark_path)
+		self.flat_data, self.flat_header = Calibrator.load_frame(flat_path)
+
+		if self.dark_data.shape != self.flat_data.shape:
+			raise ValueError('Master dark shape {} does not match flatfield shape {}'.format(self.dark_data.shape, self.flat_data.shape))
+
+		self.shape = self.dark_data.shape
+		self.dark_exposure = Calibrator.read_exposure(self.dark_header)
+		self.scaled_darks = {}
+
+		# --- Pixels of the bad pixel map measured from the calibration frames of the camera
+		y, x, flags = Masker.read_bpm(Configuration.CAMERA, self.dark_header.get('XBINNING', 1), self.shape)
+		self.bad_pixels = (y, x)
+
+		if self.dark_exposure is None:
+			print('Master dark has no exposure time, dark current will not be scaled')
+
+	@staticmethod
+	def load_frame(frame_path):
+		''' This function reads a calibration frame into a read-only array of type Configuration.DTYPE.
+
+		:parameter frame_path [string] - The path of the calibration frame
+
+		:return data [array] - The pixel values of the frame
+		:return header [Header] - The header of the frame
+
+		'''
+
+		with fits.open(frame_path) as frame:
+			data = np.array(frame[0].data, dtype=Configuration.DTYPE, order='C')
+			header = frame[0].header.copy()
+
+		if data.ndim != 2:
+			raise ValueError('Calibration frame {} is not a 2D image'.format(frame_path))
+
+		if not np.all(np.isfinite(data)):
+			raise ValueError('Calibration frame {} contains non-finite pixels'.format(frame_path))
+
+		data.setflags(write=False)
+
+		return data, header
+
+	def calibrate(self, frame_data, exposure=None):
+		''' This function subtracts the master dark, scaled to the exposure time of the frame, divides the frame by the flatfield and replaces the bad pixels of the camera. The frame is copied once into Configuration.DTYPE and every step is done in place.
+
+		:parameter frame_data [array] - The pixel values of the raw frame
+		:parameter exposure [float] - The exposure time of the frame [s]
+
+		:return reduced_data [array] - The pixel values of the calibrated frame
+
+		'''
+
+		if frame_data.shape != self.shape:
+			raise ValueError('Frame shape {} does not match calibration shape {}'.format(frame_data.shape, self.shape))
+
+		reduced_data = np.array(frame_data, dtype=Configuration.DTYPE)
+		reduced_data -= self.scale_dark(exposure)
+		reduced_data /= self.flat_data
+		self.repair(reduced_data)
+
+		return reduced_data
+
+	@staticmethod
+	def read_exposure(header):
+		''' This function returns the exposure time stored in a header.
+
+		:parameter header [Header] - The header of the frame
+
+		:return exposure [float] - The exposure time of the frame [s], or None if the header has none
+
+		'''
+
+		for key in ('EXPOSURE', 'EXPTIME'):
+			if key in header:
+				return float(header[key])
+
+		return None
+
+	def repair(self, frame_data):
+		''' This function replaces the bad pixels of a frame with the median of their good neighbours. Only the few bad pixels and their neighbours are read, so the cost does not depend on the size of the frame.
+
+		:parameter frame_data [array] - The pixel values of the frame, modified in place
+
+		'''
+
+		y, x = self.bad_pixels
+
+		if len(y) == 0:
+			return
+
+		dy, dx = np.mgrid[-1:2, -1:2]
+		neighbours = (dy != 0) | (dx != 0)
+		ny = np.clip(y[:, np.newaxis] + dy[neighbours], 0, self.shape[0] - 1)
+		nx = np.clip(x[:, np.newaxis] + dx[neighbours], 0, self.shape[1] - 1)
+
+		bad = np.isin(ny * self.shape[1] + nx, y * self.shape[1] + x)
+		values = np.where(bad, np.nan, frame_data[ny, nx])
+
+		# --- A pixel whose neighbours are all bad keeps its value
+		with np.errstate(all='ignore'), warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)
+			repaired = np.nanmedian(values, axis=1)
+
+		good = np.isfinite(repaired)
+		frame_data[y[good], x[good]] = repaired[good]
+
+	def scale_dark(self, exposure):
+		''' This function returns the master dark scaled to a given exposure time. The last Calibrator.SCALED_DARKS scaled darks are cached, so a night with a handful of exposure times scales the dark only a handful of times while a night with many keeps a bounded footprint.
+
+		:parameter exposure [float] - The exposure time of the frame [s]
+
+		:return scaled_dark [array] - The scaled master dark
+
+		'''
+
+		if (exposure is None) or (self.dark_exposure is None) or (exposure == self.dark_exposure):
+			return self.dark_data
+
+		if exposure not in self.scaled_darks:
+			if len(self.scaled_darks) >= Calibrator.SCALED_DARKS:
+				del self.scaled_darks[next(iter(self.scaled_darks))]
+			scaled_dark = self.dark_data * np.asarray(exposure / self.dark_exposure, dtype=self.dark_data.dtype)
+			scaled_dark.setflags(write=False)
+			self.scaled_darks[exposure] = scaled_dark
+
+		return self.scaled_darks[exposure]
+
+	def share(self):
+		''' This function copies the master dark and flatfield into shared memory blocks so that worker processes can map them without pickling.
+
+		:return descriptor [dictionary] - The names, shape and dtype of the shared memory blocks
+
+		'''
+
+		descriptor = {}
+		descriptor['shape'] = self.shape
+		descriptor['dtype'] = str(self.dark_data.dtype)
+		descriptor['dark_exposure'] = self.dark_exposure
+		descriptor['bad_pixels'] = self.bad_pixels
+
+		for key, data in (('dark', self.dark_data), ('flat', self.flat_data)):
+			block = shared_memory.SharedMemory(create=True, size=data.nbytes)
+			self.blocks.append(block)
+
+			shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)
+			shared_data[:] = data
+
+			descriptor[key] = block.name
+
+		return descriptor
+
+	def release(self):
+		''' This function closes and unlinks the shared memory blocks created by share.
+
+		'''
+
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+
+		self.blocks = []
+
+	@staticmethod
+	def attach(descriptor):
+		''' This function maps the shared master dark and flatfield into a worker process and stores the result in Calibrator.shared.
+
+		:parameter descriptor [dictionary] - The descriptor returned by share
+
+		:return calibrator [Calibrator] - The calibrator backed by shared memory
+
+		'''
+
+		calibrator = Calibrator.__new__(Calibrator)
+		calibrator.dark_path = None
+		calibrator.flat_path = None
+		calibrator.dark_header = None
+		calibrator.flat_header = None
+		calibrator.shape = tuple(descriptor['shape'])
+		calibrator.dark_exposure = descriptor['dark_exposure']
+		calibrator.bad_pixels = descriptor['bad_pixels']
+		calibrator.scaled_darks = {}
+		calibrator.blocks = []
+
+		for key in ('dark', 'flat'):
+			block = shared_memory.SharedMemory(name=descriptor[key])
+			calibrator.blocks.append(block)
+
+			data = np.ndarray(calibrator.shape, dtype=descriptor['dtype'], buffer=block.buf)
+			data.setflags(write=False)
+			setattr(calibrator, key + '_data', data)
+
+		Calibrator.shared = calibrator
+
+		return calibrator
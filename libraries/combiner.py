@@ -0,0 +1,198 @@
+from config import Configuration
+
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.stats import mad_std, sigma_clip
+import numpy as np
+import os
+import resource
+import sys
+
+class Combiner:
+
+	@staticmethod
+	def available_memory():
+		''' This function returns the physical memory currently available to the process.
+
+		:return available [int] - The available memory [bytes], or None if it cannot be determined
+
+		'''
+
+		try:
+			return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+		except (AttributeError, ValueError, OSError):
+			return None
+
+	@staticmethod
+	def combine(frame_list, method=None, mem_limit=None, dtype=None, sigma=None, transform=None, spread=False):
+		''' This function combines a list of frames one horizontal strip at a time. Every frame is memory-mapped, so only one strip of each frame is held in memory at any time.
+
+		:parameter frame_list [list] - The paths of the frames to combine
+		:parameter method [string] - The combine method (median, average or sigma_clip); the default is Configuration.COMBINE_METHOD
+		:parameter mem_limit [float] - The upper limit on the memory used for the strips [bytes]; the default is Configuration.MEM_LIMIT
+		:parameter dtype [string] - The dtype used for the computation and the output; the default is Configuration.DTYPE
+		:parameter sigma [float] - The clipping threshold for sigma_clip; the default is Configuration.SIGMA_BKG
+		:parameter transform [function] - An optional function (index, rows, strip) that modifies the strip of frame index in place before it is combined
+		:parameter spread [bool] - Whether to also return the per-pixel robust standard deviation of the frames, measured on the strips already in memory
+
+		:return combined [CCDData] - The combined frame, with the header of the first frame
+		:return spread_data [array] - The robust standard deviation of every pixel across the frames, only if spread is True
+
+		'''
+
+		method = method or Configuration.COMBINE_METHOD
+		mem_limit = mem_limit or Configuration.MEM_LIMIT
+		dtype = np.dtype(dtype or Configuration.DTYPE)
+		sigma = sigma or Configuration.SIGMA_BKG
+
+		if method == 'mean':
+			method = 'average'
+
+		if method not in ('median', 'average', 'sigma_clip'):
+			raise ValueError('Unknown combine method {} (must be one of median, average, sigma_clip)'.format(method))
+
+		if len(frame_list) == 0:
+			raise ValueError('No frames to combine')
+
+		frames = [fits.open(item, memmap=True, do_not_scale_image_data=True) for item in frame_list]
+
+		try:
+			shape = frames[0][0].data.shape
+			for item, frame in zip(frame_list, frames):
+				if frame[0].data.shape != shape:
+					raise ValueError('Frame {} has shape {} but expected {}'.format(item, frame[0].data.shape, shape))
+
+			strip_height = min(shape[0], Combiner.strip_height(len(frames), shape[1], dtype.itemsize, mem_limit))
+			print('Combining', len(frames), 'frames with method', method, 'in strips of', strip_height, 'rows')
+
+			combined_data = np.empty(shape, dtype=dtype)
+			spread_data = np.empty(shape, dtype=dtype) if spread else None
+			strip = np.empty((len(frames), strip_height, shape[1]), dtype=dtype)
+			peak_memory = Combiner.resident_memory()
+
+			for y0 in range(0, shape[0], strip_height):
+				y1 = min(y0 + strip_height, shape[0])
+				rows = slice(y0, y1)
+				cube = strip[:, 0:y1-y0]
+
+				for index, frame in enumerate(frames):
+					Combiner.read_strip(frame[0], rows, cube[index])
+
+					if transform is not None:
+						transform(index, rows, cube[index])
+
+				combined_data[rows] = Combiner.combine_strip(cube, method, sigma)
+
+				if spread:
+					spread_data[rows] = mad_std(cube, axis=0)
+
+				peak_memory = max(peak_memory, Combiner.resident_memory())
+
+			header = frames[0][0].header.copy()
+
+		finally:
+			for frame in frames:
+				frame.close()
+
+		for key in ('BZERO', 'BSCALE', 'BLANK'):
+			header.remove(key, ignore_missing=True)
+		header['NCOMBINE'] = len(frame_list)
+
+		print('Peak resident memory', '%.1f' % (peak_memory / 1024**2), 'MB')
+
+		combined = CCDData(combined_data, unit='adu', meta=header)
+
+		if spread:
+			return combined, spread_data
+
+		return combined
+
+	@staticmethod
+	def combine_strip(cube, method, sigma):
+		''' This function combines a stack of strips along the frame axis.
+
+		:parameter cube [array] - The strips, with shape (frames, rows, columns)
+		:parameter method [string] - The combine method (median, average or sigma_clip)
+		:parameter sigma [float] - The clipping threshold for sigma_clip
+
+		:return combined [array] - The combined strip
+
+		'''
+
+		if method == 'median':
+			return np.median(cube, axis=0)
+
+		elif method == 'average':
+			return np.mean(cube, axis=0)
+
+		else:
+			clipped = sigma_clip(cube, sigma=sigma, maxiters=5, cenfunc='median', stdfunc='std', axis=0, masked=False, copy=True)
+			return np.nanmean(clipped, axis=0)
+
+	@staticmethod
+	def read_strip(hdu, rows, out):
+		''' This function reads a block of rows from a memory-mapped HDU and applies BSCALE and BZERO to it.
+
+		:parameter hdu [PrimaryHDU] - The HDU opened with do_not_scale_image_data=True
+		:parameter rows [slice] - The rows to read
+		:parameter out [array] - The array that receives the scaled rows
+
+		'''
+
+		out[:] = hdu.data[rows]
+
+		bscale = hdu.header.get('BSCALE', 1)
+		bzero = hdu.header.get('BZERO', 0)
+
+		if bscale != 1:
+			out *= bscale
+
+		if bzero != 0:
+			out += bzero
+
+	@staticmethod
+	def resident_memory():
+		''' This function returns the resident memory of the process.
+
+		:return rss [int] - The resident set size [bytes]
+
+		'''
+
+		try:
+			with open('/proc/self/statm') as statm:
+				return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+		except (OSError, ValueError):
+			# --- Without /proc fall back to the peak resident size, which macOS reports in bytes
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+			if sys.platform != 'darwin':
+				rss *= 1024
+
+			return rss
+
+	@staticmethod
+	def strip_height(n_frames, width, itemsize, mem_limit):
+		''' This function returns the number of rows per strip that keeps the strips and the temporaries of the combine within the memory budget.
+
+		:parameter n_frames [int] - The number of frames to combine
+		:parameter width [int] - The number of columns of each frame
+		:parameter itemsize [int] - The size of one pixel in the computation dtype [bytes]
+		:parameter mem_limit [float] - The upper limit on the memory used for the strips [bytes]
+
+		:return strip_height [int] - The number of rows per strip
+
+		'''
+
+		budget = mem_limit
+
+		available = Combiner.available_memory()
+		if available is not None:
+			budget = min(budget, available // 2)
+
+		# --- The strip cube plus up to three cube-sized temporaries (sorting, clipping masks)
+		row_bytes = 4 * n_frames * width * itemsize
+		strip_height = int(max(1, budget // row_bytes))
+
+		return strip_height
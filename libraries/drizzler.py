@@ -0,0 +1,256 @@
+from config import Configuration
+from libraries.aligner import Aligner
+from libraries.combiner import Combiner
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_area
+import numpy as np
+import os
+
+class Drizzler:
+
+	# --- Number of points along each axis of the output border mapped back to a frame to find the rows it covers
+	BORDER_POINTS = 64
+
+	@staticmethod
+	def deposit(sums, weights, frame_data, first_row, frame_wcs, output_wcs, y0, pixfrac, weight=1.):
+		''' This function drops the pixels of a block of rows of a frame onto a strip of the output grid. Every pixel is shrunk to a drop of pixfrac times its size and sampled on a regular grid of points fine enough for the output pixels; each point carries its share of the pixel weight to the output pixel it falls in. The points are placed with the local affine approximation of the mapping, measured from the WCS at the pixel centres, so the WCS is evaluated once per input pixel.
+
+		:parameter sums [array] - The weighted sum of the output strip, updated in place
+		:parameter weights [array] - The sum of the weights of the output strip, updated in place
+		:parameter frame_data [array] - The pixel values of the block of rows
+		:parameter first_row [int] - The row of the frame where the block starts
+		:parameter frame_wcs [WCS] - The celestial WCS of the frame
+		:parameter output_wcs [WCS] - The celestial WCS of the output grid
+		:parameter y0 [int] - The row of the output grid where the strip starts
+		:parameter pixfrac [float] - The linear size of the drop relative to the input pixel
+		:parameter weight [float] - The weight of the frame
+
+		'''
+
+		strip_rows, width = sums.shape
+		rows, columns = frame_data.shape
+
+		# --- One extra row and column gives the forward differences of the mapping at every pixel
+		yy, xx = np.mgrid[first_row:first_row+rows+1, 0:columns+1]
+		ox, oy = output_wcs.world_to_pixel_values(*frame_wcs.pixel_to_world_values(xx, yy))
+
+		cx = ox[:-1, :-1]
+		cy = oy[:-1, :-1]
+		dxdx = ox[:-1, 1:] - cx
+		dxdy = ox[1:, :-1] - cx
+		dydx = oy[:-1, 1:] - cy
+		dydy = oy[1:, :-1] - cy
+
+		# --- Input pixels are sampled finely enough that every output pixel under a drop receives points
+		with np.errstate(invalid='ignore'):
+			pixel_sizes = np.maximum(np.hypot(dxdx, dydx), np.hypot(dxdy, dydy))
+
+		pixel_size = np.max(pixel_sizes[np.isfinite(pixel_sizes)], initial=1.)
+		n_points = max(1, int(np.ceil(2 * pixfrac * pixel_size)))
+		offsets = pixfrac * ((np.arange(n_points) + 0.5) / n_points - 0.5)
+
+		# --- Values are scaled from input to output pixel area so that the flux is conserved
+		area_ratio = proj_plane_pixel_area(output_wcs) / proj_plane_pixel_area(frame_wcs)
+		values = frame_data * area_ratio
+		valid = np.isfinite(values) & np.isfinite(cx) & np.isfinite(cy)
+		point_weight = weight / n_points**2
+
+		for v in offsets:
+			for u in offsets:
+				px = cx + u * dxdx + v * dxdy
+				py = cy + u * dydx + v * dydy
+
+				with np.errstate(invalid='ignore'):
+					ix = np.floor(px + 0.5)
+					iy = np.floor(py + 0.5) - y0
+					inside = valid & (ix >= 0) & (ix < width) & (iy >= 0) & (iy < strip_rows)
+
+				index = iy[inside].astype(np.intp) * width + ix[inside].astype(np.intp)
+
+				sums += np.bincount(index, weights=values[inside], minlength=sums.size).reshape(sums.shape) * point_weight
+				weights += np.bincount(index, minlength=sums.size).reshape(sums.shape) * point_weight
+
+	@staticmethod
+	def drizzle(frame_paths, output_header, drizzle_path, weight_path, pixfrac=None, block_rows=None, frame_weights=None):
+		''' This function co-adds solved frames onto the output grid in a single pass, without resampling them onto the reference grid first. The output is built one strip of rows at a time: for every strip only the rows of each frame that fall on it are read from the memory-mapped frame, and the finished strip is streamed to disk, so the memory used is bounded by the strip and not by the output.
+
+		:parameter frame_paths [list] - The paths of the solved frames
+		:parameter output_header [Header] - The header of the output grid, as returned by output_header
+		:parameter drizzle_path [string] - The path of the co-added frame
+		:parameter weight_path [string] - The path of the weight map
+		:parameter pixfrac [float] - The linear size of the drop relative to the input pixel; the default is Configuration.DRIZZLE_PIXFRAC
+		:parameter block_rows [int] - The number of output rows built at a time; the default is Configuration.DRIZZLE_BLOCK_ROWS
+		:parameter frame_weights [array] - The weight of every frame; the default weighs the frames equally
+
+		:return drizzle_path [string] - The path of the co-added frame
+
+		'''
+
+		pixfrac = pixfrac or Configuration.DRIZZLE_PIXFRAC
+		block_rows = block_rows or Configuration.DRIZZLE_BLOCK_ROWS
+		dtype = np.dtype(Configuration.DTYPE)
+
+		if len(frame_paths) == 0:
+			raise ValueError('No frames to drizzle')
+
+		if frame_weights is None:
+			frame_weights = np.ones(len(frame_paths))
+
+		output_wcs = Aligner.read_wcs(output_header)
+		shape = (output_header['NAXIS2'], output_header['NAXIS1'])
+		print('Drizzling', len(frame_paths), 'frames onto a', shape[1], 'x', shape[0], 'grid in strips of', block_rows, 'rows')
+
+		drizzle_header = Drizzler.stream_header(output_header, shape)
+		drizzle_header['NCOMBINE'] = len(frame_paths)
+		drizzle_header['PIXFRAC'] = (pixfrac, 'Drop size relative to the input pixel')
+
+		weight_header = Drizzler.stream_header(output_wcs.to_header(), shape)
+		weight_header['EXTNAME'] = 'WEIGHT'
+
+		# --- A streamed HDU would be appended to an existing file
+		for path in (drizzle_path, weight_path):
+			if os.path.isfile(path):
+				os.remove(path)
+
+		frames = [fits.open(frame_path, memmap=True, do_not_scale_image_data=True) for frame_path in frame_paths]
+
+		try:
+			frame_wcss = [Aligner.read_wcs(frame[0].header) for frame in frames]
+
+			drizzle_stream = fits.StreamingHDU(drizzle_path, drizzle_header)
+			weight_stream = fits.StreamingHDU(weight_path, weight_header)
+
+			for y0 in range(0, shape[0], block_rows):
+				y1 = min(y0 + block_rows, shape[0])
+
+				sums = np.zeros((y1 - y0, shape[1]))
+				weights = np.zeros((y1 - y0, shape[1]))
+
+				for frame, frame_wcs, frame_weight in zip(frames, frame_wcss, frame_weights):
+					rows = Drizzler.input_rows(frame_wcs, output_wcs, frame[0].data.shape, shape[1], y0, y1, pixfrac)
+
+					if rows is None:
+						continue
+
+					frame_data = np.empty((rows.stop - rows.start, frame[0].data.shape[1]), dtype=dtype)
+					Combiner.read_strip(frame[0], rows, frame_data)
+					Drizzler.deposit(sums, weights, frame_data, rows.start, frame_wcs, output_wcs, y0, pixfrac, frame_weight)
+
+				strip = np.full(sums.shape, np.nan, dtype=dtype)
+				np.divide(sums, weights, out=strip, where=weights > 0, casting='unsafe')
+
+				drizzle_stream.write(strip)
+				weight_stream.write(weights.astype(dtype))
+
+			drizzle_stream.close()
+			weight_stream.close()
+
+		finally:
+			for frame in frames:
+				frame.close()
+
+		return drizzle_path
+
+	@staticmethod
+	def input_rows(frame_wcs, output_wcs, frame_shape, width, y0, y1, pixfrac):
+		''' This function returns the rows of a frame whose drops can land on a strip of the output grid, from the border of the strip mapped back onto the frame.
+
+		:parameter frame_wcs [WCS] - The celestial WCS of the frame
+		:parameter output_wcs [WCS] - The celestial WCS of the output grid
+		:parameter frame_shape [tuple] - The shape of the frame
+		:parameter width [int] - The number of columns of the output grid
+		:parameter y0 [int] - The first row of the strip
+		:parameter y1 [int] - The row after the last row of the strip
+		:parameter pixfrac [float] - The linear size of the drop relative to the input pixel
+
+		:return rows [slice] - The rows of the frame, or None if the frame does not overlap the strip
+
+		'''
+
+		xs = np.linspace(-0.5, width - 0.5, Drizzler.BORDER_POINTS)
+		ys = np.linspace(y0 - 0.5, y1 - 0.5, Drizzler.BORDER_POINTS)
+
+		border_x = np.concatenate([xs, xs, np.full_like(ys, -0.5), np.full_like(ys, width - 0.5)])
+		border_y = np.concatenate([np.full_like(xs, y0 - 0.5), np.full_like(xs, y1 - 0.5), ys, ys])
+
+		fx, fy = frame_wcs.world_to_pixel_values(*output_wcs.pixel_to_world_values(border_x, border_y))
+
+		if not (np.all(np.isfinite(fx)) and np.all(np.isfinite(fy))):
+			return slice(0, frame_shape[0])
+
+		margin = pixfrac + 1
+
+		if (np.max(fx) < -margin) or (np.min(fx) > frame_shape[1] + margin):
+			return None
+
+		first_row = max(0, int(np.floor(np.min(fy) - margin)))
+		last_row = min(frame_shape[0], int(np.ceil(np.max(fy) + margin)) + 1)
+
+		if first_row >= last_row:
+			return None
+
+		return slice(first_row, last_row)
+
+	@staticmethod
+	def output_header(reference_header, scale=None):
+		''' This function builds the header of the output grid: the header of the reference with its WCS replaced by a TAN projection with the same orientation and pixels scale times the size of the reference pixels, covering the same area of the sky.
+
+		:parameter reference_header [Header] - The header of the reference
+		:parameter scale [float] - The size of the output pixels relative to the reference pixels; the default is Configuration.DRIZZLE_SCALE
+
+		:return output_header [Header] - The header of the output grid
+
+		'''
+
+		scale = scale or Configuration.DRIZZLE_SCALE
+
+		wcs = Aligner.read_wcs(reference_header)
+		shape = (int(np.ceil(reference_header['NAXIS2'] / scale)), int(np.ceil(reference_header['NAXIS1'] / scale)))
+
+		# --- The pixel edges of both grids coincide at the lower left corner
+		output_wcs = WCS(naxis=2)
+		output_wcs.wcs.ctype = [ctype.replace('-SIP', '') for ctype in wcs.wcs.ctype]
+		output_wcs.wcs.crval = wcs.wcs.crval
+		output_wcs.wcs.crpix = (wcs.wcs.crpix - 0.5) / scale + 0.5
+		output_wcs.wcs.cd = wcs.pixel_scale_matrix * scale
+
+		output_header = reference_header.copy()
+
+		for key in wcs.to_header(relax=True):
+			output_header.remove(key, ignore_missing=True, remove_all=True)
+
+		output_header.extend(output_wcs.to_header(), update=True)
+		output_header['NAXIS1'] = shape[1]
+		output_header['NAXIS2'] = shape[0]
+		output_header['DRZSCALE'] = (scale, 'Output pixel size relative to the reference')
+
+		return output_header
+
+	@staticmethod
+	def stream_header(header, shape):
+		''' This function returns a primary header for an image of the given shape in the computation dtype, with the cards of another header that do not describe the data layout.
+
+		:parameter header [Header] - The header whose other cards are copied
+		:parameter shape [tuple] - The shape of the image
+
+		:return stream_header [Header] - The header to stream the image with
+
+		'''
+
+		stream_header = fits.PrimaryHDU(np.zeros((1, 1), dtype=Configuration.DTYPE)).header
+		stream_header['NAXIS1'] = shape[1]
+		stream_header['NAXIS2'] = shape[0]
+
+		for card in header.cards:
+			if card.keyword in ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'BZERO', 'BSCALE', 'BLANK', ''):
+				continue
+
+			if card.keyword in ('COMMENT', 'HISTORY'):
+				stream_header.append(card)
+
+			else:
+				stream_header[card.keyword] = (card.value, card.comment)
+
+		return stream_header
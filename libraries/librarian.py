@@ -0,0 +1,291 @@
+from config import Configuration
+from libraries.reader import Reader
+from libraries.reducer import Reducer
+
+from astropy.time import Time
+import math
+import os
+
+class Librarian:
+
+	# --- IMAGETYP values written by the camera control software
+	DARK_TYPES = ('Dark Frame', 'Dark')
+	FLAT_TYPES = ('Flat Field', 'Flat Frame', 'Flat')
+
+	# --- Products of the reduction that must not be mistaken for raw frames
+	MASTER_NAMES = ('master-dark.fit', 'flatfield.fit', 'stack.fit')
+
+	# --- Subdirectories that Utils.create_directories makes in an object directory, which mark an object tree
+	OBJECT_DIRS = ('raw', 'cal', 'wcs', 'align')
+
+	@staticmethod
+	def build_darks(dark_rows):
+		''' This function builds a master dark in the library for every group of raw darks with the same exposure time, binning, shape, temperature and night, unless the library already has it.
+
+		:parameter dark_rows [list] - The header index rows of the raw darks
+
+		:return dark_paths [list] - The paths of the library masters
+
+		'''
+
+		dark_dir = Librarian.library_dir('dark')
+
+		groups = {}
+		for row in dark_rows:
+			temp = None if row['ccd_temp'] is None else int(round(row['ccd_temp']))
+			key = (row['exptime'], row['xbinning'], row['naxis1'], row['naxis2'], temp, Librarian.night(row))
+			groups.setdefault(key, []).append(row)
+
+		dark_paths = []
+
+		for (exptime, binning, naxis1, naxis2, temp, night), rows in groups.items():
+			dark_list = sorted(row['path'] for row in rows)
+
+			temp_label = 'na' if temp is None else '{:+d}C'.format(temp)
+			dark_name = 'dark-{:g}s-{}x{}-{}x{}-{}-{}.fit'.format(exptime, binning, binning, naxis1, naxis2, temp_label, night)
+			dark_path = os.path.join(dark_dir, dark_name)
+
+			Reducer.make_dark(os.path.dirname(dark_list[0]), dark_list=dark_list, dark_path=dark_path)
+			dark_paths.append(dark_path)
+
+		return dark_paths
+
+	@staticmethod
+	def build_flats(flat_rows):
+		''' This function builds a flatfield in the library for every group of raw flats with the same filter, binning, shape and night, using the closest master dark in the library.
+
+		:parameter flat_rows [list] - The header index rows of the raw flats
+
+		:return flat_paths [list] - The paths of the library flatfields
+
+		'''
+
+		flat_dir = Librarian.library_dir('flat')
+
+		groups = {}
+		for row in flat_rows:
+			key = (row['filter'], row['xbinning'], row['naxis1'], row['naxis2'], Librarian.night(row))
+			groups.setdefault(key, []).append(row)
+
+		flat_paths = []
+
+		for (filter, binning, naxis1, naxis2, night), rows in groups.items():
+			filter_label = 'na' if filter is None else str(filter).strip().replace(' ', '_')
+			flat_name = 'flat-{}-{}x{}-{}x{}-{}.fit'.format(filter_label, binning, binning, naxis1, naxis2, night)
+			flat_path = os.path.join(flat_dir, flat_name)
+
+			dark_path = Librarian.find_dark(rows[0])
+
+			if dark_path is None:
+				print('No master dark matches flats', flat_name, '- skipping')
+				continue
+
+			flat_list = sorted(row['path'] for row in rows)
+			Reducer.make_flat(os.path.dirname(flat_list[0]), None, flat_list=flat_list, flat_path=flat_path, dark_path=dark_path)
+			flat_paths.append(flat_path)
+
+		return flat_paths
+
+	@staticmethod
+	def build_library(night_dir):
+		''' This function finds the raw darks and flats anywhere under a night directory by their IMAGETYP and builds the missing library masters from them. Object trees, recognised by the subdirectories the reduction makes in them, are not searched, so no header index is left in them.
+
+		:parameter night_dir [string] - The directory of the night
+
+		:return dark_paths [list] - The paths of the library master darks
+		:return flat_paths [list] - The paths of the library flatfields
+
+		'''
+
+		print('Building calibration library from', night_dir)
+		library_dir = os.path.abspath(Configuration.LIBRARY_DIR)
+
+		dark_rows = []
+		flat_rows = []
+
+		for dirpath, dirnames, filenames in os.walk(night_dir):
+			dirnames.sort()
+
+			if os.path.abspath(dirpath).startswith(library_dir):
+				continue
+
+			if any(name in Librarian.OBJECT_DIRS for name in dirnames):
+				dirnames[:] = []
+				continue
+
+			if not any(name.endswith('.fit') for name in filenames):
+				continue
+
+			for row in Reader.query_directory(dirpath):
+				if row['name'] in Librarian.MASTER_NAMES:
+					continue
+
+				if row['imagetyp'] in Librarian.DARK_TYPES:
+					dark_rows.append(row)
+
+				elif row['imagetyp'] in Librarian.FLAT_TYPES:
+					flat_rows.append(row)
+
+		dark_paths = Librarian.build_darks(dark_rows)
+		flat_paths = Librarian.build_flats(flat_rows)
+
+		return dark_paths, flat_paths
+
+	@staticmethod
+	def days_between(row_a, row_b):
+		''' This function returns the number of days between the DATE-OBS of two header index rows.
+
+		:parameter row_a [dictionary] - The first header index row
+		:parameter row_b [dictionary] - The second header index row
+
+		:return days [float] - The number of days between the rows, or zero if either has no DATE-OBS
+
+		'''
+
+		if (row_a['dateobs'] is None) or (row_b['dateobs'] is None):
+			return 0.
+
+		return abs((Time(row_a['dateobs']) - Time(row_b['dateobs'])).jd)
+
+	@staticmethod
+	def find_dark(frame, update=True):
+		''' This function returns the library master dark that best matches a frame. Candidates must have the same binning and shape, a temperature within Configuration.TEMP_TOLERANCE and an age within Configuration.LIBRARY_MAX_AGE; among them the closest exposure time wins, then the closest temperature, then the closest date.
+
+		:parameter frame [dictionary] - The header index row of the frame
+		:parameter update [bool] - Whether to bring the index of the library up to date first
+
+		:return dark_path [string] - The path of the master dark, or None if no master matches
+
+		'''
+
+		dark_dir = Librarian.library_dir('dark')
+
+		candidates = []
+
+		for row in Reader.query_directory(dark_dir, xbinning=frame['xbinning'], update=update):
+			if (row['naxis1'], row['naxis2']) != (frame['naxis1'], frame['naxis2']):
+				continue
+
+			temp_delta = 0.
+			if (row['ccd_temp'] is not None) and (frame['ccd_temp'] is not None):
+				temp_delta = abs(row['ccd_temp'] - frame['ccd_temp'])
+
+				if temp_delta > Configuration.TEMP_TOLERANCE:
+					continue
+
+			age = Librarian.days_between(row, frame)
+			if age > Configuration.LIBRARY_MAX_AGE:
+				continue
+
+			exposure_delta = abs(math.log(frame['exptime'] / row['exptime'])) if (frame['exptime'] and row['exptime']) else math.inf
+
+			candidates.append((exposure_delta, temp_delta, age, row['path']))
+
+		if len(candidates) == 0:
+			return None
+
+		return min(candidates)[-1]
+
+	@staticmethod
+	def find_flat(frame, update=True):
+		''' This function returns the library flatfield that best matches a frame. Candidates must have the same filter, binning and shape and an age within Configuration.LIBRARY_MAX_AGE; the closest date wins.
+
+		:parameter frame [dictionary] - The header index row of the frame
+		:parameter update [bool] - Whether to bring the index of the library up to date first
+
+		:return flat_path [string] - The path of the flatfield, or None if no flatfield matches
+
+		'''
+
+		flat_dir = Librarian.library_dir('flat')
+
+		candidates = []
+
+		for row in Reader.query_directory(flat_dir, xbinning=frame['xbinning'], update=update):
+			if (row['naxis1'], row['naxis2']) != (frame['naxis1'], frame['naxis2']):
+				continue
+
+			if row['filter'] != frame['filter']:
+				continue
+
+			age = Librarian.days_between(row, frame)
+			if age > Configuration.LIBRARY_MAX_AGE:
+				continue
+
+			candidates.append((age, row['path']))
+
+		if len(candidates) == 0:
+			return None
+
+		return min(candidates)[-1]
+
+	@staticmethod
+	def library_dir(kind):
+		''' This function returns the library directory of a kind of master, creating it if necessary.
+
+		:parameter kind [string] - The kind of master (dark or flat)
+
+		:return path [string] - The directory of the masters
+
+		'''
+
+		path = os.path.join(Configuration.LIBRARY_DIR, kind)
+		os.makedirs(path, exist_ok=True)
+
+		return path
+
+	@staticmethod
+	def match_frames(obj_dir, night_dir=None):
+		''' This function picks the master dark and flatfield for every raw frame of an object directory. If a frame has no valid master and a night directory is given, the missing masters are built from the raw calibration frames of that night and the match is retried.
+
+		:parameter obj_dir [string] - The object directory, whose raw frames are in obj_dir/raw
+		:parameter night_dir [string] - The directory of the night that holds the raw calibration frames
+
+		:return calibrations [dictionary] - The (dark path, flat path) of every raw frame, keyed by frame name
+
+		'''
+
+		raw_dir = os.path.join(obj_dir, 'raw')
+		built = False
+
+		Reader.index_directory(Librarian.library_dir('dark'))
+		Reader.index_directory(Librarian.library_dir('flat'))
+
+		calibrations = {}
+
+		for frame in Reader.query_directory(raw_dir):
+			dark_path = Librarian.find_dark(frame, update=False)
+			flat_path = Librarian.find_flat(frame, update=False)
+
+			if ((dark_path is None) or (flat_path is None)) and (night_dir is not None) and (not built):
+				Librarian.build_library(night_dir)
+				built = True
+
+				dark_path = Librarian.find_dark(frame)
+				flat_path = Librarian.find_flat(frame)
+
+			if dark_path is None:
+				raise ValueError('No master dark in the library matches frame {}'.format(frame['name']))
+
+			if flat_path is None:
+				raise ValueError('No flatfield in the library matches frame {}'.format(frame['name']))
+
+			print('Matched', frame['name'], 'with', os.path.basename(dark_path), 'and', os.path.basename(flat_path))
+			calibrations[frame['name']] = (dark_path, flat_path)
+
+		return calibrations
+
+	@staticmethod
+	def night(row):
+		''' This function returns the date of the DATE-OBS of a header index row.
+
+		:parameter row [dictionary] - The header index row
+
+		:return night [string] - The date (yyyymmdd), or undated if the row has no DATE-OBS
+
+		'''
+
+		if row['dateobs'] is None:
+			return 'undated'
+
+		return row['dateobs'][:10].replace('-', '')
@@ -0,0 +1,422 @@
+from config import Configuration
+
+from astropy.io import fits
+from astropy.stats import mad_std
+from astropy.table import Table
+from photutils.aperture import RectangularAperture
+from scipy import ndimage
+import hashlib
+import numpy as np
+import os
+
+class Masker:
+
+	# --- Masks built or loaded by this process, keyed by (camera, binning, shape)
+	registry = {}
+
+	# --- Bad pixel maps read by this process, keyed by camera
+	maps = {}
+
+	# --- Width of the edge mask of a camera without a bad pixel map [unbinned pixels]
+	EDGE = 100
+
+	# --- Flags of the bad pixel map measured from the calibration frames
+	HOT = 1
+	DEAD = 2
+	UNSTABLE = 4
+
+	# --- Side of the boxes whose median response gives the smooth illumination of a flatfield [pixels]
+	ILLUMINATION_BOX = 64
+
+	@staticmethod
+	def bad_pixel_map(camera):
+		''' This function reads the bad pixel map of a camera from Configuration.MASK_DIR. The map is a text file with an 'edge <width>' line and one 'region <x1> <x2> <y1> <y2>' line per defect, in unbinned pixels with exclusive ends.
+
+		:parameter camera [string] - The name of the camera
+
+		:return edge [int] - The width of the edge mask [unbinned pixels]
+		:return regions [list] - The (x1, x2, y1, y2) rectangles of the defects [unbinned pixels]
+		:return digest [string] - A hash of the map, which changes whenever the map is edited
+
+		'''
+
+		if camera in Masker.maps:
+			return Masker.maps[camera]
+
+		map_path = os.path.join(Configuration.MASK_DIR, camera + '.txt')
+
+		edge = Masker.EDGE
+		regions = []
+
+		if not os.path.isfile(map_path):
+			print('No bad pixel map for camera', camera + ', masking the edges only')
+			Masker.maps[camera] = (edge, regions, 'edge-' + str(edge))
+
+			return Masker.maps[camera]
+
+		with open(map_path) as map_file:
+			text = map_file.read()
+
+		for number, line in enumerate(text.splitlines(), start=1):
+			fields = line.split('#')[0].split()
+
+			if len(fields) == 0:
+				continue
+
+			if (fields[0] == 'edge') and (len(fields) == 2):
+				edge = int(fields[1])
+
+			elif (fields[0] == 'region') and (len(fields) == 5):
+				regions.append(tuple(int(field) for field in fields[1:]))
+
+			else:
+				raise ValueError('Cannot parse line {} of bad pixel map {}: {}'.format(number, map_path, line))
+
+		digest = hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+		Masker.maps[camera] = (edge, regions, digest)
+
+		return edge, regions, digest
+
+	@staticmethod
+	def bpm_path(camera, binning, shape):
+		''' This function returns the path of the bad pixel map measured for a camera, binning and shape in the calibration library, or None if Configuration.LIBRARY_DIR does not exist.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frames
+		:parameter shape [tuple] - The shape of the frames
+
+		:return bpm_path [string] - The path of the bad pixel map
+
+		'''
+
+		if not os.path.isdir(Configuration.LIBRARY_DIR):
+			return None
+
+		name = '{}-{}x{}-{}x{}.fits'.format(camera, binning, binning, shape[0], shape[1])
+
+		return os.path.join(Configuration.LIBRARY_DIR, 'bpm', name)
+
+	@staticmethod
+	def build_mask(shape, binning, edge, regions):
+		''' This function builds the mask of a frame from the edge width and the defects of its camera.
+
+		:parameter shape [tuple] - The shape of the frame
+		:parameter binning [int] - The binning of the frame
+		:parameter edge [int] - The width of the edge mask [unbinned pixels]
+		:parameter regions [list] - The (x1, x2, y1, y2) rectangles of the defects [unbinned pixels]
+
+		:return mask [array] - The mask, True where a pixel is excluded
+
+		'''
+
+		mask = np.zeros(shape, dtype=bool)
+
+		for x1, x2, y1, y2 in regions:
+			mask[y1 // binning:y2 // binning, x1 // binning:x2 // binning] = True
+
+		edge = edge // binning
+
+		if edge > 0:
+			mask[:edge, :] = True
+			mask[-edge:, :] = True
+			mask[:, :edge] = True
+			mask[:, -edge:] = True
+
+		return mask
+
+	@staticmethod
+	def cache_path(camera, binning, shape, digest):
+		''' This function returns the path of the packed mask of a camera, binning and shape in the mask cache, or None if Configuration.CACHE_DIR does not exist.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frame
+		:parameter shape [tuple] - The shape of the frame
+		:parameter digest [string] - The hash of the bad pixel map
+
+		:return cache_path [string] - The path of the packed mask
+
+		'''
+
+		if not os.path.isdir(Configuration.CACHE_DIR):
+			return None
+
+		mask_dir = os.path.join(Configuration.CACHE_DIR, 'mask')
+		os.makedirs(mask_dir, exist_ok=True)
+
+		name = '{}-{}x{}-{}x{}-{}.npy'.format(camera, binning, binning, shape[0], shape[1], digest)
+
+		return os.path.join(mask_dir, name)
+
+	@staticmethod
+	def find_dead_pixels(flat_data, threshold=None):
+		''' This function flags the pixels of a flatfield whose response is below a fraction of the local illumination, the median response of the box of ILLUMINATION_BOX pixels around them interpolated bilinearly. Smooth vignetting therefore lowers the illumination along with the pixels and is not flagged, while isolated dead pixels and columns are.
+
+		:parameter flat_data [array] - The pixel values of the flatfield
+		:parameter threshold [float] - The fraction of the local illumination below which a pixel is dead; the default is Configuration.BPM_DEAD
+
+		:return flags [array] - The DEAD flag of every pixel
+
+		'''
+
+		threshold = threshold or Configuration.BPM_DEAD
+
+		box = Masker.ILLUMINATION_BOX
+		ny, nx = flat_data.shape
+		my, mx = -(-ny // box), -(-nx // box)
+
+		boxes = np.full((my * box, mx * box), np.nan)
+		boxes[:ny, :nx] = flat_data
+		boxes = boxes.reshape(my, box, mx, box).transpose(0, 2, 1, 3).reshape(my, mx, box * box)
+
+		# --- The mesh is extended by linear extrapolation, so the illumination keeps falling towards vignetted corners
+		mesh = np.pad(np.nanmedian(boxes, axis=2), 1, mode='reflect', reflect_type='odd')
+		illumination = ndimage.zoom(mesh, box, order=1, mode='nearest', grid_mode=True)[box:box+ny, box:box+nx]
+
+		flags = np.zeros(flat_data.shape, dtype=np.uint8)
+		flags[flat_data < threshold * illumination] = Masker.DEAD
+
+		return flags
+
+	@staticmethod
+	def find_hot_pixels(dark_data, spread_data=None, sigma=None):
+		''' This function flags the pixels of a master dark whose level, or whose spread across the dark frames, lies more than sigma robust standard deviations above the median of the frame.
+
+		:parameter dark_data [array] - The pixel values of the master dark
+		:parameter spread_data [array] - The robust standard deviation of every pixel across the dark frames, or None
+		:parameter sigma [float] - The threshold [robust standard deviations]; the default is Configuration.BPM_SIGMA
+
+		:return flags [array] - The HOT and UNSTABLE flags of every pixel
+
+		'''
+
+		sigma = sigma or Configuration.BPM_SIGMA
+
+		flags = np.zeros(dark_data.shape, dtype=np.uint8)
+
+		for data, flag in ((dark_data, Masker.HOT), (spread_data, Masker.UNSTABLE)):
+			if data is None:
+				continue
+
+			# --- A constant frame, such as the spread of a single dark, has no outliers
+			width = mad_std(data)
+			if width > 0:
+				flags[data > np.median(data) + sigma * width] |= flag
+
+		return flags
+
+	@staticmethod
+	def get_mask(camera, binning, shape):
+		''' This function returns the mask of a camera, binning and shape: its edges, the defects of its bad pixel map and the bad pixels measured from its calibration frames. A mask is built once, stored as a packed bitmask in the mask cache and kept in the registry of the process, so every later call returns the same read-only array.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frame
+		:parameter shape [tuple] - The shape of the frame
+
+		:return mask [array] - The read-only mask, True where a pixel is excluded
+
+		'''
+
+		key = (camera, int(binning), tuple(shape))
+
+		if key in Masker.registry:
+			return Masker.registry[key]
+
+		edge, regions, digest = Masker.bad_pixel_map(camera)
+		y, x, flags = Masker.read_bpm(camera, binning, shape)
+
+		if len(y) > 0:
+			digest += '-' + hashlib.sha1(np.stack([y, x]).astype(np.int32).tobytes()).hexdigest()[:12]
+
+		cache_path = Masker.cache_path(camera, binning, shape, digest)
+
+		if (cache_path is not None) and os.path.isfile(cache_path):
+			packed = np.load(cache_path)
+			mask = np.unpackbits(packed, count=shape[0] * shape[1]).astype(bool).reshape(shape)
+
+		else:
+			mask = Masker.build_mask(shape, binning, edge, regions)
+			mask[y, x] = True
+
+			if cache_path is not None:
+				part_path = '{}.{}.part'.format(cache_path, os.getpid())
+				with open(part_path, 'wb') as part_file:
+					np.save(part_file, np.packbits(mask, axis=None))
+				os.replace(part_path, cache_path)
+
+		mask.setflags(write=False)
+		Masker.registry[key] = mask
+
+		return mask
+
+	@staticmethod
+	def mask_boxes(camera, binning, shape):
+		''' This function returns the apertures of the masked regions of a frame, for plotting.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frame
+		:parameter shape [tuple] - The shape of the frame
+
+		:return boxes [dictionary] - The apertures of the defects (mask_boxes) and of the left, top, right and bottom edges
+
+		'''
+
+		edge, regions, digest = Masker.bad_pixel_map(camera)
+		edge = edge // binning
+		ny, nx = shape
+
+		boxes = {}
+		boxes['mask_boxes'] = []
+
+		for x1, x2, y1, y2 in regions:
+			x1, x2, y1, y2 = x1 // binning, min(x2 // binning, nx), y1 // binning, min(y2 // binning, ny)
+
+			if (x2 > x1) and (y2 > y1):
+				boxes['mask_boxes'].append(RectangularAperture(((x1 + x2 - 1) / 2, (y1 + y2 - 1) / 2), x2 - x1, y2 - y1, theta=0.))
+
+		if edge > 0:
+			boxes['eml_box'] = RectangularAperture(((edge - 1) / 2, (ny - 1) / 2), edge, ny, theta=0.)
+			boxes['emt_box'] = RectangularAperture(((nx - 1) / 2, ny - (edge + 1) / 2), nx, edge, theta=0.)
+			boxes['emr_box'] = RectangularAperture((nx - (edge + 1) / 2, (ny - 1) / 2), edge, ny, theta=0.)
+			boxes['emb_box'] = RectangularAperture(((nx - 1) / 2, (edge - 1) / 2), nx, edge, theta=0.)
+
+		return boxes
+
+	@staticmethod
+	def read_bpm(camera, binning, shape):
+		''' This function returns the pixels of the bad pixel map measured for a camera, binning and shape.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frames
+		:parameter shape [tuple] - The shape of the frames
+
+		:return y [array] - The rows of the bad pixels
+		:return x [array] - The columns of the bad pixels
+		:return flags [array] - The flags of the bad pixels
+
+		'''
+
+		bpm_path = Masker.bpm_path(camera, binning, shape)
+
+		if (bpm_path is None) or not os.path.isfile(bpm_path):
+			return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.uint8)
+
+		bpm = Table.read(bpm_path, hdu='BPM')
+
+		return np.asarray(bpm['Y'], dtype=np.intp), np.asarray(bpm['X'], dtype=np.intp), np.asarray(bpm['FLAGS'], dtype=np.uint8)
+
+	@staticmethod
+	def read_bpm_masters(camera, binning, shape):
+		''' This function returns the keys of the calibration masters already merged into the bad pixel map of a camera, binning and shape.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frames
+		:parameter shape [tuple] - The shape of the frames
+
+		:return masters [set] - The CALKEY of every merged master, empty if there is no map
+
+		'''
+
+		bpm_path = Masker.bpm_path(camera, binning, shape)
+
+		if (bpm_path is None) or not os.path.isfile(bpm_path):
+			return set()
+
+		with fits.open(bpm_path) as bpm:
+			if 'MASTERS' not in bpm:
+				return set()
+
+			return set(key.strip() for key in bpm['MASTERS'].data['CALKEY'])
+
+	@staticmethod
+	def read_flags(frame_path, shape):
+		''' This function returns the flags stored in the BPM extension of a calibration master by write_flags.
+
+		:parameter frame_path [string] - The path of the master
+		:parameter shape [tuple] - The shape of the master
+
+		:return flags [array] - The flags of every pixel, or None if the master has no BPM extension
+
+		'''
+
+		with fits.open(frame_path) as frame:
+			if 'BPM' not in frame:
+				return None
+
+			table = frame['BPM'].data
+			flags = np.zeros(shape, dtype=np.uint8)
+			flags[np.asarray(table['Y'], dtype=np.intp), np.asarray(table['X'], dtype=np.intp)] = table['FLAGS']
+
+		return flags
+
+	@staticmethod
+	def update_bpm(camera, binning, flags, kinds, master=None):
+		''' This function merges newly measured flags into the bad pixel map of a camera and binning. The map is the union of the flags of every master merged so far, so the masters of different exposure times, filters and nights add their bad pixels instead of replacing each other, and a master whose key is already recorded leaves the map and the cached masks untouched. A pixel that recovers stays flagged until the map is deleted. The map is stored as a table of the bad pixels, which is far smaller than an image since few pixels are bad.
+
+		:parameter camera [string] - The name of the camera
+		:parameter binning [int] - The binning of the frames
+		:parameter flags [array] - The newly measured flags of every pixel
+		:parameter kinds [int] - The flags that were measured, which are merged into the map
+		:parameter master [string] - The CALKEY of the master the flags were measured from, recorded with the map
+
+		:return bpm_path [string] - The path of the bad pixel map, or None if there is no calibration library
+
+		'''
+
+		shape = flags.shape
+		bpm_path = Masker.bpm_path(camera, binning, shape)
+
+		if bpm_path is None:
+			return None
+
+		masters = Masker.read_bpm_masters(camera, binning, shape)
+
+		if master in masters:
+			return bpm_path
+
+		os.makedirs(os.path.dirname(bpm_path), exist_ok=True)
+
+		bpm_flags = np.zeros(shape, dtype=np.uint8)
+
+		y, x, old_flags = Masker.read_bpm(camera, binning, shape)
+		bpm_flags[y, x] = old_flags
+		bpm_flags |= flags & np.uint8(kinds)
+
+		if master is not None:
+			masters.add(master)
+
+		y, x = np.nonzero(bpm_flags)
+		bpm = Table([y.astype(np.int32), x.astype(np.int32), bpm_flags[y, x]], names=('Y', 'X', 'FLAGS'))
+		bpm.meta['CAMERA'] = camera
+		bpm.meta['XBINNING'] = binning
+		bpm.meta['IMAGEW'] = shape[1]
+		bpm.meta['IMAGEH'] = shape[0]
+
+		bpm_hdu = fits.table_to_hdu(bpm)
+		bpm_hdu.name = 'BPM'
+		masters_hdu = fits.BinTableHDU(Table([sorted(masters)], names=('CALKEY',), dtype=(str,)), name='MASTERS')
+
+		part_path = '{}.{}.part'.format(bpm_path, os.getpid())
+		fits.HDUList([fits.PrimaryHDU(), bpm_hdu, masters_hdu]).writeto(part_path, overwrite=True)
+		os.replace(part_path, bpm_path)
+
+		print('Bad pixel map of', camera, 'has', np.count_nonzero(bpm_flags & Masker.HOT), 'hot,', np.count_nonzero(bpm_flags & Masker.DEAD), 'dead and', np.count_nonzero(bpm_flags & Masker.UNSTABLE), 'unstable pixels from', len(masters), 'masters')
+
+		# --- Masks built from the previous map are stale
+		Masker.registry.pop((camera, int(binning), tuple(shape)), None)
+
+		return bpm_path
+
+	@staticmethod
+	def write_flags(frame_path, flags):
+		''' This function appends the bad pixels measured from a calibration master to it as a BPM table extension, so a master reused from the cache can still update the bad pixel map.
+
+		:parameter frame_path [string] - The path of the master
+		:parameter flags [array] - The flags of every pixel
+
+		'''
+
+		y, x = np.nonzero(flags)
+		table = fits.BinTableHDU(Table([y.astype(np.int32), x.astype(np.int32), flags[y, x]], names=('Y', 'X', 'FLAGS')), name='BPM')
+
+		with fits.open(frame_path, mode='append') as frame:
+			frame.append(table)
@@ -1,6 +1,7 @@
 from config import Configuration
 from libraries.calculator import Calculator
 from libraries.plotter import Plotter
+from libraries.reader import Reader
 from libraries.reducer import Reducer
 
 from astropy.coordinates import EarthLocation, SkyCoord
@@ -11,45 +12,68 @@ from astropy.time import Time
 from astropy.wcs import WCS
 from astropy.wcs.utils import skycoord_to_pixel
 from photutils.aperture import aperture_photometry, CircularAnnulus, CircularAperture
+from photutils.detection import DAOStarFinder
+from scipy.spatial import cKDTree
 import math
+import numpy as np
 
 
 class Photometer:
 
 	@staticmethod
 	def extract_pix_sources(object_frame):
+		''' This function extracts the sources of a frame in pixel coordinates.
 
-		object_name = object_frame[:-4]
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		:parameter object_frame [string] - The path of the frame
 
-		mask, boxes = Reducer.make_mask(object_frame)
+		:return table [Table] - The sources found by DAOStarFinder
 
-		print('Extracting sources (xp, yp) for', object_frame)
-		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=Configuration.SIGMA_BKG)
+		'''
 
-		fwhm = 6.0
-		threshold = Configuration.SIGMA_SRC * std
+		frame_data, frame_header = Reader.load_frame(object_frame)
 
-		daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold)
-		table = daofind(frame_data, mask=mask)
+		print('Extracting sources (xp, yp) for', object_frame)
+		table = Photometer.extract_sources(frame_data, frame_header)
 
 		return table
 
 	@staticmethod
 	def extract_sky_sources(object_frame):
+		''' This function extracts the sources of a solved frame and adds their sky coordinates, converted from the centroids with a single call to the WCS.
 
-		object_name = object_frame[:-4]
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		:parameter object_frame [string] - The path of the frame
 
-		wcs = WCS(frame_header)
+		:return table [Table] - The sources found by DAOStarFinder, with ra and dec columns [deg]
 
-		mask, boxes = Reducer.make_mask(object_frame)
+		'''
+
+		frame_data, frame_header = Reader.load_frame(object_frame)
+
+		wcs = WCS(frame_header)
 
 		print('Extracting sources (\u03B1, \u03B4) for', object_frame)
+		table = Photometer.extract_sources(frame_data, frame_header)
+
+		ra, dec = wcs.all_pix2world(np.asarray(table['xcentroid'], dtype=float), np.asarray(table['ycentroid'], dtype=float), 0)
+
+		table['ra'] = ra
+		table['dec'] = dec
+
+		return table
+
+	@staticmethod
+	def extract_sources(frame_data, frame_header):
+		''' This function finds the sources of a frame with DAOStarFinder, outside the masked regions of its camera and above a threshold set by the clipped background noise.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter frame_header [Header] - The header of the frame
+
+		:return table [Table] - The sources found, which is empty if there are none
+
+		'''
+
+		mask, boxes = Reducer.make_mask(frame_header)
+
 		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=Configuration.SIGMA_BKG)
 
 		fwhm = 6.0
@@ -58,99 +82,150 @@ class Photometer:
 		daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold)
 		table = daofind(frame_data, mask=mask)
 
-		pix_coord_list = []
-		ra_list = []
-		dec_list = []
+		if table is None:
+			table = Table(names=('id', 'xcentroid', 'ycentroid', 'flux', 'mag'), dtype=(int, float, float, float, float))
 
-		for item in table:
-			xp = item['xcentroid']
-			yp = item['ycentroid']
+		print('Found', len(table), 'sources')
 
-			sky_positions = pixel_to_skycoord(xp, yp, wcs=wcs)
+		return table
 
-			ra = sky_positions.ra.deg
-			dec = sky_positions.dec.deg
+	@staticmethod
+	def match_catalogs(source_table, query_table, radius=None):
+		''' This function cross-matches the extracted sources with a catalog query one to one. Both tables are turned into unit vectors and put in KD-trees, and a catalog row is kept only if the nearest source within the radius has that row as its own nearest neighbour. The matched rows are selected with a single boolean mask.
 
-			ra_list.append(ra)
-			dec_list.append(dec)
+		:parameter source_table [Table] - The extracted sources, with ra and dec columns [deg]
+		:parameter query_table [Table] - The catalog query, with ra and dec (gaia) or raMean and decMean (ps1) columns [deg]
+		:parameter radius [float] - The matching radius [arcsec]; the default is Configuration.MATCH_RADIUS
 
-		table['ra'] = ra_list
-		table['dec'] = dec_list
+		:return match_table [Table] - The matched catalog rows, with the index of their source (idx) and their separation from it (sep) [arcsec]
 
-		return table
+		'''
 
-	@staticmethod
-	def match_catalogs(source_table, query_table):
+		radius = radius or Configuration.MATCH_RADIUS
 
 		print('Matching catalogs')
-		coo_source = SkyCoord(source_table['ra']*u.deg, source_table['dec']*u.deg)
 
 		if (Configuration.CATALOG == 'gaia-cone') or (Configuration.CATALOG == 'gaia-square'):
-			coo_query = SkyCoord(query_table['ra'], query_table['dec'])
+			query_ra, query_dec = query_table['ra'], query_table['dec']
 
 		elif (Configuration.CATALOG == 'ps1'):
-			coo_query = SkyCoord(query_table['raMean']*u.deg, query_table['decMean']*u.deg)
+			query_ra, query_dec = query_table['raMean'], query_table['decMean']
+
+		else:
+			raise ValueError('Unknown catalog {} (must be one of gaia-cone, gaia-square, ps1)'.format(Configuration.CATALOG))
 
-		idx, d2d, d3d = coo_query.match_to_catalog_sky(coo_source)
+		source_vectors = Photometer.unit_vectors(source_table['ra'], source_table['dec'])
+		query_vectors = Photometer.unit_vectors(query_ra, query_dec)
 
-		t = d2d < 1*u.arcsec
+		matched = np.zeros(len(query_table), dtype=bool)
+		idx = np.zeros(len(query_table), dtype=int)
+		chord = np.full(len(query_table), np.inf)
 
-		query_table['sep_flag'] = t
-		query_table['idx'] = idx
+		if (len(source_table) > 0) and (len(query_table) > 0):
+			max_chord = 2 * np.sin(np.radians(radius / 3600) / 2)
 
-		ct = query_table.dtype
-		names, dtypes = zip(*ct.descr)
-		match_table = Table(names=names, dtype=dtypes)
+			chord, idx = cKDTree(source_vectors).query(query_vectors, distance_upper_bound=max_chord)
+			_, back_idx = cKDTree(query_vectors).query(source_vectors, distance_upper_bound=max_chord)
 
-		for row, sep_flag in enumerate(query_table['sep_flag']):
-			if sep_flag:
-				match_table.add_row(query_table[row].as_void())
+			# --- Keep the pairs that are each other's nearest neighbour
+			matched = np.isfinite(chord)
+			matched[matched] = back_idx[idx[matched]] == np.flatnonzero(matched)
+
+		match_table = query_table[matched]
+		match_table['idx'] = idx[matched]
+		match_table['sep'] = np.degrees(2 * np.arcsin(chord[matched] / 2)) * 3600
+		match_table['sep_flag'] = np.ones(len(match_table), dtype=bool)
+
+		print('Matched', len(match_table), 'of', len(query_table), 'catalog sources within', radius, 'arcsec')
 
 		return match_table
 
+	@staticmethod
+	def photometry_columns(master_table, median, std, aperture_area, annulus_area, exptime, survey='gaia'):
+		''' This function computes the fluxes, magnitudes, colours and delta magnitudes of a photometry table as whole columns. Residual sums at or below the background (median + std) are replaced by it and flagged, and stars without observations in either colour band, or with masked catalog values, get a flagged colour and catalog magnitude of zero.
+
+		:parameter master_table [Table] - The matched catalog rows with their aperture photometry, updated in place
+		:parameter median [float] - The median of the background
+		:parameter std [float] - The standard deviation of the background
+		:parameter aperture_area [float] - The area of the aperture [pix]
+		:parameter annulus_area [float] - The area of the annulus [pix]
+		:parameter exptime [float] - The exposure time [s]
+		:parameter survey [string] - The catalog of the table (gaia or ps1)
+
+		:return master_table [Table] - The table with the flux, flux_error, flux_flag, inst_mag, inst_mag_error, color, color_flag and delta_mag columns
+
+		'''
+
+		if survey == 'gaia':
+			n_obs = ('phot_bp_n_obs', 'phot_rp_n_obs')
+			blue, red, cat = 'phot_bp_mean_mag', 'phot_rp_mean_mag', 'phot_g_mean_mag'
+
+		else:
+			n_obs = ('nr', 'ni')
+			blue, red, cat = 'rMeanPSFMag', 'iMeanPSFMag', 'rMeanPSFMag'
+
+		# --- Filter flux values below the background (and zero)
+		bkg_val = median + std
+		res_sum = np.ma.filled(np.ma.asarray(master_table['res_aperture_sum'], dtype=float), np.nan)
+
+		flux_flag = ~(res_sum > bkg_val)
+		flux = np.where(flux_flag, bkg_val, res_sum)
+
+		# --- Calculate flux error (Poisson + RMS) and instrumental magnitude (exposure time correction)
+		flux_error = np.sqrt(flux + (aperture_area * (1 + (np.pi * aperture_area) / (2 * annulus_area)) * (std**2)))
+		inst_mag = (-2.5 * np.log10(flux)) + (2.5 * np.log10(exptime))
+		inst_mag_error = (2.5 * flux_error) / (np.log(10) * flux)
+
+		# --- Missing observation counts are treated as no observations
+		color_flag = np.zeros(len(master_table), dtype=bool)
+		for column in n_obs:
+			color_flag |= np.ma.filled(np.ma.asarray(master_table[column]), 0) == 0
+
+		blue_mag = np.ma.filled(np.ma.asarray(master_table[blue], dtype=float), np.nan)
+		red_mag = np.ma.filled(np.ma.asarray(master_table[red], dtype=float), np.nan)
+		cat_mag = np.ma.filled(np.ma.asarray(master_table[cat], dtype=float), np.nan)
+
+		color = blue_mag - red_mag
+		color_flag |= ~np.isfinite(color) | ~np.isfinite(cat_mag)
+
+		color = np.where(color_flag, 0., color)
+		cat_mag = np.where(color_flag, 0., cat_mag)
+
+		master_table['flux'] = flux
+		master_table['flux_error'] = flux_error
+		master_table['flux_flag'] = flux_flag
+		master_table['inst_mag'] = inst_mag
+		master_table['inst_mag_error'] = inst_mag_error
+		master_table['color'] = color
+		master_table['color_flag'] = color_flag
+		master_table['delta_mag'] = cat_mag - inst_mag
+
+		return master_table
+
 	@staticmethod
 	def photometry_field(object_frame, match_table, survey='gaia'):
 
 		print('Performing photometery on', object_frame)
 		object_name = object_frame[:-4]
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		frame_data, frame_header = Reader.load_frame(object_frame)
 		
 		exptime = frame_header['EXPTIME']
 		wcs = WCS(frame_header)
 
 		# --- Create frame mask
-		mask, boxes = Reducer.make_mask(object_frame)
+		mask, boxes = Reducer.make_mask(frame_header)
 
 		# --- Calculate background statistics
 		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=Configuration.SIGMA_BKG)
-		print(mean, median, std)
-
-		# --- Grab sky coordinates from catalog
-		sky_coord_list = []
-		for item in match_table:
+		print('Background mean, median, std:', mean, median, std)
 
-			ra = item['ra']
-			dec = item['dec']
-
-			coord_tuple = (ra, dec)
-			sky_coord_list.append(coord_tuple)
-
-		# --- Convert sky coordinates to pixel coordinates
-		sky_positions = SkyCoord(sky_coord_list, unit='deg')
-		pix_positions = skycoord_to_pixel(sky_positions, wcs=wcs)
-
-		pix_coord_list = []
-		for px in range(len(pix_positions[0])):
-			xp = pix_positions[0][px]
-			yp = pix_positions[1][px]
-			coord_tuple = (xp, yp)
-			pix_coord_list.append(coord_tuple)
+		# --- Convert catalog sky coordinates to pixel coordinates
+		xp, yp = wcs.all_world2pix(np.asarray(match_table['ra'], dtype=float), np.asarray(match_table['dec'], dtype=float), 0)
+		pix_positions = np.column_stack([xp, yp])
 
 		# --- Create apertures and annuli
-		apertures = CircularAperture(pix_coord_list, r=Configuration.RAD_AP)
-		annuli = CircularAnnulus(pix_coord_list, r_in=Configuration.RAD_AN_IN, r_out=Configuration.RAD_AN_OUT)
+		apertures = CircularAperture(pix_positions, r=Configuration.RAD_AP)
+		annuli = CircularAnnulus(pix_positions, r_in=Configuration.RAD_AN_IN, r_out=Configuration.RAD_AN_OUT)
 		apers = [apertures, annuli]
 
 		# --- Conduct aperture photometry at all catalog positions
@@ -171,117 +246,16 @@ class Photometer:
 		# --- Merge catalog and photometry tables into master table
 		master_table = hstack([match_table, phot_table])
 
-		# --- Calculate fluxes and magnitudes
-		flux_list = []
-		flux_error_list = []
-		flux_flag_list = []
-
-		inst_mag_list = []
-		inst_mag_error_list = []
-
-		bkg_val = median + std
-
-		for item in master_table:
-
-			# --- Filter flux values below mean (and zero)
-			if item['res_aperture_sum'] <= bkg_val:
-				flux_flag_list.append(True)
-				flux = bkg_val
-
-			else:
-				flux_flag_list.append(False)
-				flux = item['res_aperture_sum']
-
-			print(flux)
-
-			flux_list.append(flux)
-
-			# --- Calculate flux error (Poisson + RMS)
-			flux_error = math.sqrt(flux + (aperture_area * (1 + (math.pi * aperture_area) / (2 * annulus_area))*(std**2)))
-			flux_error_list.append(flux_error)
-
-			# --- Calculate instrumental magnitude (exposure time correction)
-			inst_mag = (-2.5*math.log10(flux)) + (2.5*math.log10(exptime))
-			inst_mag_list.append(inst_mag)
-
-			# --- Calculate instrumental magnitude error
-			inst_mag_error = (2.5 * flux_error) / (math.log(10) * flux)
-			inst_mag_error_list.append(inst_mag_error)
-
-		master_table['flux'] = flux_list
-		master_table['flux_error'] = flux_error_list
-		master_table['flux_flag'] = flux_flag_list
-		master_table['inst_mag'] = inst_mag_list
-		master_table['inst_mag_error'] = inst_mag_error_list
-
-		# --- Calculate colors and delta magnitudes
-		color_list = []
-		color_flag_list = []
-		delta_mag_list = []
-
-		for item in master_table:
+		# --- Calculate fluxes, magnitudes, colors and delta magnitudes
+		master_table = Photometer.photometry_columns(master_table, median, std, aperture_area, annulus_area, exptime, survey)
 
-			if survey == "gaia":
-
-				if item["phot_bp_n_obs"] == 0 or item["phot_rp_n_obs"] == 0:
-					
-					color_flag_list.append(True)
-					color = 0
-					cat_mag = 0
-
-				else:
-					
-					color_flag_list.append(False)
-					b = item["phot_bp_mean_mag"]
-					#b = b.unmasked.value
-					r = item["phot_rp_mean_mag"]
-					#r = r.unmasked.value
-
-					color = b - r
-					cat_mag = item['phot_g_mean_mag']
-
-			else:
-
-				if item["nr"] == 0 or item["ni"] == 0:
-
-					color_flag_list.append(True)
-					color = 0
-					cat_mag = 0
-
-				else:
-
-					color_flag_list.append(False)
-					r = item["rMeanPSFMag"]
-					i = item["iMeanPSFMag"]
-
-					color = r - i
-					cat_mag = item["rMeanPSFMag"]
-
-			color_list.append(color)
-
-			inst_mag = item["inst_mag"]
-			delta_mag = cat_mag - inst_mag
-			delta_mag_list.append(delta_mag)
-
-		master_table["color"] = color_list
-		master_table["color_flag"] = color_flag_list
-		master_table["delta_mag"] = delta_mag_list
+		print(np.count_nonzero(master_table['flux_flag']), 'of', len(master_table), 'fluxes at or below the background')
+		print(np.count_nonzero(master_table['color_flag']), 'of', len(master_table), 'colors without observations')
 
 		# --- Calculate transform and zero point
-		color_list = []
-		delta_mag_list = []
-
-		for item in master_table:
-
-			if (item["flux_flag"] == True) or (item["color_flag"] == True):
-				pass
-
-			else:
-				color = item["color"]
-				color_list.append(color)
-
-				delta_mag = item["delta_mag"]
-				delta_mag_list.append(delta_mag)
+		good = ~(master_table['flux_flag'] | master_table['color_flag'])
+		color_list = np.asarray(master_table['color'][good])
+		delta_mag_list = np.asarray(master_table['delta_mag'][good])
 
 		yfit, slope, intercept, delta_slope, delta_intercept = Calculator.unweighted_fit(color_list, delta_mag_list)
 
@@ -296,14 +270,12 @@ class Photometer:
 	def photometry_pix_point(object_frame, xp, yp):
 
 		object_name = object_frame[:-4]
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		frame_data, frame_header = Reader.load_frame(object_frame)
 		wcs = WCS(frame_header)
 
 		sigma = 3.0
 
-		mask, boxes = reducer.make_mask(object_frame)
+		mask, boxes = Reducer.make_mask(frame_header)
 		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=sigma)
 
 		exptime = frame_header["EXPTIME"]
@@ -375,14 +347,12 @@ class Photometer:
 	def photometry_sky_point(object_frame, ra, dec):
 
 		object_name = object_frame[:-4]
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		frame_data, frame_header = Reader.load_frame(object_frame)
 		wcs = WCS(frame_header)
 
 		sigma = 3.0
 
-		mask, boxes = Reducer.make_mask(object_frame)
+		mask, boxes = Reducer.make_mask(frame_header)
 		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=sigma)
 		
 		exptime = frame_header["EXPTIME"]
@@ -478,4 +448,20 @@ class Photometer:
 		yfit, slope, intercept, delta_slope, delta_intercept = unweighted_fit(airmass_list, inst_mag_list)
 		Plotter.plot_extinction(item, airmass_list, inst_mag_list, yfit)
 
-		return slope, intercept, delta_slope, delta_intercept
\ No newline at end of file
+		return slope, intercept, delta_slope, delta_intercept
+
+	@staticmethod
+	def unit_vectors(ra, dec):
+		''' This function converts sky coordinates to unit vectors, on which Euclidean distances are chords of the celestial sphere.
+
+		:parameter ra [array] - The right ascensions [deg]
+		:parameter dec [array] - The declinations [deg]
+
+		:return vectors [array] - The unit vectors, with shape (n, 3)
+
+		'''
+
+		ra = np.radians(np.asarray(ra, dtype=float))
+		dec = np.radians(np.asarray(dec, dtype=float))
+
+		return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
@@ -78,17 +78,12 @@ class Plotter:
 
 		apertures.plot(color="lime", lw=0.5, alpha=0.5)
 
-		mask_box = boxes["mask_box"]
-		eml_box = boxes["eml_box"]
-		emt_box = boxes["emt_box"]
-		emr_box = boxes["emr_box"]
-		emb_box = boxes["emb_box"]
-
-		mask_box.plot(color="red", ls="dashed")
-		eml_box.plot(color="cyan", ls="dashed")
-		emt_box.plot(color="lime", ls="dashed")
-		emr_box.plot(color="yellow", ls="dashed")
-		emb_box.plot(color="orange", ls="dashed")
+		for mask_box in boxes["mask_boxes"]:
+			mask_box.plot(color="red", ls="dashed")
+
+		for name, color in (("eml_box", "cyan"), ("emt_box", "lime"), ("emr_box", "yellow"), ("emb_box", "orange")):
+			if name in boxes:
+				boxes[name].plot(color=color, ls="dashed")
 
 		if save:
 			plt.savefig(name + "-field.png", dpi=400)
@@ -2,13 +2,32 @@ from astropy.io import fits
 from astropy.stats import sigma_clipped_stats
 from astropy.time import Time
 from astropy.wcs import WCS
+from contextlib import contextmanager
 from tabulate import tabulate
+import glob
+import os
+import sqlite3
 
 #import warnings
 #warnings.filterwarnings("ignore")
 
 class Reader:
 
+	# --- Paths of the frames opened through open_frame that are still open, keyed by handle id
+	open_handles = {}
+
+	# --- Header index sidecar and the header keywords it stores, as (keyword, column, type)
+	INDEX_NAME = "header-index.db"
+	INDEX_COLUMNS = [("IMAGETYP", "imagetyp", "TEXT"),
+					("FILTER", "filter", "TEXT"),
+					("EXPTIME", "exptime", "REAL"),
+					("XBINNING", "xbinning", "INTEGER"),
+					("DATE-OBS", "dateobs", "TEXT"),
+					("CCD-TEMP", "ccd_temp", "REAL"),
+					("NAXIS1", "naxis1", "INTEGER"),
+					("NAXIS2", "naxis2", "INTEGER")]
+	INDEX_QUERY_COLUMNS = ["imagetyp", "filter", "exptime", "xbinning", "dateobs"]
+
 	@staticmethod
 	def config_camera(name="PL16803"):
 
@@ -36,42 +55,193 @@ class Reader:
 
 		return params
 
+	@staticmethod
+	def connect_index(path):
+		""" This function opens the header index of a directory, creating it if it does not exist.
+
+		:parameter path [string] - The directory of the frames
+
+		:return connection [Connection] - The connection to the index
+
+		"""
+
+		connection = sqlite3.connect(os.path.join(path, Reader.INDEX_NAME))
+		connection.row_factory = sqlite3.Row
+
+		columns = ", ".join("{} {}".format(column, kind) for key, column, kind in Reader.INDEX_COLUMNS)
+		connection.execute("CREATE TABLE IF NOT EXISTS frames (name TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, {})".format(columns))
+
+		for column in Reader.INDEX_QUERY_COLUMNS:
+			connection.execute("CREATE INDEX IF NOT EXISTS frames_{0} ON frames ({0})".format(column))
+
+		return connection
+
+	@staticmethod
+	def index_directory(path, pattern="*.fit"):
+		""" This function brings the header index of a directory up to date. Only frames that are new, or whose modification time or size changed, have their headers read; frames that no longer exist are dropped.
+
+		:parameter path [string] - The directory of the frames
+		:parameter pattern [string] - The glob pattern of the frames
+
+		:return updated [int] - The number of frames whose headers were read
+
+		"""
+
+		connection = Reader.connect_index(path)
+
+		try:
+			indexed = {}
+			for row in connection.execute("SELECT name, mtime, size FROM frames"):
+				indexed[row["name"]] = (row["mtime"], row["size"])
+
+			present = set()
+			records = []
+
+			for item in glob.glob(os.path.join(glob.escape(str(path)), pattern)):
+				name = os.path.basename(item)
+				stat = os.stat(item)
+				present.add(name)
+
+				if indexed.get(name) == (stat.st_mtime_ns, stat.st_size):
+					continue
+
+				header = Reader.read_header(item)
+
+				record = [name, stat.st_mtime_ns, stat.st_size]
+				for key, column, kind in Reader.INDEX_COLUMNS:
+					record.append(header.get(key))
+
+				records.append(record)
+
+			placeholders = ", ".join(["?"] * (3 + len(Reader.INDEX_COLUMNS)))
+
+			with connection:
+				connection.executemany("INSERT OR REPLACE INTO frames VALUES ({})".format(placeholders), records)
+				connection.executemany("DELETE FROM frames WHERE name = ?", [(name,) for name in indexed if name not in present])
+
+		finally:
+			connection.close()
+
+		return len(records)
+
+	@staticmethod
+	def load_frame(frame_path, memmap=True):
+		""" This function returns the data and header of the primary HDU of a frame and closes the file handle. With memmap the data stay mapped from disk until the array is released.
+
+		:parameter frame_path [string] - The path of the frame
+		:parameter memmap [bool] - Whether to memory-map the data
+
+		:return data [array] - The pixel values of the frame
+		:return header [Header] - The header of the frame
+
+		"""
+
+		with Reader.open_frame(frame_path, memmap=memmap) as frame:
+			data = frame[0].data
+			header = frame[0].header
+
+		return data, header
+
+	@staticmethod
+	@contextmanager
+	def open_frame(frame_path, memmap=True):
+		""" This function opens a frame as a context manager, so the file handle is closed when the block exits, and tracks the handle while it is open.
+
+		:parameter frame_path [string] - The path of the frame
+		:parameter memmap [bool] - Whether to memory-map the data
+
+		:return frame [HDUList] - The opened frame
+
+		"""
+
+		frame = fits.open(frame_path, memmap=memmap)
+		Reader.open_handles[id(frame)] = str(frame_path)
+
+		try:
+			yield frame
+
+		finally:
+			frame.close()
+			del Reader.open_handles[id(frame)]
+
+	@staticmethod
+	def query_directory(path, imagetyp=None, filter=None, exptime=None, xbinning=None, date_start=None, date_end=None, update=True):
+		""" This function returns the frames of a directory whose headers match the given values, using the header index.
+
+		:parameter path [string] - The directory of the frames
+		:parameter imagetyp [string] - The IMAGETYP of the frames
+		:parameter filter [string] - The FILTER of the frames
+		:parameter exptime [float] - The EXPTIME of the frames [s]
+		:parameter xbinning [int] - The XBINNING of the frames
+		:parameter date_start [string] - The earliest DATE-OBS (ISO-8601) of the frames
+		:parameter date_end [string] - The latest DATE-OBS (ISO-8601) of the frames
+		:parameter update [bool] - Whether to bring the index up to date before the query
+
+		:return rows [list] - The matching frames as dictionaries of indexed values plus the name and path, sorted by name
+
+		"""
+
+		if update:
+			Reader.index_directory(path)
+
+		conditions = []
+		values = []
+
+		for column, value in (("imagetyp", imagetyp), ("filter", filter), ("exptime", exptime), ("xbinning", xbinning)):
+			if value is not None:
+				conditions.append("{} = ?".format(column))
+				values.append(value)
+
+		if date_start is not None:
+			conditions.append("dateobs >= ?")
+			values.append(date_start)
+
+		if date_end is not None:
+			conditions.append("dateobs <= ?")
+			values.append(date_end)
+
+		statement = "SELECT * FROM frames"
+		if len(conditions) > 0:
+			statement += " WHERE " + " AND ".join(conditions)
+		statement += " ORDER BY name"
+
+		connection = Reader.connect_index(path)
+
+		try:
+			rows = [dict(row) for row in connection.execute(statement, values)]
+
+		finally:
+			connection.close()
+
+		for row in rows:
+			row["path"] = os.path.join(path, row["name"])
+
+		return rows
+
 	@staticmethod
 	def read_directory(path, verbose=True):
 
 		os.chdir(path)
-		frame_list = []
 
-		for item in glob.glob("*.fit"):
-			frame_list.append(item)
-		frame_list = sorted(frame_list)
+		rows = Reader.query_directory(path)
 
+		frame_list = [row["name"] for row in rows]
 		data_table = []
 
-		for item in frame_list:
-			param_list = []
-
-			frame = fits.open(item)
-			frame_header = frame[0].header
+		obstimes = Time([row["dateobs"] for row in rows], format="isot")
 
-			binning = frame_header["XBINNING"]
-			binning = str(binning) + "x" + str(binning)
-
-			exptime = frame_header["EXPTIME"]
-			exptime = str(exptime)
+		for row, obstime in zip(rows, obstimes):
+			param_list = []
 
-			dateobs = frame_header["DATE-OBS"]
-			obstime = Time(dateobs, format="isot")
+			binning = str(row["xbinning"]) + "x" + str(row["xbinning"])
+			exptime = str(row["exptime"])
 
-			try:
-				filtertype = frame_header["FILTER"]
-			except KeyError:
+			filtertype = row["filter"]
+			if filtertype is None:
 				filtertype = "n/a"
 
-			imagetype = frame_header["IMAGETYP"]
-
-			param_list.append(item)
-			param_list.append(imagetype)
+			param_list.append(row["name"])
+			param_list.append(row["imagetyp"])
 			param_list.append(obstime)
 			param_list.append(exptime)
 			param_list.append(filtertype)
@@ -79,11 +249,11 @@ class Reader:
 
 			data_table.append(param_list)
 
-			if verbose == True:
-				tabulated = tabulate(data_table, headers=["Item", "Type", "Time", "Exposure", "Filter", "Binning"], tablefmt="github")
-				print()
-				print(tabulated)
-			
+		if verbose == True:
+			tabulated = tabulate(data_table, headers=["Item", "Type", "Time", "Exposure", "Filter", "Binning"], tablefmt="github")
+			print()
+			print(tabulated)
+
 		return frame_list, data_table
 
 	@staticmethod
@@ -94,9 +264,7 @@ class Reader:
 
 		params = {}
 
-		frame = fits.open(fits_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+		frame_data, frame_header = Reader.load_frame(fits_frame)
 
 		wcs = WCS(frame_header)
 
@@ -124,4 +292,36 @@ class Reader:
 		params["median"] = median
 		params["std"] = std
 
-		return params
\ No newline at end of file
+		return params
+
+	@staticmethod
+	def read_header(frame_path):
+		""" This function reads the primary header of a frame without opening it as an HDU list. Only the header blocks are read from disk.
+
+		:parameter frame_path [string] - The path of the frame
+
+		:return header [Header] - The primary header of the frame
+
+		"""
+
+		block_size = 2880
+		card_size = 80
+
+		blocks = []
+
+		with open(frame_path, "rb") as frame:
+
+			while True:
+				block = frame.read(block_size)
+
+				if len(block) < block_size:
+					raise OSError("No END card found in header of {}".format(frame_path))
+
+				blocks.append(block)
+
+				if any(block[i:i+8] == b"END     " for i in range(0, block_size, card_size)):
+					break
+
+		header = fits.Header.fromstring(b"".join(blocks).decode("ascii"))
+
+		return header
@@ -1,230 +1,532 @@
 from config import Configuration
+from libraries.aligner import Aligner
+from libraries.background import Background
+from libraries.calibrator import Calibrator
+from libraries.combiner import Combiner
+from libraries.drizzler import Drizzler
+from libraries.masker import Masker
+from libraries.reader import Reader
+from libraries.solver import Solver
+from libraries.stacker import Stacker
 
-from astropy import units as u
 from astropy.io import fits
-from astropy.stats import SigmaClip, sigma_clipped_stats
+from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
 from astropy.wcs.utils import pixel_to_skycoord
-from photutils.aperture import RectangularAperture
-from photutils.background import Background2D, MedianBackground
+from concurrent.futures import ProcessPoolExecutor
 from photutils.detection import DAOStarFinder
-from photutils.segmentation import detect_threshold, detect_sources
-from photutils.utils import circular_footprint
-from reproject import reproject_interp
 import ccdproc
 import glob
+import hashlib
 import numpy as np
 import os
 import shutil
-import subprocess
 
 class Reducer:
 
 	@staticmethod
-	def align_frames(obj_dir):
+	def align_frames(obj_dir, method=None, workers=None, reference=None, fields=None):
 
 		wcs_dir = os.path.join(obj_dir, 'wcs')
 		align_dir = os.path.join(obj_dir, 'align')
 
+		if workers is None:
+			workers = Configuration.WORKERS
+
 		os.chdir(wcs_dir)
 		obj_list = []
 		for item in glob.glob('*.fit'):
 			obj_list.append(item)
 		obj_list = sorted(obj_list)
 
-		reference_frame = fits.open(obj_list[0])
-		reference_data = reference_frame[0].data
-		reference_header = reference_frame[0].header
+		reference_name, reference_header = Reducer.read_reference(align_dir, wcs_dir, obj_list, reference, fields)
+
+		# --- A survey field is not one of the frames, so every frame is aligned to it
+		if (reference_name in obj_list) and not os.path.isfile(os.path.join(align_dir, 'a-' + reference_name)):
+			print('Saving reference frame', reference_name)
+			reference_data, frame_header = Reader.load_frame(reference_name)
+			reference_hdu = fits.PrimaryHDU(reference_data.astype(Configuration.DTYPE), header=reference_header)
+			reference_hdu.writeto(os.path.join(align_dir, 'a-' + reference_name), overwrite=True)
 
-		align_path = os.path.join(align_dir, 'a-' + obj_list[0])
+		target_paths = []
+		align_paths = []
 
-		if not os.path.isfile(align_path):
-			print('Saving reference frame', obj_list[0])
-			reference_hdu = fits.PrimaryHDU(reference_data, header=reference_header)
-			reference_hdu.writeto(align_path, overwrite=True)
+		for obj in obj_list:
 
-		for i in range(1, len(obj_list)):
+			if obj == reference_name:
+				continue
 
-			align_path = os.path.join(align_dir, 'a-' + obj_list[i])
+			align_path = os.path.join(align_dir, 'a-' + obj)
 
 			if os.path.isfile(align_path):
-				print('Skipping alignment on frame', obj_list[i])
+				print('Skipping alignment on frame', obj)
 
 			else:
-				print('Aligning frame', obj_list[i], 'with reference frame')
-				target_frame = fits.open(obj_list[i])
-				target_data = target_frame[0].data
-				target_header = target_frame[0].header
+				target_paths.append(os.path.join(wcs_dir, obj))
+				align_paths.append(align_path)
 
-				target_hdu = fits.PrimaryHDU(target_data, header=target_header)
-				array, footprint = reproject_interp(target_hdu, reference_header)
+		if (workers > 1) and (len(target_paths) > 1):
+			align_workers = min(workers, len(target_paths))
+			print('Aligning', len(target_paths), 'frames with', align_workers, 'workers')
 
-				aligned_hdu = fits.PrimaryHDU(array, header=reference_header)
-				aligned_hdu.writeto(align_path)
+			with ProcessPoolExecutor(max_workers=align_workers) as executor:
+				reference_headers = [reference_header] * len(target_paths)
+				methods = [method] * len(target_paths)
+				list(executor.map(Aligner.align_frame, target_paths, align_paths, reference_headers, methods))
+
+		else:
+			for target_path, align_path in zip(target_paths, align_paths):
+				Aligner.align_frame(target_path, align_path, reference_header, method)
 
 		return obj_list
 
 	@staticmethod
-	def make_dark(dark_dir):
+	def cache_master(master_path, key):
+		''' This function stores a master in the calibration cache under its provenance key. The cache is only used if Configuration.CACHE_DIR exists.
 
-		dark_path = os.path.join(dark_dir, 'master-dark.fit')
+		:parameter master_path [string] - The path of the master
+		:parameter key [string] - The provenance key of the master
 
-		if os.path.isfile(dark_path):
-			print('Reading extant master dark')
-			master_dark = fits.open(dark_path)
+		'''
+
+		if not os.path.isdir(Configuration.CACHE_DIR):
+			return
+
+		cache_path = os.path.join(Configuration.CACHE_DIR, key + '.fit')
+
+		if not os.path.isfile(cache_path):
+			try:
+				os.link(master_path, cache_path)
+			except OSError:
+				shutil.copyfile(master_path, cache_path)
+
+	@staticmethod
+	def calibrate_frame(obj_frame_data, obj_frame_header, bkg_method='flat', calibrator=None, warm_start=None):
+		''' This function calibrates a raw frame held in memory and subtracts its background. The median background level and rms before the subtraction are recorded in the header.
+
+		:parameter obj_frame_data [array] - The pixel values of the raw frame
+		:parameter obj_frame_header [Header] - The header of the raw frame, updated in place
+		:parameter bkg_method [string] - The background subtracted (flat for the median level, 2d for the full background)
+		:parameter calibrator [Calibrator] - The calibrator of the frame; the default is Calibrator.shared
+		:parameter warm_start [bool] - Whether the background of the previous frame reduced by this process seeds this one; the default is Configuration.BKG_WARM_START. Parallel reductions never warm start, so their backgrounds can differ slightly from a serial run with it
+
+		:return reduced_obj_frame_data [array] - The calibrated, background-subtracted pixel values
+		:return obj_frame_header [Header] - The header of the frame
+
+		'''
+
+		if warm_start is None:
+			warm_start = Configuration.BKG_WARM_START
+
+		if calibrator is None:
+			calibrator = Calibrator.shared
+
+		obj_exposure = Calibrator.read_exposure(obj_frame_header)
+		reduced_obj_frame_data = calibrator.calibrate(obj_frame_data, obj_exposure)
+
+		# --- The background of the previous frame seeds the source detection and the clipping of this one
+		previous = Background.previous if warm_start else None
+		bkg, mask = Background.estimate(reduced_obj_frame_data, previous=previous)
+
+		if warm_start:
+			Background.previous = bkg
+
+		print(bkg.background_median, bkg.background_rms_median)
+
+		obj_frame_header['BKGMED'] = (float(bkg.background_median), 'Median background before subtraction [adu]')
+		obj_frame_header['BKGRMS'] = (float(bkg.background_rms_median), 'Median background rms [adu]')
+
+		if bkg_method == '2d':
+			reduced_obj_frame_data -= bkg.background
+
+		elif bkg_method == 'flat':
+			reduced_obj_frame_data -= bkg.background_median
 
 		else:
-			print('Creating master dark')
-			os.chdir(dark_dir)
-			
+			reduced_obj_frame_data -= bkg.background
+
+		return reduced_obj_frame_data, obj_frame_header
+
+	@staticmethod
+	def drizzle_stack(obj_dir, scale=None, pixfrac=None, weighting=None, reference=None, fields=None):
+		''' This function co-adds the solved frames of an object onto a grid finer than the reference grid, dropping every frame straight from its own WCS. It replaces align_frames and make_stack for undersampled frames, without writing the aligned frames.
+
+		:parameter obj_dir [string] - The directory of the object
+		:parameter scale [float] - The size of the output pixels relative to the reference pixels; the default is Configuration.DRIZZLE_SCALE
+		:parameter pixfrac [float] - The linear size of the drop relative to the input pixel; the default is Configuration.DRIZZLE_PIXFRAC
+		:parameter weighting [string] - The weighting of the frames (none, variance or seeing); the default is Configuration.STACK_WEIGHTING
+		:parameter reference [string] - The reference strategy (first, seeing or field); the default is Configuration.ALIGN_REFERENCE
+		:parameter fields [DataFrame] - The survey fields, for the field strategy
+
+		:return stack [CCDData] - The co-added frame
+
+		'''
+
+		scale = scale or Configuration.DRIZZLE_SCALE
+		pixfrac = pixfrac or Configuration.DRIZZLE_PIXFRAC
+		weighting = weighting or Configuration.STACK_WEIGHTING
+
+		wcs_dir = os.path.join(obj_dir, 'wcs')
+		align_dir = os.path.join(obj_dir, 'align')
+		drizzle_path = os.path.join(align_dir, 'drizzle.fit')
+		weight_path = os.path.join(align_dir, 'drizzle-weight.fit')
+
+		obj_list = sorted(os.path.basename(item) for item in glob.glob(os.path.join(wcs_dir, '*.fit')))
+		frame_paths = [os.path.join(wcs_dir, obj) for obj in obj_list]
+
+		stack_key = Reducer.master_key('drizzle', frame_paths, (scale, pixfrac, weighting, Configuration.DTYPE, Configuration.STACK_REJECT))
+
+		if os.path.isfile(weight_path) and Reducer.fetch_master(drizzle_path, stack_key):
+			print('Reading extant drizzled stack')
+
+		else:
+			reference_name, reference_header = Reducer.read_reference(align_dir, wcs_dir, obj_list, reference, fields)
+
+			frame_weights = None
+			if weighting != 'none':
+				frame_weights = Stacker.frame_weights([Stacker.frame_quality(frame_path) for frame_path in frame_paths], weighting)
+
+				for obj, frame_weight in zip(obj_list, frame_weights):
+					if frame_weight == 0:
+						print('Rejected frame', obj)
+
+				frame_paths = [frame_path for frame_path, frame_weight in zip(frame_paths, frame_weights) if frame_weight > 0]
+				frame_weights = frame_weights[frame_weights > 0]
+
+			output_header = Drizzler.output_header(reference_header, scale)
+			output_header['CALKEY'] = stack_key
+
+			Drizzler.drizzle(frame_paths, output_header, drizzle_path, weight_path, pixfrac, frame_weights=frame_weights)
+
+		stack = ccdproc.fits_ccddata_reader(drizzle_path)
+
+		return stack
+
+	@staticmethod
+	def fetch_master(master_path, key):
+		''' This function checks whether a valid master with a given provenance key is available, either at its path or in the calibration cache. A cached master is copied to the path.
+
+		:parameter master_path [string] - The path of the master
+		:parameter key [string] - The provenance key of the master
+
+		:return found [bool] - Whether a valid master is now at master_path
+
+		'''
+
+		if os.path.isfile(master_path) and (Reader.read_header(master_path).get('CALKEY') == key):
+			return True
+
+		cache_path = os.path.join(Configuration.CACHE_DIR, key + '.fit')
+
+		if os.path.isfile(cache_path):
+			print('Restoring cached master', key)
+			if os.path.isfile(master_path):
+				os.remove(master_path)
+
+			try:
+				os.link(cache_path, master_path)
+			except OSError:
+				shutil.copyfile(cache_path, master_path)
+
+			return True
+
+		return False
+
+	@staticmethod
+	def make_dark(dark_dir, dark_list=None, dark_path=None):
+
+		if dark_path is None:
+			dark_path = os.path.join(dark_dir, 'master-dark.fit')
+
+		os.chdir(dark_dir)
+
+		if dark_list is None:
 			dark_list = []
 
 			for item in glob.glob('*.fit'):
-				dark_list.append(item)
+				if os.path.abspath(item) != os.path.abspath(dark_path):
+					dark_list.append(item)
+
+		dark_key = Reducer.master_key('dark', dark_list, (Configuration.COMBINE_METHOD, Configuration.DTYPE, Configuration.SIGMA_BKG))
+
+		if (len(dark_list) == 0 and os.path.isfile(dark_path)) or Reducer.fetch_master(dark_path, dark_key):
+			print('Reading extant master dark')
+			master_dark = ccdproc.fits_ccddata_reader(dark_path)
+
+		else:
+			print('Creating master dark')
+			master_dark, dark_spread = Combiner.combine(dark_list, spread=True)
+			master_dark.header['CALKEY'] = dark_key
 
-			master_dark = ccdproc.combine(dark_list, method=Configuration.COMBINE_METHOD, unit='adu', mem_limit=Configuration.MEM_LIMIT, dtype=Configuration.DTYPE)
+			# --- The master dark and the spread of the darks are already in memory, so the hot and unstable pixels come almost for free; they travel with the master so a cached copy can still update the map
+			hot_flags = Masker.find_hot_pixels(np.asarray(master_dark), dark_spread)
 
 			ccdproc.fits_ccddata_writer(master_dark, dark_path, overwrite=True)
+			Masker.write_flags(dark_path, hot_flags)
+			Reducer.cache_master(dark_path, dark_key)
+
+		# --- Every master in use adds its bad pixels to the map once, whether it was built or reused
+		binning = master_dark.header.get('XBINNING', 1)
+		calkey = master_dark.header.get('CALKEY', dark_key)
+
+		if calkey not in Masker.read_bpm_masters(Configuration.CAMERA, binning, master_dark.shape):
+			hot_flags = Masker.read_flags(dark_path, master_dark.shape)
+			kinds = Masker.HOT | Masker.UNSTABLE
+
+			# --- A master written without its flags has lost the spread of its darks
+			if hot_flags is None:
+				hot_flags = Masker.find_hot_pixels(np.asarray(master_dark))
+				kinds = Masker.HOT
+
+			Masker.update_bpm(Configuration.CAMERA, binning, hot_flags, kinds, calkey)
 
 		return master_dark
 
 	@staticmethod
-	def make_flat(flat_dir, dark_dir):
-
-		flat_path = os.path.join(flat_dir, 'flatfield.fit')
-		dark_path = os.path.join(dark_dir, 'master-dark.fit')
+	def make_flat(flat_dir, dark_dir, flat_list=None, flat_path=None, dark_path=None):
 
-		if os.path.isfile(flat_path):
-			print('Reading extant flatfield')
-			flatfield = fits.open(flat_path)
+		if flat_path is None:
+			flat_path = os.path.join(flat_dir, 'flatfield.fit')
 
-		else:
-			print('Creating flatfield')
-			master_dark = ccdproc.fits_ccddata_reader(dark_path)
-			dark_exposure = master_dark.header['exposure']*u.second
+		if dark_path is None:
+			dark_path = os.path.join(dark_dir, 'master-dark.fit')
 
-			os.chdir(flat_dir)
+		os.chdir(flat_dir)
 
+		if flat_list is None:
 			flat_list = []
+
 			for item in glob.glob('*.fit'):
+				if os.path.abspath(item) != os.path.abspath(flat_path):
+					flat_list.append(item)
 
-				flat = ccdproc.fits_ccddata_reader(item, unit='adu')
-				flat_exposure = flat.header['exposure']*u.second
+		dark_key = Reader.read_header(dark_path).get('CALKEY') if os.path.isfile(dark_path) else None
+		flat_key = Reducer.master_key('flat', flat_list, (Configuration.COMBINE_METHOD, Configuration.DTYPE, Configuration.SIGMA_BKG, dark_key))
 
-				reduced_flat = ccdproc.subtract_dark(flat, master_dark, data_exposure=flat_exposure, dark_exposure=dark_exposure)
-				flat_list.append(reduced_flat)
+		if (len(flat_list) == 0 and os.path.isfile(flat_path)) or Reducer.fetch_master(flat_path, flat_key):
+			print('Reading extant flatfield')
+			flatfield = ccdproc.fits_ccddata_reader(flat_path)
 
-			combined_flat = ccdproc.combine(flat_list, method=Configuration.COMBINE_METHOD, unit='adu', mem_limit=Configuration.MEM_LIMIT, dtype=Configuration.DTYPE)
+		else:
+			print('Creating flatfield')
+			master_dark_data, master_dark_header = Calibrator.load_frame(dark_path)
+			dark_exposure = master_dark_header['exposure']
 
-			combined_flat_data = np.asarray(combined_flat)
-			flatfield_data = combined_flat_data / np.mean(combined_flat_data)
+			flat_exposures = []
+			for item in flat_list:
+				flat_exposures.append(Reader.read_header(item)['exposure'])
 
-			flatfield = ccdproc.CCDData(flatfield_data, unit='adu')
-			ccdproc.fits_ccddata_writer(flatfield, flat_path)
+			def subtract_dark(index, rows, strip):
+				strip -= master_dark_data[rows] * np.asarray(flat_exposures[index] / dark_exposure, dtype=strip.dtype)
 
-		return flatfield
+			combined_flat = Combiner.combine(flat_list, transform=subtract_dark)
 
-	@staticmethod
-	def make_mask(object_frame):
+			combined_flat_data = np.asarray(combined_flat)
+			flatfield_data = combined_flat_data / np.mean(combined_flat_data)
 
-		frame = fits.open(object_frame)
-		frame_data = frame[0].data
-		frame_header = frame[0].header
+			flatfield = ccdproc.CCDData(flatfield_data, unit='adu', meta=combined_flat.header)
+			flatfield.header['CALKEY'] = flat_key
 
-		mask = np.zeros(frame_data.shape, dtype=bool)
+			ccdproc.fits_ccddata_writer(flatfield, flat_path, overwrite=True)
+			Reducer.cache_master(flat_path, flat_key)
 
-		binning = frame_header['XBINNING']
-		edge = 100 // binning
+		# --- Every flatfield in use adds its dead pixels to the map once, whether it was built or reused
+		binning = flatfield.header.get('XBINNING', 1)
+		calkey = flatfield.header.get('CALKEY', flat_key)
 
-		dx = frame_data.shape[0]
-		dy = frame_data.shape[1]
+		if calkey not in Masker.read_bpm_masters(Configuration.CAMERA, binning, flatfield.shape):
+			dead_flags = Masker.find_dead_pixels(np.asarray(flatfield))
+			Masker.update_bpm(Configuration.CAMERA, binning, dead_flags, Masker.DEAD, calkey)
 
-		# --- Bad pixel mask
-		mask_y1 = 860 // binning
-		mask_y2 = 4089 // binning
-		mask_delta_y = mask_y2 - mask_y1
-		center_y = mask_delta_y // 2
+		return flatfield
 
-		mask_x1 = 1200 // binning
-		mask_x2 = 1210 // binning
-		mask_delta_x = mask_x2 - mask_x1
-		center_x = mask_delta_x // 2
+	@staticmethod
+	def make_mask(object_frame, camera=None):
+		''' This function returns the mask of the edges and bad pixels of a frame from the mask registry, which builds the mask of a camera, binning and shape only once.
 
-		mask[mask_y1:mask_y2, mask_x1:mask_x2] = True
+		:parameter object_frame [string or Header] - The path of the frame, or its header
+		:parameter camera [string] - The name of the camera; the default is Configuration.CAMERA
 
-		# --- Left edge mask
-		eml_center_x = edge // 2
-		eml_center_y = dy // 2
-		mask[0:dy, 0:edge] = True
+		:return mask [array] - The read-only mask, True where a pixel is excluded
+		:return boxes [dictionary] - The apertures of the masked regions, for plotting
 
-		# --- Top edge mask
-		emt_center_x = dx // 2
-		emt_center_y = edge // 2
-		mask[dy-edge:dy, 0:dx] = True
+		'''
 
-		# --- Right edge mask
-		emr_center_x = edge // 2
-		emr_center_y = dy // 2
-		mask[0:dy, dx-edge:dx] = True
+		camera = camera or Configuration.CAMERA
 
-		# --- Bottom edge mask
-		emb_center_x = dx // 2
-		emb_center_y = edge // 2
-		mask[0:edge, 0:dx] = True
+		if isinstance(object_frame, fits.Header):
+			frame_header = object_frame
 
-		boxes = {}
+		else:
+			frame_header = Reader.read_header(object_frame)
 
-		mask_box = RectangularAperture((center_x + mask_x1, center_y + mask_y1), mask_delta_x, mask_delta_y, theta=0.)
-		eml_box = RectangularAperture((eml_center_x, eml_center_y), edge, dy, theta=0.)
-		emt_box = RectangularAperture((emt_center_x, emt_center_y + dy - edge), dx, edge, theta=0.)
-		emr_box = RectangularAperture((emr_center_x + dx - edge, emr_center_y), edge, dy, theta=0.)
-		emb_box = RectangularAperture((emb_center_x, emb_center_y), dx, edge, theta=0.)
+		frame_shape = (frame_header['NAXIS2'], frame_header['NAXIS1'])
+		binning = frame_header.get('XBINNING', 1)
 
-		boxes['mask_box'] = mask_box
-		boxes['eml_box'] = eml_box
-		boxes['emt_box'] = emt_box
-		boxes['emr_box'] = emr_box
-		boxes['emb_box'] = emb_box
+		mask = Masker.get_mask(camera, binning, frame_shape)
+		boxes = Masker.mask_boxes(camera, binning, frame_shape)
 
 		return mask, boxes
 
 	@staticmethod
-	def make_stack(obj_dir):
+	def make_stack(obj_dir, incremental=False, weighting=None):
+
+		weighting = weighting or Configuration.STACK_WEIGHTING
 
 		align_dir = os.path.join(obj_dir, 'align')
 		stack_path = os.path.join(align_dir, 'stack.fit')
 
-		if os.path.isfile(stack_path):
+		os.chdir(align_dir)
+		stack_list = sorted(glob.glob('a-*.fit'))
+
+		if incremental:
+			print('Updating incremental stack')
+			stack = Stacker.update_stack(align_dir, stack_list)
+			ccdproc.fits_ccddata_writer(stack, stack_path, overwrite=True)
+
+			return stack
+
+		if weighting == 'none':
+			params = (Configuration.COMBINE_METHOD, Configuration.DTYPE, Configuration.SIGMA_BKG)
+
+		else:
+			params = (weighting, Configuration.DTYPE, Configuration.SIGMA_BKG, Configuration.STACK_REJECT)
+
+		stack_key = Reducer.master_key('stack', stack_list, params)
+
+		if (len(stack_list) == 0 and os.path.isfile(stack_path)) or Reducer.fetch_master(stack_path, stack_key):
 			print('Reading extant stack')
 			stack = ccdproc.fits_ccddata_reader(stack_path)
 
-		else:
+		elif weighting == 'none':
 			print('Creating master stack')
-			os.chdir(align_dir)
-			stack_list = []
-			for item in glob.glob('*.fit'):
-				stack_list.append(item)
+			stack = Combiner.combine(stack_list)
+			stack.header['CALKEY'] = stack_key
+
+			ccdproc.fits_ccddata_writer(stack, stack_path, overwrite=True)
+			Reducer.cache_master(stack_path, stack_key)
 
-			stack = ccdproc.combine(stack_list, method=Configuration.COMBINE_METHOD, unit='adu', mem_limit=Configuration.MEM_LIMIT, dtype=Configuration.DTYPE)
-			ccdproc.fits_ccddata_writer(stack, stack_path)
+		else:
+			print('Creating weighted stack')
+			stack, exposure_map, weight_map = Stacker.weighted_stack(align_dir, stack_list, weighting)
+			stack.header['CALKEY'] = stack_key
+
+			# --- The exposure and weight maps follow the stack as image extensions
+			ccdproc.fits_ccddata_writer(stack, stack_path, overwrite=True)
+			fits.append(stack_path, exposure_map, header=fits.Header({'EXTNAME': 'EXPOSURE', 'BUNIT': 's'}))
+			fits.append(stack_path, weight_map, header=fits.Header({'EXTNAME': 'WEIGHT'}))
+			Reducer.cache_master(stack_path, stack_key)
 
 		return stack
 
 	@staticmethod
-	def reduce_objects(obj_dir, flat_dir, dark_dir, bkg_method='flat'):
+	def master_key(kind, frame_list, params=()):
+		''' This function returns the provenance key of a master: a hash of its kind, its combine parameters and the content of its input frames. Every frame is hashed in full, so the key does not depend on where the frame is stored or on the order of the list, and any change to its header or pixels gives a new key. Hashing reads every input once, which costs far less than the combine it can save.
+
+		:parameter kind [string] - The kind of master (dark, flat or stack)
+		:parameter frame_list [list] - The paths of the input frames
+		:parameter params [tuple] - The parameters that change the result of the combine
+
+		:return key [string] - The provenance key
+
+		'''
+
+		chunk_size = 1 << 20
+
+		frame_digests = []
 
-		flat_path = os.path.join(flat_dir, 'flatfield.fit')
-		dark_path = os.path.join(dark_dir, 'master-dark.fit')
+		for item in frame_list:
+			frame_digest = hashlib.sha1()
+
+			with open(item, 'rb') as frame:
+				for chunk in iter(lambda: frame.read(chunk_size), b''):
+					frame_digest.update(chunk)
+
+			frame_digests.append(frame_digest.hexdigest())
+
+		digest = hashlib.sha1(repr((kind,) + tuple(params)).encode('ascii'))
+		for frame_digest in sorted(frame_digests):
+			digest.update(frame_digest.encode('ascii'))
+
+		return kind + '-' + digest.hexdigest()
+
+	@staticmethod
+	def read_reference(align_dir, wcs_dir, obj_list, reference=None, fields=None):
+		''' This function returns the reference of an object. The reference is chosen once per object and cached in the align directory with its strategy, so frames added later share the same grid. A different strategy selects the reference again, and if that changes the reference the frames aligned to the old one are removed so they are aligned again.
+
+		:parameter align_dir [string] - The directory of the aligned frames
+		:parameter wcs_dir [string] - The directory of the solved frames
+		:parameter obj_list [list] - The names of the solved frames
+		:parameter reference [string] - The reference strategy (first, seeing or field); the default is Configuration.ALIGN_REFERENCE
+		:parameter fields [DataFrame] - The survey fields, for the field strategy
+
+		:return reference_name [string] - The name of the reference frame, or None for a survey field
+		:return reference_header [Header] - The header of the reference
+
+		'''
+
+		reference = reference or Configuration.ALIGN_REFERENCE
+		reference_path = os.path.join(align_dir, 'reference.hdr')
+		cached_frame = None
+
+		if os.path.isfile(reference_path):
+			reference_header = fits.Header.fromtextfile(reference_path)
+			cached_frame = reference_header['REFFRAME']
+
+			if reference_header.get('REFSTRAT') == reference:
+				print('Reading cached reference', reference_path)
+				reference_name = None if cached_frame.startswith('field ') else cached_frame
+
+				return reference_name, reference_header
+
+			print('Reference strategy changed from', reference_header.get('REFSTRAT', 'unknown'), 'to', reference)
+
+		reference_name, reference_header = Aligner.select_reference(wcs_dir, obj_list, reference, fields)
+		reference_header['REFSTRAT'] = (reference, 'Reference strategy of the alignment')
+
+		# --- Frames aligned to another reference are on another grid
+		if (cached_frame is not None) and (cached_frame != reference_header['REFFRAME']):
+			Reducer.remove_aligned(align_dir)
+
+		reference_header.totextfile(reference_path, overwrite=True)
+
+		return reference_name, reference_header
+
+	@staticmethod
+	def reduce_frame(obj_path, cal_path, bkg_method='flat', calibrator=None, warm_start=None):
+
+		print('Reducing frame', os.path.basename(obj_path))
+		obj_frame_data, obj_frame_header = Reader.load_frame(obj_path)
+
+		reduced_obj_frame_data, obj_frame_header = Reducer.calibrate_frame(obj_frame_data, obj_frame_header, bkg_method, calibrator, warm_start)
+
+		obj_hdu = fits.PrimaryHDU(reduced_obj_frame_data, header=obj_frame_header)
+		obj_hdu.writeto(cal_path)
+
+		return cal_path
+
+	@staticmethod
+	def reduce_objects(obj_dir, flat_dir=None, dark_dir=None, bkg_method='flat', workers=None, calibrations=None):
 
 		raw_dir = os.path.join(obj_dir, 'raw')
 		cal_dir = os.path.join(obj_dir, 'cal')
 
+		if workers is None:
+			workers = Configuration.WORKERS
+
+		if calibrations is None:
+			flat_path = os.path.join(flat_dir, 'flatfield.fit')
+			dark_path = os.path.join(dark_dir, 'master-dark.fit')
+
 		os.chdir(raw_dir)
 		obj_list = []
 		for item in glob.glob('*.fit'):
 			obj_list.append(item)
 		obj_list = sorted(obj_list)
 
+		# --- Group the pending frames by their (master dark, flatfield) pair
+		groups = {}
+
 		for obj in obj_list:
 
 			obj_name = 'red-' + obj
@@ -234,48 +536,59 @@ class Reducer:
 				print('Skipping reduction on frame', obj)
 
 			else:
-				print('Reducing frame', obj)
-				obj_frame = fits.open(obj)
-				obj_frame_data = obj_frame[0].data
-				obj_frame_header = obj_frame[0].header
-
-				master_dark = fits.open(dark_path)
-				master_dark_data = master_dark[0].data
-				master_dark_header = master_dark[0].header
-				reduced_obj_frame_data = obj_frame_data - master_dark_data
-
-				flatfield = fits.open(flat_path)
-				flatfield_data = flatfield[0].data
-				flatfield_header = flatfield[0].header
-				reduced_obj_frame_data /= flatfield_data
-
-				sigma_clip = SigmaClip(sigma=Configuration.SIGMA)
-				threshold = detect_threshold(reduced_obj_frame_data, nsigma=Configuration.SIGMA_BKG, sigma_clip=sigma_clip)
-				segment_img = detect_sources(reduced_obj_frame_data, threshold, npixels=Configuration.NPIXELS)
-				footprint = circular_footprint(radius=10)
-				mask = segment_img.make_source_mask(footprint=footprint)
-
-				bkg_estimator = MedianBackground()
-				bkg = Background2D(reduced_obj_frame_data, box_size=Configuration.BOX_SIZE, filter_size=Configuration.FILTER_SIZE, sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-				
-				print(bkg.background_median, bkg.background_rms_median)
-
-				if bkg_method == '2d':
-					reduced_obj_frame_data -= bkg.background
-
-				elif bkg_method == 'flat':
-					reduced_obj_frame_data -= bkg.background_median
+				if calibrations is not None:
+					dark_path, flat_path = calibrations[obj]
 
-				else:
-					reduced_obj_frame_data -= bkg.background
+				obj_paths, cal_paths = groups.setdefault((dark_path, flat_path), ([], []))
+				obj_paths.append(os.path.join(raw_dir, obj))
+				cal_paths.append(cal_path)
+
+		for (dark_path, flat_path), (obj_paths, cal_paths) in groups.items():
+
+			calibrator = Calibrator(dark_path, flat_path)
+			Background.previous = None
+
+			if (workers > 1) and (len(obj_paths) > 1):
+				group_workers = min(workers, len(obj_paths))
+				print('Reducing', len(obj_paths), 'frames with', group_workers, 'workers')
+
+				descriptor = calibrator.share()
+
+				try:
+					with ProcessPoolExecutor(max_workers=group_workers, initializer=Calibrator.attach, initargs=(descriptor,)) as executor:
+						# --- Workers do not share Background.previous, so every frame starts cold whatever the order of the workers
+						bkg_methods = [bkg_method] * len(obj_paths)
+						calibrators = [None] * len(obj_paths)
+						warm_starts = [False] * len(obj_paths)
+						reduced_list = list(executor.map(Reducer.reduce_frame, obj_paths, cal_paths, bkg_methods, calibrators, warm_starts))
 
-				obj_hdu = fits.PrimaryHDU(reduced_obj_frame_data, header=obj_frame_header)
-				obj_hdu.writeto(cal_path)
+				finally:
+					calibrator.release()
+
+			else:
+				for obj_path, cal_path in zip(obj_paths, cal_paths):
+					Reducer.reduce_frame(obj_path, cal_path, bkg_method, calibrator)
 
 		return obj_list
 
 	@staticmethod
-	def solve_plates(obj_dir):
+	def remove_aligned(align_dir):
+		''' This function removes the aligned frames of an object and the accumulators of its incremental stack, which belong to a reference that is no longer in use.
+
+		:parameter align_dir [string] - The directory of the aligned frames
+
+		'''
+
+		aligned_paths = glob.glob(os.path.join(align_dir, 'a-*.fit'))
+		print('Removing', len(aligned_paths), 'frames aligned to the previous reference')
+
+		for aligned_path in aligned_paths:
+			os.remove(aligned_path)
+
+		shutil.rmtree(os.path.join(align_dir, 'stack-acc'), ignore_errors=True)
+
+	@staticmethod
+	def solve_plates(obj_dir, workers=None, timeout=None, mode=None, track=None):
 
 		cal_dir = os.path.join(obj_dir, 'cal')
 		wcs_dir = os.path.join(obj_dir, 'wcs')
@@ -286,42 +599,209 @@ class Reducer:
 			obj_list.append(item)
 		obj_list = sorted(obj_list)
 
-		for obj in obj_list:
+		cal_paths = [os.path.join(cal_dir, obj) for obj in obj_list]
+		wcs_paths = [os.path.join(wcs_dir, 'wcs-' + obj) for obj in obj_list]
 
-			cal_path = os.path.join(cal_dir, obj)
-			wcs_path = os.path.join(wcs_dir, 'wcs-' + obj)
+		mode = mode or Configuration.SOLVE_MODE
 
-			if os.path.isfile(wcs_path):
-				print('Skipping plate solve on frame', obj)
+		if track is None:
+			track = Configuration.SOLVE_TRACK
 
-			else:
-				print('Plate solving frame', obj)
-				file_name = obj[:-4]
-				file_axy = file_name + '.axy'
-				file_corr = file_name + '.corr'
-				file_match = file_name + '.match'
-				file_new = file_name + '.new'
-				file_rdls = file_name + '.rdls'
-				file_solved = file_name + '.solved'
-				file_wcs = file_name + '.wcs'
-				file_xyls = file_name + '-indx.xyls'
-
-				subprocess.run(['solve-field', '--no-plots', obj, '--ra', str(Configuration.FIELD_RA), '--dec', str(Configuration.FIELD_DEC), '--radius', str(Configuration.RAD_SOLVE)])
-				subprocess.run(['rm', file_axy])
-				subprocess.run(['rm', file_corr])
-				subprocess.run(['rm', file_match])
-				subprocess.run(['rm', file_rdls])
-				subprocess.run(['rm', file_solved])
-				subprocess.run(['rm', file_wcs])
-				subprocess.run(['rm', file_xyls])
-				subprocess.run(['mv', file_new, 'wcs-' + str(file_name) + '.fit'])
-
-		wcs_list = []
-		for item in glob.glob('wcs-*.fit'):
-
-			old_item_path = os.path.join(cal_dir, item)
-			new_item_path = os.path.join(wcs_dir, item)
-
-			shutil.move(old_item_path, new_item_path)
+		# --- The frames of an object share their binning and shape, so one mask serves all of them
+		mask = None
+		if ((mode == 'xyls') or track) and (len(cal_paths) > 0):
+			mask, boxes = Reducer.make_mask(cal_paths[0])
+
+		if track:
+			Solver.track_frames(cal_paths, wcs_paths, timeout=timeout, mode=mode, mask=mask)
+
+		else:
+			Solver.solve_frames(cal_paths, wcs_paths, workers=workers, timeout=timeout, mode=mode, mask=mask)
 
 		return obj_list
+
+	@staticmethod
+	def stream_objects(obj_dir, flat_dir=None, dark_dir=None, bkg_method='flat', calibrations=None, keep=None, method=None, reference=None, fields=None, timeout=None, weighting=None):
+		''' This function reduces the raw frames of an object into a stack in a single pass, keeping every frame in memory from calibration to the stack. Each frame is calibrated, plate solved by tracking the previous solution or by solve-field on its extracted sources, aligned with the reference and added to the running accumulators of the stack. The calibrated, solved and aligned frames are only written if asked for, with the names reduce_objects, solve_plates and align_frames give them, and frames already in the accumulators are skipped. The running stack is unweighted, so weighted stacking has to go through make_stack. If a frame fails, the frames added before it are committed before the error is raised; if the process is killed, the accumulators stay as the last committed run left them.
+
+		:parameter obj_dir [string] - The directory of the object
+		:parameter flat_dir [string] - The directory of the flatfield, if calibrations is None
+		:parameter dark_dir [string] - The directory of the master dark, if calibrations is None
+		:parameter bkg_method [string] - The background subtracted (flat or 2d)
+		:parameter calibrations [dictionary] - The (master dark, flatfield) paths of every raw frame, as returned by Librarian.match_frames
+		:parameter keep [list] - The intermediate frames to write (cal, wcs and align); the default is Configuration.PIPELINE_KEEP
+		:parameter method [string] - The alignment method (auto or reproject); the default is Configuration.ALIGN_METHOD
+		:parameter reference [string] - The reference strategy (first or field); the default is Configuration.ALIGN_REFERENCE
+		:parameter fields [DataFrame] - The survey fields, for the field strategy
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]; the default is Configuration.SOLVE_TIMEOUT
+		:parameter weighting [string] - The frame weighting, which must be none; the default is Configuration.STACK_WEIGHTING
+
+		:return stack [CCDData] - The stack
+
+		'''
+
+		keep = Configuration.PIPELINE_KEEP if keep is None else keep
+		reference = reference or Configuration.ALIGN_REFERENCE
+		weighting = weighting or Configuration.STACK_WEIGHTING
+
+		for kind in keep:
+			if kind not in ('cal', 'wcs', 'align'):
+				raise ValueError('Unknown intermediate {} (must be one of cal, wcs, align)'.format(kind))
+
+		if reference not in ('first', 'field'):
+			raise ValueError('The {} reference strategy cannot be streamed (must be one of first, field)'.format(reference))
+
+		if (reference == 'field') and (fields is None):
+			raise ValueError('The field reference strategy needs the survey fields')
+
+		if weighting != 'none':
+			raise ValueError('The {} weighting cannot be streamed (the running stack is unweighted)'.format(weighting))
+
+		raw_dir = os.path.join(obj_dir, 'raw')
+		cal_dir = os.path.join(obj_dir, 'cal')
+		wcs_dir = os.path.join(obj_dir, 'wcs')
+		align_dir = os.path.join(obj_dir, 'align')
+		acc_dir = os.path.join(align_dir, 'stack-acc')
+		reference_path = os.path.join(align_dir, 'reference.hdr')
+		stack_path = os.path.join(align_dir, 'stack.fit')
+
+		obj_list = sorted(os.path.basename(item) for item in glob.glob(os.path.join(raw_dir, '*.fit')))
+
+		if len(obj_list) == 0:
+			raise ValueError('No raw frames in {}'.format(raw_dir))
+
+		if calibrations is None:
+			flat_path = os.path.join(flat_dir, 'flatfield.fit')
+			dark_path = os.path.join(dark_dir, 'master-dark.fit')
+
+		# --- The frames of an object share their binning and shape, so one mask serves all of them
+		mask, boxes = Reducer.make_mask(os.path.join(raw_dir, obj_list[0]))
+
+		reference_header = None
+		accumulators = None
+		frames = []
+
+		if os.path.isfile(reference_path):
+			reference_header = fits.Header.fromtextfile(reference_path)
+
+			# --- The running stack is on the grid of the cached reference, so another strategy starts it again
+			if reference_header.get('REFSTRAT') != reference:
+				print('Reference strategy changed from', reference_header.get('REFSTRAT', 'unknown'), 'to', reference)
+				Reducer.remove_aligned(align_dir)
+				os.remove(reference_path)
+				reference_header = None
+
+			else:
+				print('Reading cached reference', reference_path)
+				accumulators, frames = Stacker.open_accumulators(acc_dir, (reference_header['NAXIS2'], reference_header['NAXIS1']))
+
+		calibrators = {}
+
+		# --- The index headers are read once for all frames
+		indexes = Solver.read_indexes(Configuration.INDEX_DIR)
+
+		# --- Solution of the last solved frame and the sky positions of the sources of the last frame solved by solve-field
+		wcs = None
+		catalog = None
+
+		# --- An error inside accumulate leaves the accumulators between two frames, so only errors outside it commit
+		accumulating = False
+
+		try:
+			for obj in obj_list:
+
+				aligned_name = 'a-wcs-red-' + obj
+
+				if aligned_name in frames:
+					print('Skipping frame', obj, '(already stacked)')
+					continue
+
+				if calibrations is not None:
+					dark_path, flat_path = calibrations[obj]
+
+				if (dark_path, flat_path) not in calibrators:
+					calibrators[(dark_path, flat_path)] = Calibrator(dark_path, flat_path)
+					Background.previous = None
+
+				print('Streaming frame', obj)
+				obj_frame_data, obj_frame_header = Reader.load_frame(os.path.join(raw_dir, obj))
+				frame_data, frame_header = Reducer.calibrate_frame(obj_frame_data, obj_frame_header, bkg_method, calibrators[(dark_path, flat_path)])
+
+				if 'cal' in keep:
+					fits.PrimaryHDU(frame_data, header=frame_header).writeto(os.path.join(cal_dir, 'red-' + obj), overwrite=True)
+
+				wcs_header = None
+
+				if catalog is not None:
+					refined_wcs, residual, n_matched = Solver.refine_wcs(frame_data, wcs, catalog, mask)
+
+					if (refined_wcs is not None) and (residual <= Configuration.SOLVE_TRACK_TOLERANCE):
+						print('Tracked frame', obj, '- matched', n_matched, 'sources with rms residual', '%.2f' % residual, 'arcsec')
+						wcs = refined_wcs
+						wcs_header = refined_wcs.to_header(relax=True)
+
+					else:
+						print('Lost track on frame', obj, '({} sources matched, rms residual {:.2f} arcsec)'.format(n_matched, residual))
+
+				if wcs_header is None:
+					sources = Solver.extract_sources(frame_data, mask)
+					status, wcs_header = Solver.solve_data(frame_data, frame_header, obj_dir, timeout, mask=mask, sources=sources, indexes=indexes)
+
+					if wcs_header is None:
+						print('Frame', obj, 'did not solve', '(' + status['status'] + ')')
+						continue
+
+					print('Plate solved frame', obj, 'in', '%.1f' % status['time'], 's')
+					wcs = WCS(wcs_header)
+					catalog = wcs.pixel_to_world(sources['xcentroid'], sources['ycentroid'])
+
+				frame_header = Solver.apply_solution(frame_header, wcs_header)
+
+				if 'wcs' in keep:
+					fits.PrimaryHDU(frame_data, header=frame_header).writeto(os.path.join(wcs_dir, 'wcs-red-' + obj), overwrite=True)
+
+				if reference_header is None:
+					if reference == 'field':
+						reference_header, field_id = Aligner.field_header(frame_header, fields)
+						reference_header['REFFRAME'] = ('field ' + field_id, 'Reference of the alignment')
+
+					else:
+						reference_header = frame_header.copy()
+						reference_header['REFFRAME'] = ('wcs-red-' + obj, 'Reference of the alignment')
+
+					reference_header['REFSTRAT'] = (reference, 'Reference strategy of the alignment')
+					reference_header.totextfile(reference_path)
+					accumulators, frames = Stacker.open_accumulators(acc_dir, (reference_header['NAXIS2'], reference_header['NAXIS1']))
+
+				if reference_header['REFFRAME'] == 'wcs-red-' + obj:
+					aligned_data = frame_data.astype(Configuration.DTYPE)
+
+				else:
+					aligned_data, kind = Aligner.align(frame_data, frame_header, reference_header, method)
+					print('Aligned frame', obj, 'with reference frame', '(' + kind + ')')
+
+				if 'align' in keep:
+					aligned_hdu = fits.PrimaryHDU(aligned_data, header=Aligner.aligned_header(frame_header, reference_header))
+					aligned_hdu.writeto(os.path.join(align_dir, aligned_name), overwrite=True)
+
+				accumulating = True
+				Stacker.accumulate(accumulators, aligned_data)
+				frames.append(aligned_name)
+				accumulating = False
+
+		except Exception:
+			if (accumulators is not None) and not accumulating:
+				print('Committing the', len(frames), 'frames stacked before the error')
+				Stacker.close_accumulators(acc_dir, accumulators, frames)
+
+			raise
+
+		if accumulators is None:
+			raise ValueError('No frame of {} was plate solved'.format(raw_dir))
+
+		Stacker.close_accumulators(acc_dir, accumulators, frames)
+
+		stack = Stacker.read_stack(accumulators, reference_header, len(frames))
+		ccdproc.fits_ccddata_writer(stack, stack_path, overwrite=True)
+
+		return stack
@@ -0,0 +1,774 @@
+from config import Configuration
+from libraries.reader import Reader
+from libraries.utils import Utils
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from astropy.table import Table
+from astropy.wcs import WCS
+from astropy.wcs.utils import fit_wcs_from_points, proj_plane_pixel_scales
+from concurrent.futures import ThreadPoolExecutor
+from photutils.detection import DAOStarFinder
+from scipy.spatial import cKDTree
+import glob
+import numpy as np
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+class Solver:
+
+	# --- Status of a frame after solve_frames
+	SOLVED = 'solved'
+	FAILED = 'failed'
+	TIMEOUT = 'timeout'
+	SKIPPED = 'skipped'
+	TRACKED = 'tracked'
+
+	# --- Fewest sources worth handing to solve-field in xyls mode
+	MIN_SOURCES = 10
+
+	@staticmethod
+	def apply_solution(header, wcs_header):
+		''' This function returns a copy of a header that carries a WCS solution, replacing any WCS the header already had.
+
+		:parameter header [Header] - The header of the frame
+		:parameter wcs_header [Header] - The header of the WCS solution
+
+		:return header [Header] - The header with the solution
+
+		'''
+
+		header = header.copy()
+
+		for key in WCS(header).to_header(relax=True):
+			header.remove(key, ignore_missing=True, remove_all=True)
+
+		header.extend(wcs_header, strip=True, update=True)
+
+		return header
+
+	@staticmethod
+	def cache_hints(cache_path):
+		''' This function returns the solve-field options that start a solve from a cached solution: solve-field first verifies the cached WCS and otherwise searches a narrow range around its pixel scale.
+
+		:parameter cache_path [string] - The path of the cached solution
+
+		:return options [list] - The options of solve-field
+
+		'''
+
+		wcs = WCS(Reader.read_header(cache_path))
+		scale = np.mean(proj_plane_pixel_scales(wcs)) * 3600
+
+		return ['--verify', cache_path] + Solver.scale_options(scale, Configuration.SOLVE_CACHE_TOLERANCE)
+
+	@staticmethod
+	def cache_path(header):
+		''' This function returns the path of the cached solution for the pointing and binning of a frame. The pointing is quantized to Configuration.SOLVE_CACHE_GRID, so repeat visits to a field share one entry. The cache is only used if Configuration.CACHE_DIR exists.
+
+		:parameter header [Header] - The header of the frame
+
+		:return cache_path [string] - The path of the cached solution, or None if there is no cache
+
+		'''
+
+		if not os.path.isdir(Configuration.CACHE_DIR):
+			return None
+
+		solve_dir = os.path.join(Configuration.CACHE_DIR, 'solve')
+		os.makedirs(solve_dir, exist_ok=True)
+
+		ra, dec = Solver.read_pointing(header)
+		grid = Configuration.SOLVE_CACHE_GRID
+		binning = header.get('XBINNING', 1)
+
+		ra_index = int(round(ra / grid)) % int(round(360 / grid))
+		dec_index = int(round(dec / grid))
+
+		cache_name = 'wcs-{:g}-{}-{}-{}x{}.wcs'.format(grid, ra_index, dec_index, binning, binning)
+
+		return os.path.join(solve_dir, cache_name)
+
+	@staticmethod
+	def cache_solution(wcs_header_path, cache_path):
+		''' This function stores the .wcs file of a solved frame as the cached solution of its pointing.
+
+		:parameter wcs_header_path [string] - The path of the .wcs file written by solve-field
+		:parameter cache_path [string] - The path of the cached solution
+
+		'''
+
+		# --- Concurrent solves of the same pointing may race, so the entry is replaced atomically
+		part_path = '{}.{}.{}.part'.format(cache_path, os.getpid(), threading.get_ident())
+		shutil.copyfile(wcs_header_path, part_path)
+		os.replace(part_path, cache_path)
+
+	@staticmethod
+	def extract_sources(frame_data, mask=None, n_sources=None):
+		''' This function extracts the brightest sources of a frame with DAOStarFinder.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter mask [array] - The pixels to ignore, True where a pixel is masked
+		:parameter n_sources [int] - The number of sources to keep; the default is Configuration.SOLVE_SOURCES
+
+		:return sources [Table] - The sources, brightest first, or None if no source is found
+
+		'''
+
+		n_sources = n_sources or Configuration.SOLVE_SOURCES
+
+		mean, median, std = sigma_clipped_stats(frame_data, mask=mask, sigma=Configuration.SIGMA_BKG)
+
+		daofind = DAOStarFinder(fwhm=6.0, threshold=Configuration.SIGMA_SRC * std, brightest=n_sources)
+		sources = daofind(frame_data - median, mask=mask)
+
+		if sources is not None:
+			sources.sort('flux', reverse=True)
+
+		return sources
+
+	@staticmethod
+	def extract_xyls(frame_path, xyls_path, mask=None, n_sources=None):
+		''' This function extracts the brightest sources of a frame with DAOStarFinder and writes their positions, brightest first, to an xyls table that solve-field can solve without reading the image.
+
+		:parameter frame_path [string] - The path of the frame
+		:parameter xyls_path [string] - The path of the xyls table
+		:parameter mask [array] - The pixels to ignore, True where a pixel is masked
+		:parameter n_sources [int] - The number of sources to keep; the default is Configuration.SOLVE_SOURCES
+
+		:return n_sources [int] - The number of sources written
+		:return shape [tuple] - The shape of the frame
+
+		'''
+
+		frame_data, frame_header = Reader.load_frame(frame_path)
+		sources = Solver.extract_sources(frame_data, mask, n_sources)
+
+		n_sources = Solver.write_xyls(sources, frame_data.shape, xyls_path)
+
+		return n_sources, frame_data.shape
+
+	@staticmethod
+	def read_indexes(index_dir):
+		''' This function lists the astrometry.net index files of a directory with the HEALPix cell each covers, given by HEALPIX and HPNSIDE in its header. All-sky index files have a HEALPIX of -1 or none. The headers are read once, so a run of frames can share the listing.
+
+		:parameter index_dir [string] - The directory of the index files
+
+		:return indexes [list] - The (path, healpix, nside) of every index file, or None if the directory does not exist
+
+		'''
+
+		if (index_dir is None) or not os.path.isdir(index_dir):
+			return None
+
+		indexes = []
+
+		for index_path in sorted(glob.glob(os.path.join(index_dir, 'index-*.fits'))):
+			header = Reader.read_header(index_path)
+			indexes.append((index_path, header.get('HEALPIX', -1), header.get('HPNSIDE', 1)))
+
+		return indexes
+
+	@staticmethod
+	def read_pointing(header):
+		''' This function returns the pointing of a frame from OBJCTRA and OBJCTDEC, or from numeric RA and DEC, falling back to Configuration.FIELD_RA and Configuration.FIELD_DEC.
+
+		:parameter header [Header] - The header of the frame
+
+		:return ra [float] - The right ascension of the pointing [deg]
+		:return dec [float] - The declination of the pointing [deg]
+
+		'''
+
+		if ('OBJCTRA' in header) and ('OBJCTDEC' in header):
+			try:
+				pointing = SkyCoord(header['OBJCTRA'], header['OBJCTDEC'], unit=(u.hourangle, u.deg))
+				return pointing.ra.deg, pointing.dec.deg
+
+			except ValueError:
+				pass
+
+		if isinstance(header.get('RA'), (int, float)) and isinstance(header.get('DEC'), (int, float)):
+			return float(header['RA']), float(header['DEC'])
+
+		return Configuration.FIELD_RA, Configuration.FIELD_DEC
+
+	@staticmethod
+	def refine_wcs(frame_data, wcs, catalog, mask=None, sip_degree=None):
+		''' This function refines the WCS of a frame that drifted slightly from the previous one. The catalog positions are projected with the previous WCS, matched one-to-one to the sources of the frame within Configuration.SOLVE_TRACK_RADIUS pixels, and a new TAN (or TAN-SIP) solution is fitted to the matches.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter wcs [WCS] - The WCS of the previous frame
+		:parameter catalog [SkyCoord] - The sky positions of the sources of the reference frame
+		:parameter mask [array] - The pixels to ignore, True where a pixel is masked
+		:parameter sip_degree [int] - The degree of the SIP distortion to fit, or None for a linear solution
+
+		:return wcs [WCS] - The refined WCS, or None if too few sources match
+		:return residual [float] - The rms distance between the matched sources and the catalog under the refined WCS [arcsec]
+		:return n_matched [int] - The number of matched sources
+
+		'''
+
+		sources = Solver.extract_sources(frame_data, mask)
+
+		if (sources is None) or (len(sources) < Solver.MIN_SOURCES):
+			return None, np.inf, 0
+
+		source_xy = np.column_stack([sources['xcentroid'], sources['ycentroid']])
+		catalog_xy = np.column_stack(wcs.world_to_pixel(catalog))
+
+		distance, index = cKDTree(source_xy).query(catalog_xy, distance_upper_bound=Configuration.SOLVE_TRACK_RADIUS)
+		matched = np.isfinite(distance)
+
+		# --- Drop the sources claimed by more than one catalog position
+		claimed, counts = np.unique(index[matched], return_counts=True)
+		matched &= np.isin(index, claimed[counts == 1])
+
+		n_matched = int(np.sum(matched))
+
+		if n_matched < Solver.MIN_SOURCES:
+			return None, np.inf, n_matched
+
+		xy = (source_xy[index[matched], 0], source_xy[index[matched], 1])
+		world = catalog[matched]
+
+		template = WCS(naxis=2)
+		template.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+		template.wcs.cd = wcs.pixel_scale_matrix
+
+		refined_wcs = fit_wcs_from_points(xy, world, projection=template, sip_degree=sip_degree)
+		refined_wcs.pixel_shape = frame_data.shape[::-1]
+
+		separation = refined_wcs.pixel_to_world(*xy).separation(world).arcsec
+		residual = float(np.sqrt(np.mean(separation**2)))
+
+		return refined_wcs, residual, n_matched
+
+	@staticmethod
+	def run_solver(command, timeout):
+		''' This function runs solve-field in its own process group and kills the group if it runs past the timeout.
+
+		:parameter command [list] - The arguments of solve-field
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]
+
+		:return status [string] - FAILED if solve-field could not run or exited with an error, TIMEOUT if it was killed, or None if it finished
+		:return output [string] - The output of solve-field
+
+		'''
+
+		try:
+			process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True)
+
+		except OSError as error:
+			return Solver.FAILED, str(error)
+
+		try:
+			output, _ = process.communicate(timeout=timeout)
+
+		except subprocess.TimeoutExpired:
+			os.killpg(process.pid, signal.SIGKILL)
+			output, _ = process.communicate()
+
+			return Solver.TIMEOUT, output
+
+		if process.returncode != 0:
+			return Solver.FAILED, output
+
+		return None, output
+
+	@staticmethod
+	def scale_hints(binning):
+		''' This function returns the solve-field options that bound the pixel scale of Configuration.CAMERA at a given binning.
+
+		:parameter binning [int] - The binning of the frame
+
+		:return options [list] - The scale options of solve-field, empty if the pixel size of the camera is unknown
+
+		'''
+
+		pixel_size = Utils.config_camera(Configuration.CAMERA)['pixel_size']
+
+		if pixel_size is None:
+			return []
+
+		return Solver.scale_options(pixel_size * binning, Configuration.SOLVE_SCALE_TOLERANCE)
+
+	@staticmethod
+	def scale_options(scale, tolerance):
+		''' This function returns the solve-field options that bound the pixel scale.
+
+		:parameter scale [float] - The expected pixel scale [arcsec/px]
+		:parameter tolerance [float] - The fractional tolerance on the pixel scale
+
+		:return options [list] - The scale options of solve-field
+
+		'''
+
+		scale_low = scale * (1 - tolerance)
+		scale_high = scale * (1 + tolerance)
+
+		return ['--scale-units', 'arcsecperpix', '--scale-low', '%.4f' % scale_low, '--scale-high', '%.4f' % scale_high]
+
+	@staticmethod
+	def select_indexes(indexes, ra, dec, radius):
+		''' This function selects the astrometry.net index files that cover a field. An index file covers one HEALPix cell, numbered in the xy scheme of astrometry.net; all-sky index files are always kept.
+
+		:parameter indexes [list] - The index files, as returned by read_indexes
+		:parameter ra [float] - The right ascension of the field [deg]
+		:parameter dec [float] - The declination of the field [deg]
+		:parameter radius [float] - The radius of the field [deg]
+
+		:return index_paths [list] - The paths of the index files that cover the field
+
+		'''
+
+		# --- Only the index selection needs astropy_healpix
+		import astropy_healpix as ah
+
+		index_paths = []
+		cells = {}
+
+		for index_path, healpix, nside in indexes:
+
+			if healpix < 0:
+				index_paths.append(index_path)
+				continue
+
+			if nside not in cells:
+				hp = ah.HEALPix(nside=nside, order='nested')
+				cells[nside] = set(hp.cone_search_lonlat(ra * u.deg, dec * u.deg, radius=radius * u.deg).tolist())
+
+			if Solver.xy_to_nested(healpix, nside) in cells[nside]:
+				index_paths.append(index_path)
+
+		return index_paths
+
+	@staticmethod
+	def solve_command(input_path, scratch_dir, out_name, cpu_limit, options=()):
+		''' This function returns the solve-field command line for a frame or an xyls table. Every output of solve-field is written to the scratch directory.
+
+		:parameter input_path [string] - The path of the frame or xyls table to solve
+		:parameter scratch_dir [string] - The directory for the outputs of solve-field
+		:parameter out_name [string] - The base name of the outputs of solve-field
+		:parameter cpu_limit [float] - The CPU time after which solve-field gives up [s]
+		:parameter options [list] - Additional options of solve-field, including the pointing hints of solve_options
+
+		:return command [list] - The arguments of solve-field
+
+		'''
+
+		command = ['solve-field', '--no-plots', '--overwrite', '--dir', scratch_dir, '--out', out_name, '--cpulimit', str(int(cpu_limit))]
+		command += list(options)
+		command.append(input_path)
+
+		return command
+
+	@staticmethod
+	def solve_data(frame_data, frame_header, scratch_dir, timeout=None, cpu_limit=None, mask=None, sources=None, indexes=None):
+		''' This function plate solves a frame held in memory. The brightest sources are extracted in-process and only their positions are written for solve-field, so the frame itself never goes to disk.
+
+		:parameter frame_data [array] - The pixel values of the frame
+		:parameter frame_header [Header] - The header of the frame
+		:parameter scratch_dir [string] - The directory in which the scratch directory of solve-field is created
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]; the default is Configuration.SOLVE_TIMEOUT
+		:parameter cpu_limit [float] - The CPU time after which solve-field gives up [s]; the default is Configuration.SOLVE_CPU_LIMIT
+		:parameter mask [array] - The pixels to ignore when extracting sources
+		:parameter sources [Table] - The sources of the frame, if they are already extracted
+		:parameter indexes [list] - The index files, as returned by read_indexes; the default reads Configuration.INDEX_DIR
+
+		:return status [dictionary] - The status (solved, failed or timeout), the wall-clock time and the output of solve-field
+		:return wcs_header [Header] - The header of the WCS solution, or None if the frame did not solve
+
+		'''
+
+		timeout = timeout or Configuration.SOLVE_TIMEOUT
+		cpu_limit = cpu_limit or Configuration.SOLVE_CPU_LIMIT
+
+		if indexes is None:
+			indexes = Solver.read_indexes(Configuration.INDEX_DIR)
+
+		out_name = 'frame'
+		start = time.monotonic()
+
+		cache_path = Solver.cache_path(frame_header)
+
+		if sources is None:
+			sources = Solver.extract_sources(frame_data, mask)
+
+		with tempfile.TemporaryDirectory(prefix='solve-', dir=scratch_dir) as solve_dir:
+			options = Solver.solve_options(frame_header, cache_path, solve_dir, out_name, 'xyls', indexes)
+
+			xyls_path = os.path.join(solve_dir, out_name + '-src.xyls')
+			n_sources = Solver.write_xyls(sources, frame_data.shape, xyls_path)
+
+			if n_sources < Solver.MIN_SOURCES:
+				return {'status': Solver.FAILED, 'time': time.monotonic() - start, 'output': 'Only {} sources extracted'.format(n_sources)}, None
+
+			options += ['--width', str(frame_data.shape[1]), '--height', str(frame_data.shape[0]), '--x-column', 'X', '--y-column', 'Y', '--sort-column', 'FLUX']
+			command = Solver.solve_command(xyls_path, solve_dir, out_name, cpu_limit, options)
+
+			status, output = Solver.run_solver(command, timeout)
+
+			solved_path = os.path.join(solve_dir, out_name + '.solved')
+			wcs_header_path = os.path.join(solve_dir, out_name + '.wcs')
+
+			wcs_header = None
+
+			if (status is None) and os.path.isfile(solved_path) and os.path.isfile(wcs_header_path):
+				status = Solver.SOLVED
+				wcs_header = Reader.read_header(wcs_header_path)
+
+				if cache_path is not None:
+					Solver.cache_solution(wcs_header_path, cache_path)
+
+		return {'status': status or Solver.FAILED, 'time': time.monotonic() - start, 'output': output}, wcs_header
+
+	@staticmethod
+	def solve_frame(frame_path, wcs_path, timeout=None, cpu_limit=None, mode=None, mask=None, indexes=None):
+		''' This function plate solves one frame with solve-field in a scratch directory next to wcs_path and writes the solved frame to wcs_path. In image mode solve-field extracts the sources of the frame itself; in xyls mode the brightest sources are extracted in-process and solve-field only sees their positions, with scale hints from the pixel size of the camera. The scratch directory is removed whatever the outcome, and solve-field is killed together with its children if it runs past the timeout.
+
+		:parameter frame_path [string] - The path of the frame to solve
+		:parameter wcs_path [string] - The path of the solved frame
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]; the default is Configuration.SOLVE_TIMEOUT
+		:parameter cpu_limit [float] - The CPU time after which solve-field gives up [s]; the default is Configuration.SOLVE_CPU_LIMIT
+		:parameter mode [string] - The solving mode (image or xyls); the default is Configuration.SOLVE_MODE
+		:parameter mask [array] - The pixels to ignore when extracting sources in xyls mode
+		:parameter indexes [list] - The index files, as returned by read_indexes; the default reads Configuration.INDEX_DIR
+
+		:return status [dictionary] - The status (solved, failed or timeout), the wall-clock time and the output of solve-field
+
+		'''
+
+		timeout = timeout or Configuration.SOLVE_TIMEOUT
+		cpu_limit = cpu_limit or Configuration.SOLVE_CPU_LIMIT
+		mode = mode or Configuration.SOLVE_MODE
+
+		if indexes is None:
+			indexes = Solver.read_indexes(Configuration.INDEX_DIR)
+
+		if mode not in ('image', 'xyls'):
+			raise ValueError('Unknown solving mode {} (must be one of image, xyls)'.format(mode))
+
+		out_name = os.path.splitext(os.path.basename(frame_path))[0]
+		start = time.monotonic()
+
+		frame_header = Reader.read_header(frame_path)
+		cache_path = Solver.cache_path(frame_header)
+
+		with tempfile.TemporaryDirectory(prefix='solve-', dir=os.path.dirname(wcs_path)) as scratch_dir:
+			options = Solver.solve_options(frame_header, cache_path, scratch_dir, out_name, mode, indexes)
+
+			if mode == 'xyls':
+				xyls_path = os.path.join(scratch_dir, out_name + '-src.xyls')
+				n_sources, shape = Solver.extract_xyls(frame_path, xyls_path, mask)
+
+				if n_sources < Solver.MIN_SOURCES:
+					return {'status': Solver.FAILED, 'time': time.monotonic() - start, 'output': 'Only {} sources extracted'.format(n_sources)}
+
+				options += ['--width', str(shape[1]), '--height', str(shape[0]), '--x-column', 'X', '--y-column', 'Y', '--sort-column', 'FLUX']
+				command = Solver.solve_command(xyls_path, scratch_dir, out_name, cpu_limit, options)
+
+			else:
+				command = Solver.solve_command(os.path.abspath(frame_path), scratch_dir, out_name, cpu_limit, options)
+
+			status, output = Solver.run_solver(command, timeout)
+
+			if status is not None:
+				return {'status': status, 'time': time.monotonic() - start, 'output': output}
+
+			solved_path = os.path.join(scratch_dir, out_name + '.solved')
+			new_path = os.path.join(scratch_dir, out_name + '.new')
+			wcs_header_path = os.path.join(scratch_dir, out_name + '.wcs')
+
+			status = Solver.FAILED
+
+			if os.path.isfile(solved_path):
+
+				if os.path.isfile(new_path):
+					shutil.move(new_path, wcs_path)
+					status = Solver.SOLVED
+
+				elif os.path.isfile(wcs_header_path):
+					Solver.write_solution(frame_path, Reader.read_header(wcs_header_path), new_path)
+					shutil.move(new_path, wcs_path)
+					status = Solver.SOLVED
+
+			if (status == Solver.SOLVED) and (cache_path is not None) and os.path.isfile(wcs_header_path):
+				Solver.cache_solution(wcs_header_path, cache_path)
+
+		return {'status': status, 'time': time.monotonic() - start, 'output': output}
+
+	@staticmethod
+	def solve_frames(frame_paths, wcs_paths, workers=None, timeout=None, cpu_limit=None, mode=None, mask=None):
+		''' This function plate solves frames with a bounded pool of concurrent solve-field processes. Frames whose solved frame already exists are skipped.
+
+		:parameter frame_paths [list] - The paths of the frames to solve
+		:parameter wcs_paths [list] - The paths of the solved frames
+		:parameter workers [int] - The number of concurrent solve-field processes; the default is Configuration.WORKERS
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]; the default is Configuration.SOLVE_TIMEOUT
+		:parameter cpu_limit [float] - The CPU time after which solve-field gives up [s]; the default is Configuration.SOLVE_CPU_LIMIT
+		:parameter mode [string] - The solving mode (image or xyls); the default is Configuration.SOLVE_MODE
+		:parameter mask [array] - The pixels to ignore when extracting sources in xyls mode, shared by all frames
+
+		:return statuses [dictionary] - The status of every frame, keyed by frame name
+
+		'''
+
+		workers = max(1, workers or Configuration.WORKERS)
+
+		# --- The index headers are read once for all frames
+		indexes = Solver.read_indexes(Configuration.INDEX_DIR)
+
+		statuses = {}
+		pending = []
+
+		for frame_path, wcs_path in zip(frame_paths, wcs_paths):
+			name = os.path.basename(frame_path)
+
+			if os.path.isfile(wcs_path):
+				print('Skipping plate solve on frame', name)
+				statuses[name] = {'status': Solver.SKIPPED, 'time': 0., 'output': ''}
+
+			else:
+				pending.append((name, frame_path, wcs_path))
+
+		if len(pending) > 0:
+			print('Plate solving', len(pending), 'frames with', min(workers, len(pending)), 'workers')
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [(name, executor.submit(Solver.solve_frame, frame_path, wcs_path, timeout, cpu_limit, mode, mask, indexes)) for name, frame_path, wcs_path in pending]
+
+			for name, future in futures:
+				status = future.result()
+				statuses[name] = status
+
+				if status['status'] == Solver.SOLVED:
+					print('Plate solved frame', name, 'in', '%.1f' % status['time'], 's')
+
+				else:
+					print('Frame', name, 'did not solve', '(' + status['status'] + ')')
+
+		solved = sum(1 for status in statuses.values() if status['status'] in (Solver.SOLVED, Solver.SKIPPED))
+		print('Solved', solved, 'of', len(statuses), 'frames')
+
+		return statuses
+
+	@staticmethod
+	def solve_options(frame_header, cache_path, scratch_dir, out_name, mode, indexes=None):
+		''' This function returns the options of solve-field that narrow the search: the pointing of the frame, the scale and verification hints of a cached solution, or the scale hints of the camera in xyls mode, and an index configuration restricted to the same pointing when there are index files.
+
+		:parameter frame_header [Header] - The header of the frame
+		:parameter cache_path [string] - The path of the cached solution of the pointing, or None
+		:parameter scratch_dir [string] - The scratch directory of solve-field
+		:parameter out_name [string] - The base name of the outputs of solve-field
+		:parameter mode [string] - The solving mode (image or xyls)
+		:parameter indexes [list] - The index files, as returned by read_indexes, or None
+
+		:return options [list] - The options of solve-field
+
+		'''
+
+		ra, dec = Solver.read_pointing(frame_header)
+		options = ['--ra', str(ra), '--dec', str(dec), '--radius', str(Configuration.RAD_SOLVE)]
+
+		if (cache_path is not None) and os.path.isfile(cache_path):
+			options += Solver.cache_hints(cache_path)
+
+		elif mode == 'xyls':
+			options += Solver.scale_hints(frame_header.get('XBINNING', 1))
+
+		if indexes is not None:
+			config_path = os.path.join(scratch_dir, out_name + '.cfg')
+			Solver.write_index_config(config_path, indexes, ra, dec, Configuration.RAD_SOLVE)
+			options += ['--config', config_path]
+
+		return options
+
+	@staticmethod
+	def track_frames(frame_paths, wcs_paths, timeout=None, cpu_limit=None, mode=None, mask=None, sip_degree=None):
+		''' This function plate solves a time series by tracking the WCS from frame to frame. The first frame of a pointing is solved with solve-field and the positions of its sources become the catalog; every later frame is matched against the catalog and gets a refined WCS. solve-field is only run again when too few sources match or the rms residual exceeds Configuration.SOLVE_TRACK_TOLERANCE, which also happens when the telescope moves to a new pointing.
+
+		:parameter frame_paths [list] - The paths of the frames to solve, in time order
+		:parameter wcs_paths [list] - The paths of the solved frames
+		:parameter timeout [float] - The wall-clock time after which solve-field is killed [s]; the default is Configuration.SOLVE_TIMEOUT
+		:parameter cpu_limit [float] - The CPU time after which solve-field gives up [s]; the default is Configuration.SOLVE_CPU_LIMIT
+		:parameter mode [string] - The solving mode of the full solves (image or xyls); the default is Configuration.SOLVE_MODE
+		:parameter mask [array] - The pixels to ignore when extracting sources, shared by all frames
+		:parameter sip_degree [int] - The degree of the SIP distortion of the refined solutions, or None for linear solutions
+
+		:return statuses [dictionary] - The status of every frame, keyed by frame name
+
+		'''
+
+		statuses = {}
+		full_solves = 0
+
+		# --- The index headers are read once for all frames
+		indexes = Solver.read_indexes(Configuration.INDEX_DIR)
+
+		# --- Solution of the last solved frame, and the frame whose sources make up the catalog
+		wcs = None
+		reference_path = None
+		catalog = None
+
+		for frame_path, wcs_path in zip(frame_paths, wcs_paths):
+			name = os.path.basename(frame_path)
+
+			if os.path.isfile(wcs_path):
+				print('Skipping plate solve on frame', name)
+				statuses[name] = {'status': Solver.SKIPPED, 'time': 0., 'output': ''}
+
+				wcs = WCS(Reader.read_header(wcs_path))
+				reference_path = wcs_path
+				catalog = None
+				continue
+
+			status = None
+
+			if wcs is not None:
+				start = time.monotonic()
+
+				if catalog is None:
+					reference_data, reference_header = Reader.load_frame(reference_path)
+					reference_sources = Solver.extract_sources(reference_data, mask)
+
+					if reference_sources is not None:
+						catalog = wcs.pixel_to_world(reference_sources['xcentroid'], reference_sources['ycentroid'])
+
+				if catalog is not None:
+					frame_data, frame_header = Reader.load_frame(frame_path)
+					refined_wcs, residual, n_matched = Solver.refine_wcs(frame_data, wcs, catalog, mask, sip_degree)
+
+					if (refined_wcs is not None) and (residual <= Configuration.SOLVE_TRACK_TOLERANCE):
+						Solver.write_solution(frame_path, refined_wcs.to_header(relax=True), wcs_path + '.part')
+						os.replace(wcs_path + '.part', wcs_path)
+
+						wcs = refined_wcs
+						output = 'Matched {} sources with rms residual {:.2f} arcsec'.format(n_matched, residual)
+						status = {'status': Solver.TRACKED, 'time': time.monotonic() - start, 'output': output}
+
+					else:
+						print('Lost track on frame', name, '({} sources matched, rms residual {:.2f} arcsec)'.format(n_matched, residual))
+
+			if status is None:
+				status = Solver.solve_frame(frame_path, wcs_path, timeout, cpu_limit, mode, mask, indexes)
+				full_solves += 1
+
+				if status['status'] == Solver.SOLVED:
+					wcs = WCS(Reader.read_header(wcs_path))
+					reference_path = wcs_path
+					catalog = None
+
+			statuses[name] = status
+
+			if status['status'] == Solver.TRACKED:
+				print('Tracked frame', name, '-', status['output'])
+
+			elif status['status'] == Solver.SOLVED:
+				print('Plate solved frame', name, 'in', '%.1f' % status['time'], 's')
+
+			else:
+				print('Frame', name, 'did not solve', '(' + status['status'] + ')')
+
+		solved = sum(1 for status in statuses.values() if status['status'] not in (Solver.FAILED, Solver.TIMEOUT))
+		print('Solved', solved, 'of', len(statuses), 'frames with', full_solves, 'full solves')
+
+		return statuses
+
+	@staticmethod
+	def write_index_config(config_path, indexes, ra, dec, radius):
+		''' This function writes an astrometry.net backend configuration that loads only the index files covering a field, for solve-field --config.
+
+		:parameter config_path [string] - The path of the configuration
+		:parameter indexes [list] - The index files, as returned by read_indexes
+		:parameter ra [float] - The right ascension of the field [deg]
+		:parameter dec [float] - The declination of the field [deg]
+		:parameter radius [float] - The radius of the field [deg]
+
+		:return index_paths [list] - The paths of the index files in the configuration
+
+		'''
+
+		index_paths = Solver.select_indexes(indexes, ra, dec, radius)
+
+		if len(index_paths) == 0:
+			print('No index file covers the field at', ra, dec)
+
+		with open(config_path, 'w') as config_file:
+			config_file.write('inparallel\n')
+
+			for index_path in index_paths:
+				config_file.write('index ' + os.path.abspath(index_path) + '\n')
+
+		return index_paths
+
+	@staticmethod
+	def write_solution(frame_path, wcs_header, new_path):
+		''' This function writes a copy of a frame whose header carries a WCS solution, replacing any WCS the frame already had.
+
+		:parameter frame_path [string] - The path of the frame
+		:parameter wcs_header [Header] - The header of the WCS solution
+		:parameter new_path [string] - The path of the solved frame
+
+		'''
+
+		with Reader.open_frame(frame_path) as frame:
+			header = Solver.apply_solution(frame[0].header, wcs_header)
+
+			fits.PrimaryHDU(frame[0].data, header=header).writeto(new_path, overwrite=True)
+
+	@staticmethod
+	def write_xyls(sources, shape, xyls_path):
+		''' This function writes the positions of sources, brightest first, to an xyls table that solve-field can solve without reading the image.
+
+		:parameter sources [Table] - The sources, as returned by extract_sources, or None
+		:parameter shape [tuple] - The shape of the frame
+		:parameter xyls_path [string] - The path of the xyls table
+
+		:return n_sources [int] - The number of sources written
+
+		'''
+
+		xyls = Table(names=('X', 'Y', 'FLUX'), dtype=('f8', 'f8', 'f8'))
+
+		if sources is not None:
+			# --- solve-field expects FITS pixel coordinates, which start at 1
+			xyls = Table([sources['xcentroid'] + 1, sources['ycentroid'] + 1, sources['flux']], names=('X', 'Y', 'FLUX'))
+
+		xyls.meta['IMAGEW'] = shape[1]
+		xyls.meta['IMAGEH'] = shape[0]
+		xyls.write(xyls_path, format='fits', overwrite=True)
+
+		return len(xyls)
+
+	@staticmethod
+	def xy_to_nested(healpix, nside):
+		''' This function converts a HEALPix index from the xy scheme of astrometry.net, base * nside**2 + x * nside + y, to the nested scheme.
+
+		:parameter healpix [int] - The index in the xy scheme
+		:parameter nside [int] - The HEALPix nside
+
+		:return nested [int] - The index in the nested scheme
+
+		'''
+
+		base, xy = divmod(int(healpix), nside * nside)
+		x, y = divmod(xy, nside)
+
+		nested = 0
+		bit = 0
+
+		while (x > 0) or (y > 0):
+			nested |= ((x & 1) | ((y & 1) << 1)) << (2 * bit)
+			x >>= 1
+			y >>= 1
+			bit += 1
+
+		return base * nside * nside + nested
@@ -0,0 +1,414 @@
+from config import Configuration
+from libraries.aligner import Aligner
+from libraries.calibrator import Calibrator
+from libraries.combiner import Combiner
+from libraries.reader import Reader
+
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.stats import mad_std, sigma_clip, sigma_clipped_stats
+import numpy as np
+import os
+import warnings
+
+class Stacker:
+
+	# --- Per-pixel running accumulators kept next to the stack: (name, dtype)
+	ACCUMULATORS = [('count', 'int32'), ('mean', 'float64'), ('m2', 'float64'), ('median', 'float32')]
+
+	# --- States of the accumulators recorded on the first line of frames.txt
+	COMMITTED = '# committed'
+	OPEN = '# open'
+
+	# --- Gain of the stochastic median update, 1/(2 f(m)) for a Gaussian pixel distribution in units of sigma
+	MEDIAN_GAIN = 1.2533
+
+	# --- Stride of the pixel sample used for the background of a frame whose header has none
+	SAMPLE_STRIDE = 8
+
+	# --- Side of the central cutout used for the seeing of a frame whose header has none [pixels]
+	SEEING_CUTOUT = 1024
+
+	@staticmethod
+	def accumulate(accumulators, data):
+		''' This function adds one frame to the running accumulators. The mean and the sum of squared deviations are updated with Welford's algorithm, and the median with a stochastic approximation whose step shrinks as 1/n. Non-finite pixels are skipped.
+
+		:parameter accumulators [dictionary] - The count, mean, m2 and median arrays, updated in place
+		:parameter data [array] - The pixel values of the frame
+
+		'''
+
+		count = accumulators['count']
+		mean = accumulators['mean']
+		m2 = accumulators['m2']
+		median = accumulators['median']
+
+		valid = np.isfinite(data)
+		values = np.where(valid, data, 0.)
+
+		count += valid
+
+		delta = np.where(valid, values - mean, 0.)
+		mean += delta / np.maximum(count, 1)
+		m2 += delta * np.where(valid, values - mean, 0.)
+
+		first = valid & (count == 1)
+		median[first] = values[first]
+
+		later = valid & (count > 1)
+		sigma = np.sqrt(m2 / np.maximum(count - 1, 1))
+		step = Stacker.MEDIAN_GAIN * sigma / np.maximum(count, 1)
+		median += np.where(later, step * np.sign(values - median), 0.).astype(median.dtype)
+
+	@staticmethod
+	def accumulator_paths(acc_dir):
+		''' This function returns the paths of the accumulators of a stack.
+
+		:parameter acc_dir [string] - The directory of the accumulators
+
+		:return acc_paths [dictionary] - The path of every accumulator
+
+		'''
+
+		return {name: os.path.join(acc_dir, name + '.npy') for name, dtype in Stacker.ACCUMULATORS}
+
+	@staticmethod
+	def close_accumulators(acc_dir, accumulators, frames):
+		''' This function commits the accumulators of a stack: they are flushed to disk, and frames.txt is then replaced atomically with the list of the frames they hold, marked as committed.
+
+		:parameter acc_dir [string] - The directory of the accumulators
+		:parameter accumulators [dictionary] - The accumulator arrays
+		:parameter frames [list] - The names of the frames accumulated
+
+		'''
+
+		for accumulator in accumulators.values():
+			accumulator.flush()
+
+		Stacker.write_frames(acc_dir, frames, Stacker.COMMITTED)
+
+	@staticmethod
+	def frame_quality(frame_path):
+		''' This function returns the quality of an aligned frame: its background level and rms, its seeing and its exposure time. The values written to the header during the reduction are used when present; otherwise the background is measured on a strided sample of the pixels and the seeing on a central cutout, so the frame is never read in full.
+
+		:parameter frame_path [string] - The path of the aligned frame
+
+		:return quality [dictionary] - The background, rms, fwhm and exposure of the frame
+
+		'''
+
+		header = Reader.read_header(frame_path)
+
+		background = header.get('BKGMED')
+		rms = header.get('BKGRMS')
+		fwhm = header.get('FWHM')
+
+		if (background is None) or (rms is None) or (fwhm is None):
+			with fits.open(frame_path, memmap=True) as frame:
+				frame_data = frame[0].data
+
+				if (background is None) or (rms is None):
+					sample = np.array(frame_data[::Stacker.SAMPLE_STRIDE, ::Stacker.SAMPLE_STRIDE], dtype=Configuration.DTYPE)
+					mean, background, rms = sigma_clipped_stats(sample, sigma=Configuration.SIGMA_BKG)
+
+				if fwhm is None:
+					y0 = max(0, (frame_data.shape[0] - Stacker.SEEING_CUTOUT) // 2)
+					x0 = max(0, (frame_data.shape[1] - Stacker.SEEING_CUTOUT) // 2)
+					cutout = np.array(frame_data[y0:y0+Stacker.SEEING_CUTOUT, x0:x0+Stacker.SEEING_CUTOUT], dtype=Configuration.DTYPE)
+					fwhm = Aligner.measure_fwhm(cutout)
+
+		exposure = Calibrator.read_exposure(header)
+
+		if exposure is None:
+			exposure = 1.
+
+		quality = {'background': float(background), 'rms': float(rms), 'fwhm': float(fwhm), 'exposure': exposure}
+
+		return quality
+
+	@staticmethod
+	def frame_weights(qualities, weighting=None, reject=None):
+		''' This function returns the relative weights of the frames of a stack. The 'variance' weighting is the inverse of the background variance, and the 'seeing' weighting further divides it by the square of the FWHM, which is proportional to the signal-to-noise ratio squared of a point source. Frames whose background level is more than reject robust standard deviations above the median of the frames get zero weight, as do frames whose quality could not be measured.
+
+		:parameter qualities [list] - The quality of every frame, as returned by frame_quality
+		:parameter weighting [string] - The weighting (none, variance or seeing); the default is Configuration.STACK_WEIGHTING
+		:parameter reject [float] - The background rejection threshold; the default is Configuration.STACK_REJECT
+
+		:return weights [array] - The weights, normalized to a maximum of one
+
+		'''
+
+		weighting = weighting or Configuration.STACK_WEIGHTING
+		reject = reject or Configuration.STACK_REJECT
+
+		if weighting not in ('none', 'variance', 'seeing'):
+			raise ValueError('Unknown stack weighting {} (must be one of none, variance, seeing)'.format(weighting))
+
+		background = np.array([quality['background'] for quality in qualities])
+		rms = np.array([quality['rms'] for quality in qualities])
+		fwhm = np.array([quality['fwhm'] for quality in qualities])
+
+		weights = np.ones(len(qualities))
+
+		with np.errstate(divide='ignore', invalid='ignore'):
+			if weighting in ('variance', 'seeing'):
+				weights = weights / rms**2
+
+			if weighting == 'seeing':
+				weights = weights / fwhm**2
+
+		weights[~np.isfinite(weights) | (weights < 0)] = 0.
+
+		spread = mad_std(background)
+		if spread > 0:
+			weights[background > np.median(background) + reject * spread] = 0.
+
+		if np.max(weights) > 0:
+			weights = weights / np.max(weights)
+
+		return weights
+
+	@staticmethod
+	def open_accumulators(acc_dir, shape):
+		''' This function opens the accumulators of a stack as memory maps that frames are added to in place, so an update costs the pixels of the new frames only. frames.txt is marked as open before any accumulator changes and only marked as committed again by close_accumulators, so accumulators left open by a crash, which may hold part of a frame, are never reused: the stack starts over and every frame is added again.
+
+		:parameter acc_dir [string] - The directory of the accumulators
+		:parameter shape [tuple] - The shape of the frames
+
+		:return accumulators [dictionary] - The accumulator arrays
+		:return frames [list] - The names of the frames already accumulated
+
+		'''
+
+		os.makedirs(acc_dir, exist_ok=True)
+
+		frames_path = os.path.join(acc_dir, 'frames.txt')
+		acc_paths = Stacker.accumulator_paths(acc_dir)
+		frames = []
+
+		if os.path.isfile(frames_path):
+			with open(frames_path) as frames_file:
+				lines = frames_file.read().splitlines()
+
+			if (len(lines) > 0) and (lines[0] == Stacker.COMMITTED):
+				frames = [line for line in lines[1:] if line]
+
+			else:
+				print('Accumulators of', acc_dir, 'were not committed, restarting the stack')
+
+		# --- Start over unless every committed accumulator is present
+		if (len(frames) > 0) and not all(os.path.isfile(acc_path) for acc_path in acc_paths.values()):
+			frames = []
+
+		Stacker.write_frames(acc_dir, frames, Stacker.OPEN)
+
+		accumulators = {}
+
+		for name, dtype in Stacker.ACCUMULATORS:
+
+			if len(frames) > 0:
+				accumulator = np.lib.format.open_memmap(acc_paths[name], mode='r+')
+
+				if accumulator.shape != tuple(shape):
+					raise ValueError('Accumulator {} has shape {} but the frames have shape {}'.format(acc_paths[name], accumulator.shape, shape))
+
+			else:
+				accumulator = np.lib.format.open_memmap(acc_paths[name], mode='w+', dtype=dtype, shape=tuple(shape))
+				accumulator[:] = 0
+
+			accumulators[name] = accumulator
+
+		return accumulators, frames
+
+	@staticmethod
+	def read_stack(accumulators, header, n_frames, method=None):
+		''' This function returns the stack held by the accumulators.
+
+		:parameter accumulators [dictionary] - The accumulator arrays
+		:parameter header [Header] - The header of the stack
+		:parameter n_frames [int] - The number of frames accumulated
+		:parameter method [string] - The combine method (median or average); the default is Configuration.COMBINE_METHOD
+
+		:return stack [CCDData] - The stack, NaN where no frame contributed
+
+		'''
+
+		method = method or Configuration.COMBINE_METHOD
+
+		if method == 'median':
+			stack_data = np.array(accumulators['median'], dtype=Configuration.DTYPE)
+
+		else:
+			stack_data = np.array(accumulators['mean'], dtype=Configuration.DTYPE)
+
+		stack_data[accumulators['count'] == 0] = np.nan
+
+		header = header.copy()
+		header['NCOMBINE'] = n_frames
+
+		stack = CCDData(stack_data, unit='adu', meta=header)
+
+		return stack
+
+	@staticmethod
+	def update_stack(align_dir, stack_list, method=None):
+		''' This function adds the frames of stack_list that are not yet in the accumulators of the stack and returns the updated stack. Adding N new frames costs O(N) regardless of how many frames the stack already holds. The frames are added in place and committed once all of them are in; an interrupted update leaves the accumulators open, and the next update rebuilds the stack from all of its frames.
+
+		:parameter align_dir [string] - The directory of the aligned frames
+		:parameter stack_list [list] - The names of the aligned frames
+		:parameter method [string] - The combine method (median or average); the default is Configuration.COMBINE_METHOD
+
+		:return stack [CCDData] - The updated stack
+
+		'''
+
+		acc_dir = os.path.join(align_dir, 'stack-acc')
+
+		if len(stack_list) == 0:
+			raise ValueError('No aligned frames to stack in {}'.format(align_dir))
+
+		first_header = Reader.read_header(os.path.join(align_dir, stack_list[0]))
+		shape = (first_header['NAXIS2'], first_header['NAXIS1'])
+
+		accumulators, frames = Stacker.open_accumulators(acc_dir, shape)
+
+		new_frames = [item for item in stack_list if item not in frames]
+		print('Adding', len(new_frames), 'frames to a stack of', len(frames))
+
+		for item in new_frames:
+			frame_data, frame_header = Reader.load_frame(os.path.join(align_dir, item))
+			Stacker.accumulate(accumulators, frame_data)
+			frames.append(item)
+
+		Stacker.close_accumulators(acc_dir, accumulators, frames)
+
+		stack = Stacker.read_stack(accumulators, first_header, len(frames), method)
+
+		return stack
+
+	@staticmethod
+	def weighted_stack(align_dir, stack_list, weighting=None, sigma=None, mem_limit=None):
+		''' This function combines the aligned frames into a weighted mean in one streaming pass. The frames are weighted by their quality, frames with a deviant background are rejected, and every strip is sigma-clipped along the frame axis before the weighted mean is taken, so each pixel of each frame is read once. The per-pixel sum of the weights and of the exposure times of the frames that were not clipped are returned with the stack.
+
+		:parameter align_dir [string] - The directory of the aligned frames
+		:parameter stack_list [list] - The names of the aligned frames
+		:parameter weighting [string] - The weighting (none, variance or seeing); the default is Configuration.STACK_WEIGHTING
+		:parameter sigma [float] - The clipping threshold; the default is Configuration.SIGMA_BKG
+		:parameter mem_limit [float] - The upper limit on the memory used for the strips [bytes]; the default is Configuration.MEM_LIMIT
+
+		:return stack [CCDData] - The stack
+		:return exposure_map [array] - The exposure time of every pixel [s]
+		:return weight_map [array] - The sum of the weights of every pixel
+
+		'''
+
+		weighting = weighting or Configuration.STACK_WEIGHTING
+		sigma = sigma or Configuration.SIGMA_BKG
+		mem_limit = mem_limit or Configuration.MEM_LIMIT
+		dtype = np.dtype(Configuration.DTYPE)
+
+		if len(stack_list) == 0:
+			raise ValueError('No frames to stack')
+
+		frame_paths = [os.path.join(align_dir, item) for item in stack_list]
+		qualities = [Stacker.frame_quality(frame_path) for frame_path in frame_paths]
+		weights = Stacker.frame_weights(qualities, weighting)
+
+		for item, quality, weight in zip(stack_list, qualities, weights):
+			if weight == 0:
+				print('Rejected frame', item, '(background', '%.1f' % quality['background'] + ', rms', '%.1f' % quality['rms'] + ', fwhm', '%.2f' % quality['fwhm'] + ')')
+
+		used = np.flatnonzero(weights > 0)
+		if len(used) == 0:
+			raise ValueError('Every frame of the stack was rejected')
+
+		frame_weights = weights[used].astype(dtype)[:, np.newaxis, np.newaxis]
+		frame_exposures = np.array([qualities[index]['exposure'] for index in used], dtype=dtype)[:, np.newaxis, np.newaxis]
+
+		frames = [fits.open(frame_paths[index], memmap=True, do_not_scale_image_data=True) for index in used]
+
+		try:
+			shape = frames[0][0].data.shape
+			for index, frame in zip(used, frames):
+				if frame[0].data.shape != shape:
+					raise ValueError('Frame {} has shape {} but expected {}'.format(stack_list[index], frame[0].data.shape, shape))
+
+			strip_height = min(shape[0], Combiner.strip_height(len(frames), shape[1], dtype.itemsize, mem_limit))
+			print('Stacking', len(frames), 'of', len(stack_list), 'frames with', weighting, 'weights in strips of', strip_height, 'rows')
+
+			stack_data = np.empty(shape, dtype=dtype)
+			exposure_map = np.empty(shape, dtype=dtype)
+			weight_map = np.empty(shape, dtype=dtype)
+			strip = np.empty((len(frames), strip_height, shape[1]), dtype=dtype)
+
+			for y0 in range(0, shape[0], strip_height):
+				y1 = min(y0 + strip_height, shape[0])
+				rows = slice(y0, y1)
+				cube = strip[:, 0:y1-y0]
+
+				for index, frame in enumerate(frames):
+					Combiner.read_strip(frame[0], rows, cube[index])
+
+				# --- Pixels outside the footprint of a frame are NaN and leave all-NaN slices where no frame covers the sky
+				with warnings.catch_warnings():
+					warnings.simplefilter('ignore', RuntimeWarning)
+					clipped = sigma_clip(cube, sigma=sigma, maxiters=5, cenfunc='median', stdfunc='std', axis=0, masked=False, copy=False)
+
+				valid = np.isfinite(clipped)
+				weight_map[rows] = np.sum(frame_weights * valid, axis=0)
+				exposure_map[rows] = np.sum(frame_exposures * valid, axis=0)
+
+				weighted_sum = np.sum(np.where(valid, clipped * frame_weights, 0.), axis=0)
+				stack_data[rows] = np.nan
+				np.divide(weighted_sum, weight_map[rows], out=stack_data[rows], where=weight_map[rows] > 0)
+
+			header = frames[0][0].header.copy()
+
+		finally:
+			for frame in frames:
+				frame.close()
+
+		for key in ('BZERO', 'BSCALE', 'BLANK', 'BKGMED', 'BKGRMS', 'FWHM'):
+			header.remove(key, ignore_missing=True)
+		header['NCOMBINE'] = len(frames)
+		header['WEIGHTNG'] = weighting
+
+		stack = CCDData(stack_data, unit='adu', meta=header)
+
+		return stack, exposure_map, weight_map
+
+	@staticmethod
+	def variance(accumulators):
+		''' This function returns the per-pixel sample variance of the accumulated frames.
+
+		:parameter accumulators [dictionary] - The accumulator arrays
+
+		:return variance [array] - The sample variance, NaN where fewer than two frames contributed
+
+		'''
+
+		count = accumulators['count']
+
+		variance = np.full(count.shape, np.nan)
+		np.divide(accumulators['m2'], count - 1, out=variance, where=count > 1)
+
+		return variance
+
+	@staticmethod
+	def write_frames(acc_dir, frames, state):
+		''' This function replaces frames.txt atomically with the state of the accumulators and the list of the frames they hold.
+
+		:parameter acc_dir [string] - The directory of the accumulators
+		:parameter frames [list] - The names of the frames accumulated
+		:parameter state [string] - The state line, Stacker.COMMITTED or Stacker.OPEN
+
+		'''
+
+		frames_path = os.path.join(acc_dir, 'frames.txt')
+
+		with open(frames_path + '.tmp', 'w') as frames_file:
+			frames_file.write('\n'.join([state] + frames))
+			frames_file.flush()
+			os.fsync(frames_file.fileno())
+
+		os.replace(frames_path + '.tmp', frames_path)
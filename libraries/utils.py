@@ -241,6 +241,11 @@ class Utils:
 		if not os.path.exists(analysis_gw_galaxies_dir):
 			os.mkdir(analysis_gw_galaxies_dir)
 
+		# cache
+		cache_dir = os.path.join(main_dir, 'cache/')
+		if not os.path.exists(cache_dir):
+			os.mkdir(cache_dir)
+
 		# logs
 		log_dir = os.path.join(main_dir, 'logs/')
 		if not os.path.exists(log_dir):
@@ -1,4 +1,6 @@
 from config import Configuration
+from libraries.librarian import Librarian
+from libraries.priority import Priority
 from libraries.reducer import Reducer
 from libraries.utils import Utils
 
@@ -13,21 +15,24 @@ os.system('clear')
 print('Running quick reduction')
 start_time = time.time()
 
-dark_dir = os.path.join(Configuration.WORKING_DIR, 'dark')
-dark_flat_dir = os.path.join(dark_dir, 'flat')
-dark_light_dir = os.path.join(dark_dir, 'light')
-flat_dir = os.path.join(Configuration.WORKING_DIR, 'flat')
 light_dir = os.path.join(Configuration.WORKING_DIR, Configuration.OBJECT)
 
 raw_dir, cal_dir, wcs_dir, align_dir = Utils.create_directories(light_dir)
 
-Reducer.make_dark(dark_flat_dir)
-Reducer.make_dark(dark_light_dir)
-Reducer.make_flat(flat_dir, dark_flat_dir)
-Reducer.reduce_objects(light_dir, flat_dir, dark_light_dir, bkg_method=Configuration.BKG_METHOD)
-Reducer.solve_plates(light_dir)
-Reducer.align_frames(light_dir)
-Reducer.make_stack(light_dir)
+calibrations = Librarian.match_frames(light_dir, night_dir=Configuration.WORKING_DIR)
+
+fields = None
+if Configuration.ALIGN_REFERENCE == 'field':
+	fields = Priority.field_generator(Configuration.FIELD_SIZE)
+
+if Configuration.PIPELINE_STREAM:
+	Reducer.stream_objects(light_dir, bkg_method=Configuration.BKG_METHOD, calibrations=calibrations, reference=Configuration.ALIGN_REFERENCE, fields=fields)
+
+else:
+	Reducer.reduce_objects(light_dir, bkg_method=Configuration.BKG_METHOD, calibrations=calibrations)
+	Reducer.solve_plates(light_dir)
+	Reducer.align_frames(light_dir, reference=Configuration.ALIGN_REFERENCE, fields=fields)
+	Reducer.make_stack(light_dir)
 
 end_time = time.time()
 total_time = end_time - start_time
@@ -1,5 +1,6 @@
 import pytest
 import os
+import stat
 from pathlib import Path
 
 import numpy as np
@@ -107,3 +108,41 @@ def example_header_with_wcs():
 def example_hdu(data = example_ccd_data()):
     hdu = fits.PrimaryHDU(data, example_header_with_wcs())
     return hdu
+
+FAKE_SOLVE_FIELD = '''#!/usr/bin/env python3
+import os, shutil, sys, time
+args = sys.argv[1:]
+out_dir = args[args.index('--dir') + 1]
+out_name = args[args.index('--out') + 1]
+frame = args[-1]
+if 'slow' in frame:
+    time.sleep(30)
+if 'bad' in frame:
+    print('Did not solve (or no WCS file was written).')
+    sys.exit(0)
+from astropy.io import fits
+header = fits.Header({'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRVAL1': 326.1, 'CRVAL2': 38.6, 'CRPIX1': 50.0, 'CRPIX2': 50.0, 'CD1_1': -0.0002, 'CD2_2': 0.0002})
+fits.PrimaryHDU(header=header).writeto(os.path.join(out_dir, out_name + '.wcs'))
+if frame.endswith('.xyls'):
+    from astropy.table import Table
+    xyls = Table.read(frame)
+    with open(os.path.join(out_dir, '..', 'args.txt'), 'w') as args_file:
+        args_file.write(' '.join(args) + ' ' + str(len(xyls)))
+else:
+    shutil.copyfile(frame, os.path.join(out_dir, out_name + '.new'))
+if 'FAKE_ARGS' in os.environ:
+    with open(os.environ['FAKE_ARGS'], 'a') as args_file:
+        args_file.write(' '.join(args) + '\\n')
+for ext in ('.solved', '.axy', '.corr', '.match', '.rdls', '-indx.xyls'):
+    open(os.path.join(out_dir, out_name + ext), 'w').close()
+'''
+
+@pytest.fixture
+def fake_solver(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'solve-field'
+    script.write_text(FAKE_SOLVE_FIELD)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    return bin_dir
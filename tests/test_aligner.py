@@ -0,0 +1,92 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from libraries.aligner import Aligner
+from photutils.datasets import make_100gaussians_image
+from reproject import reproject_interp
+
+def make_header(crpix=(250., 150.), angle=0.):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [326.1413, 38.5948]
+    wcs.wcs.crpix = list(crpix)
+    scale = 0.6305 / 3600
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    wcs.wcs.cd = [[-scale * c, scale * s], [scale * s, scale * c]]
+    header = wcs.to_header()
+    header['NAXIS1'] = 500
+    header['NAXIS2'] = 300
+    return header
+
+@pytest.mark.parametrize('crpix, angle, expected', [((252.3, 148.6), 0., 'shift'), ((252.3, 148.6), 0.2, 'affine')])
+def test_align_matches_reproject(crpix, angle, expected):
+    data = make_100gaussians_image().astype(np.float32)[:300, :500]
+    reference_header = make_header()
+    target_header = make_header(crpix, angle)
+    aligned, kind = Aligner.align(data, target_header, reference_header)
+    assert kind == expected
+    assert aligned.dtype == np.float32
+    expected_data, footprint = reproject_interp((data, WCS(target_header)), WCS(reference_header), shape_out=data.shape)
+    valid = np.isfinite(aligned) & np.isfinite(expected_data)
+    assert valid.sum() > 0.9 * data.size
+    assert np.allclose(aligned[valid], expected_data[valid], rtol=1e-3, atol=0.05)
+
+def test_fit_transform_distortion():
+    reference_header = make_header()
+    target_header = make_header()
+    target_header['CTYPE1'] = 'RA---TAN-SIP'
+    target_header['CTYPE2'] = 'DEC--TAN-SIP'
+    target_header['A_ORDER'] = 2
+    target_header['A_2_0'] = 1e-5
+    target_header['B_ORDER'] = 2
+    target_header['B_0_2'] = 1e-5
+    kind, matrix, offset = Aligner.fit_transform(WCS(target_header), WCS(reference_header), (300, 500))
+    assert kind == 'reproject'
+
+def test_reproject_blocks():
+    data = make_100gaussians_image().astype(np.float32)[:300, :500]
+    reference_header = make_header()
+    target_header = make_header((252.3, 148.6), 0.2)
+    target_header['CTYPE1'] = 'RA---TAN-SIP'
+    target_header['CTYPE2'] = 'DEC--TAN-SIP'
+    target_header['A_ORDER'] = 2
+    target_header['A_2_0'] = 1e-5
+    target_header['B_ORDER'] = 2
+    target_header['B_0_2'] = 1e-5
+    reference_header = fits.Header(reference_header)
+    reference_header['CTYPE1'] = 'RA---TAN-SIP'
+    reference_header['CTYPE2'] = 'DEC--TAN-SIP'
+    reference_header['A_ORDER'] = 2
+    reference_header['A_1_1'] = 2e-6
+    reference_header['B_ORDER'] = 2
+    reference_header['B_1_1'] = 2e-6
+    target_hdu = fits.PrimaryHDU(data, header=target_header)
+    expected, footprint = reproject_interp(target_hdu, reference_header, shape_out=data.shape)
+    aligned, aligned_footprint = Aligner.reproject(target_hdu, reference_header, block_rows=64, return_footprint=True)
+    assert np.allclose(aligned, expected, equal_nan=True, rtol=1e-6, atol=1e-4)
+    assert np.array_equal(aligned_footprint, footprint)
+    assert np.array_equal(Aligner.reproject(target_hdu, reference_header, block_rows=64), aligned, equal_nan=True)
+
+def test_select_reference(tmp_path):
+    import pandas as pd
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:300, 0:500]
+    stars = rng.uniform(20, 280, size=(30, 2))
+    for i, sigma in enumerate((3.0, 1.5, 2.5)):
+        data = rng.normal(100., 2., size=(300, 500))
+        for x, y in stars:
+            data += 1000. * np.exp(-((xx - x)**2 + (yy - y)**2) / (2 * sigma**2))
+        header = make_header()
+        del header['NAXIS1'], header['NAXIS2']
+        fits.PrimaryHDU(data, header=header).writeto(tmp_path / f'wcs-{i}.fit')
+    names = ['wcs-0.fit', 'wcs-1.fit', 'wcs-2.fit']
+    assert Aligner.select_reference(tmp_path, names, 'first')[0] == 'wcs-0.fit'
+    assert Aligner.select_reference(tmp_path, names, 'seeing')[0] == 'wcs-1.fit'
+    fields = pd.DataFrame({'field_id': ['01.001', '01.002'], 'ra': [326.2, 10.0], 'dec': [38.6, -20.0]})
+    name, header = Aligner.select_reference(tmp_path, names, 'field', fields)
+    assert name is None
+    assert header['REFFRAME'] == 'field 01.001'
+    assert header['CRVAL1'] == pytest.approx(326.2)
+    assert header['CRPIX1'] == pytest.approx(250.5)
@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+
+from libraries.background import Background
+from photutils.datasets import make_4gaussians_image
+
+def make_frame(seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:200, 0:300]
+    data = np.zeros((200, 300), dtype=np.float32)
+    data[50:150, 50:250] = make_4gaussians_image() - 5.0
+    data += 100.0 + 0.05 * xx + rng.normal(0., 2., size=(200, 300))
+    return data, 100.0 + 0.05 * xx
+
+def test_mesh_background():
+    data, truth = make_frame()
+    bkg, mask = Background.estimate(data, estimator='mesh')
+    assert mask is not None and mask.any()
+    assert bkg.background.shape == data.shape
+    assert np.median(np.abs(bkg.background - truth)) < 1.0
+    assert bkg.background_rms_median == pytest.approx(2.0, rel=0.2)
+
+def test_background2d_uses_mask():
+    data, truth = make_frame()
+    bkg, mask = Background.estimate(data, estimator='background2d')
+    assert bkg.mask is not None
+    assert np.median(np.abs(bkg.background - truth)) < 1.0
+
+def test_mesh_warm_start():
+    data, truth = make_frame()
+    cold, mask = Background.estimate(data, estimator='mesh')
+    data, truth = make_frame(seed=1)
+    warm, mask = Background.estimate(data, estimator='mesh', previous=cold)
+    assert mask is not None
+    assert np.median(np.abs(warm.background - truth)) < 1.0
+
+def test_mesh_gradient_under_mask():
+    rng = np.random.default_rng(2)
+    yy, xx = np.mgrid[0:200, 0:300]
+    truth = 100.0 + 0.2 * xx
+    data = (truth + rng.normal(0., 2., size=truth.shape)).astype(np.float32)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[50:150, 200:250] = True
+    bkg = Background.mesh(data, mask)
+    assert np.max(np.abs(bkg.background_mesh[1:3, 4] - truth[0, [225]])) < 3.0
+    assert np.median(np.abs(bkg.background - truth)[mask]) < 3.0
+
+def test_no_sources():
+    data = np.random.default_rng(1).normal(100., 2., size=(100, 100))
+    bkg, mask = Background.estimate(data, estimator='mesh')
+    assert mask is None
+    assert bkg.background_median == pytest.approx(100.0, abs=0.5)
+
+def test_warm_start_level_shift(capsys):
+    data, truth = make_frame()
+    cold, mask = Background.estimate(data, estimator='mesh')
+    data, truth = make_frame(seed=1)
+    for estimator in ('mesh', 'background2d'):
+        warm, mask = Background.estimate(data + 20.0, estimator=estimator, previous=cold)
+        assert np.median(np.abs(warm.background - truth - 20.0)) < 1.0
+    out, err = capsys.readouterr()
+    assert out.lower().count('without warm start') == 2
+
+def test_warm_start_fallback(monkeypatch, capsys):
+    data, truth = make_frame()
+    cold, mask = Background.estimate(data, estimator='mesh')
+    monkeypatch.setattr(Background, 'LEVEL_TOLERANCE', np.inf)
+    warm, mask = Background.estimate(make_frame(seed=1)[0] + 20.0, estimator='mesh', previous=cold)
+    assert np.median(np.abs(warm.background - truth - 20.0)) < 1.0
+    out, err = capsys.readouterr()
+    assert 'estimating without it' in out.lower()
@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from libraries.calibrator import Calibrator
+
+def test_calibrator(tmp_path):
+    fits.PrimaryHDU(np.full((10, 20), 2.0)).writeto(tmp_path / 'dark.fit')
+    fits.PrimaryHDU(np.full((10, 20), 0.5)).writeto(tmp_path / 'flat.fit')
+    calibrator = Calibrator(tmp_path / 'dark.fit', tmp_path / 'flat.fit')
+    assert calibrator.dark_data.dtype == np.float32
+    assert not calibrator.dark_data.flags.writeable
+    reduced = calibrator.calibrate(np.full((10, 20), 12.0))
+    assert np.allclose(reduced, 20.0)
+
+def test_calibrator_shape_mismatch(tmp_path):
+    fits.PrimaryHDU(np.ones((10, 20))).writeto(tmp_path / 'dark.fit')
+    fits.PrimaryHDU(np.ones((20, 10))).writeto(tmp_path / 'flat.fit')
+    with pytest.raises(ValueError):
+        Calibrator(tmp_path / 'dark.fit', tmp_path / 'flat.fit')
+
+def test_calibrator_exposure_scaling(tmp_path):
+    dark_header = fits.Header({'EXPOSURE': 60.0})
+    fits.PrimaryHDU(np.full((10, 20), 6.0), header=dark_header).writeto(tmp_path / 'dark.fit')
+    fits.PrimaryHDU(np.ones((10, 20))).writeto(tmp_path / 'flat.fit')
+    calibrator = Calibrator(tmp_path / 'dark.fit', tmp_path / 'flat.fit')
+    reduced = calibrator.calibrate(np.full((10, 20), 100, dtype=np.uint16), exposure=30.0)
+    assert reduced.dtype == np.float32
+    assert np.allclose(reduced, 97.0)
+
+def test_calibrator_scaled_darks(tmp_path):
+    dark_header = fits.Header({'EXPOSURE': 60.0})
+    fits.PrimaryHDU(np.full((10, 20), 6.0), header=dark_header).writeto(tmp_path / 'dark.fit')
+    fits.PrimaryHDU(np.ones((10, 20))).writeto(tmp_path / 'flat.fit')
+    calibrator = Calibrator(tmp_path / 'dark.fit', tmp_path / 'flat.fit')
+    exposures = [float(exposure) for exposure in range(1, Calibrator.SCALED_DARKS + 3)]
+    for exposure in exposures:
+        assert np.allclose(calibrator.scale_dark(exposure), exposure / 10.)
+    assert list(calibrator.scaled_darks) == exposures[-Calibrator.SCALED_DARKS:]
+
+def test_calibrator_repair(tmp_path, monkeypatch):
+    from config import Configuration
+    from libraries.masker import Masker
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path))
+    flags = np.zeros((10, 20), dtype=np.uint8)
+    flags[0, 0] = flags[4, 5] = flags[4, 6] = Masker.HOT
+    Masker.update_bpm(Configuration.CAMERA, 1, flags, Masker.HOT)
+    fits.PrimaryHDU(np.zeros((10, 20))).writeto(tmp_path / 'dark.fit')
+    fits.PrimaryHDU(np.ones((10, 20))).writeto(tmp_path / 'flat.fit')
+    calibrator = Calibrator(tmp_path / 'dark.fit', tmp_path / 'flat.fit')
+    frame = np.arange(200, dtype=float).reshape(10, 20)
+    frame[0, 0] = frame[4, 5] = frame[4, 6] = 1e5
+    reduced = calibrator.calibrate(frame)
+    assert reduced[4, 5] == np.median([64, 65, 66, 84, 104, 105, 106])
+    assert reduced[0, 0] == np.median([1, 20, 21])
+    assert reduced[4, 6] < 1e3
@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from libraries.combiner import Combiner
+
+def make_frames(tmp_path, n=5, shape=(40, 30)):
+    rng = np.random.default_rng(0)
+    frame_list = []
+    cube = []
+    for i in range(n):
+        data = rng.integers(1000, 60000, size=shape).astype(np.uint16)
+        path = tmp_path / f'frame-{i}.fit'
+        fits.PrimaryHDU(data).writeto(path)
+        frame_list.append(str(path))
+        cube.append(data.astype(np.float64))
+    return frame_list, np.array(cube)
+
+@pytest.mark.parametrize('method', ['median', 'average'])
+def test_combine_strips(tmp_path, method):
+    frame_list, cube = make_frames(tmp_path)
+    combined = Combiner.combine(frame_list, method=method, mem_limit=5*30*4*4*7)
+    expected = np.median(cube, axis=0) if method == 'median' else np.mean(cube, axis=0)
+    assert combined.header['NCOMBINE'] == len(frame_list)
+    assert np.allclose(combined.data, expected, rtol=1e-6)
+
+def test_combine_sigma_clip(tmp_path):
+    frame_list, cube = make_frames(tmp_path, n=9)
+    inliers = np.arange(1000, 1008)
+    for path, value in zip(frame_list, [60000] + list(inliers)):
+        with fits.open(path, mode='update') as frame:
+            frame[0].data[0, 0] = value
+    combined = Combiner.combine(frame_list, method='sigma_clip', sigma=2.0)
+    assert combined.data.shape == cube.shape[1:]
+    assert np.all(np.isfinite(combined.data))
+    assert combined.data[0, 0] == pytest.approx(np.mean(inliers))
+
+def test_combine_bad_method(tmp_path):
+    frame_list, cube = make_frames(tmp_path, n=2)
+    with pytest.raises(ValueError):
+        Combiner.combine(frame_list, method='mode')
@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from libraries.drizzler import Drizzler
+
+def make_header(crpix=(40., 30.), angle=0.):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [326.1413, 38.5948]
+    wcs.wcs.crpix = list(crpix)
+    scale = 0.6305 / 3600
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    wcs.wcs.cd = [[-scale * c, scale * s], [scale * s, scale * c]]
+    header = wcs.to_header()
+    header['NAXIS1'] = 80
+    header['NAXIS2'] = 60
+    return header
+
+def star_frame(header, ra, dec, flux=1e4, sigma=1.2):
+    x, y = WCS(header).world_to_pixel_values(ra, dec)
+    yy, xx = np.mgrid[0:60, 0:80]
+    return flux / (2 * np.pi * sigma**2) * np.exp(-((xx - x)**2 + (yy - y)**2) / (2 * sigma**2))
+
+def test_output_header():
+    reference_header = make_header()
+    output_header = Drizzler.output_header(reference_header, scale=0.5)
+    assert (output_header['NAXIS1'], output_header['NAXIS2']) == (160, 120)
+    corner = WCS(reference_header).pixel_to_world_values(-0.5, -0.5)
+    assert np.allclose(WCS(output_header).world_to_pixel_values(*corner), (-0.5, -0.5), atol=1e-6)
+
+def test_drizzle(tmp_path):
+    ra, dec = WCS(make_header()).pixel_to_world_values(40.3, 28.7)
+    frame_paths = []
+    for i, (crpix, angle) in enumerate([((40., 30.), 0.), ((40.5, 29.5), 0.), ((41.2, 30.3), 0.5)]):
+        header = make_header(crpix, angle)
+        frame_path = tmp_path / f'wcs-{i}.fit'
+        del header['NAXIS1'], header['NAXIS2']
+        fits.PrimaryHDU(star_frame(header, ra, dec).astype(np.float32), header=header).writeto(frame_path)
+        frame_paths.append(str(frame_path))
+    output_header = Drizzler.output_header(make_header(), scale=0.5)
+    Drizzler.drizzle(frame_paths, output_header, tmp_path / 'd.fit', tmp_path / 'w.fit', pixfrac=0.8, block_rows=13)
+    drizzled = fits.getdata(tmp_path / 'd.fit')
+    weights = fits.getdata(tmp_path / 'w.fit')
+    assert drizzled.shape == (120, 160)
+    assert np.nansum(drizzled) == pytest.approx(1e4, rel=0.02)
+    assert np.mean(weights[20:100, 20:140]) == pytest.approx(3 * 0.5**2, rel=0.01)
+    assert np.all(weights[20:100, 20:140] > 0)
+    x, y = WCS(fits.getheader(tmp_path / 'd.fit')).world_to_pixel_values(ra, dec)
+    peak = np.unravel_index(np.nanargmax(drizzled), drizzled.shape)
+    assert abs(peak[0] - y) <= 1 and abs(peak[1] - x) <= 1
+    Drizzler.drizzle(frame_paths, output_header, tmp_path / 'd.fit', tmp_path / 'w.fit', pixfrac=0.8, block_rows=200)
+    assert np.allclose(fits.getdata(tmp_path / 'd.fit'), drizzled, equal_nan=True, atol=1e-3)
@@ -0,0 +1,63 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from photutils.datasets import make_4gaussians_image
+from config import Configuration
+from libraries.librarian import Librarian
+from libraries.reducer import Reducer
+
+def write_frame(path, imagetyp, exptime, value, filter='r', temp=-10.0):
+    header = fits.Header()
+    header['IMAGETYP'] = imagetyp
+    header['EXPTIME'] = exptime
+    header['EXPOSURE'] = exptime
+    header['XBINNING'] = 1
+    header['FILTER'] = filter
+    header['CCD-TEMP'] = temp
+    header['DATE-OBS'] = '2024-06-16T05:38:08'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fits.PrimaryHDU(np.zeros((100, 200), dtype=np.float32) + value, header=header).writeto(path)
+
+@pytest.fixture
+def night_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path / 'library'))
+    night_dir = tmp_path / 'night'
+    for i in range(3):
+        write_frame(night_dir / 'darks' / f'dark-60-{i}.fit', 'Dark Frame', 60.0, 6.0)
+        write_frame(night_dir / 'darks' / f'dark-5-{i}.fit', 'Dark Frame', 5.0, 0.5)
+        write_frame(night_dir / 'flats' / f'flat-r-{i}.fit', 'Flat Field', 5.0, 1000.5)
+        write_frame(night_dir / 'flats' / f'flat-i-{i}.fit', 'Flat Field', 5.0, 2000.5, filter='i')
+        write_frame(night_dir / 'target' / 'raw' / f'light-{i}.fit', 'Light Frame', 60.0, make_4gaussians_image() + 106.0, filter='i' if i == 2 else 'r')
+    (night_dir / 'target' / 'cal').mkdir()
+    return night_dir
+
+def test_build_library(night_dir):
+    dark_paths, flat_paths = Librarian.build_library(night_dir)
+    assert len(dark_paths) == 2
+    assert len(flat_paths) == 2
+    assert Librarian.build_library(night_dir) == (dark_paths, flat_paths)
+
+def test_match_frames(night_dir):
+    calibrations = Librarian.match_frames(night_dir / 'target', night_dir=night_dir)
+    assert 'dark-60s' in calibrations['light-0.fit'][0]
+    assert 'flat-r' in calibrations['light-0.fit'][1]
+    assert 'flat-i' in calibrations['light-2.fit'][1]
+    Reducer.reduce_objects(night_dir / 'target', calibrations=calibrations)
+    assert len(list((night_dir / 'target' / 'cal').glob('*.fit'))) == 3
+
+def test_match_frames_missing(night_dir):
+    with pytest.raises(ValueError):
+        Librarian.match_frames(night_dir / 'target')
+
+def test_build_library_nights(night_dir):
+    for i in range(3):
+        path = night_dir / 'darks-2' / f'dark-60-{i}.fit'
+        write_frame(path, 'Dark Frame', 60.0, 7.0)
+        with fits.open(path, mode='update') as frame:
+            frame[0].header['DATE-OBS'] = '2024-06-17T05:38:08'
+    dark_paths, flat_paths = Librarian.build_library(night_dir)
+    assert len(dark_paths) == 3
+    assert sum('20240617' in path for path in dark_paths) == 1
+    assert not (night_dir / 'target' / 'raw' / 'header-index.db').exists()
+    assert not (night_dir / 'target' / 'header-index.db').exists()
@@ -0,0 +1,85 @@
+import pytest
+import os
+import numpy as np
+
+from config import Configuration
+from libraries.masker import Masker
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    (tmp_path / 'cache').mkdir()
+    monkeypatch.setattr(Configuration, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Masker, 'registry', {})
+    monkeypatch.setattr(Masker, 'maps', {})
+    return tmp_path / 'cache' / 'mask'
+
+def test_get_mask(registry):
+    mask = Masker.get_mask('PL16803', 4, (1024, 1024))
+    assert mask is Masker.get_mask('PL16803', 4, (1024, 1024))
+    assert not mask.flags.writeable
+    assert mask[500, 301] and not mask[500, 303] and not mask[100, 301]
+    assert mask[:25].all() and mask[:, -25:].all() and not mask[25:-25, 25:-25][:, :270].any()
+    assert len(os.listdir(registry)) == 1
+    Masker.registry.clear()
+    assert np.array_equal(Masker.get_mask('PL16803', 4, (1024, 1024)), mask)
+
+def test_bad_pixel_map(registry, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(Configuration, 'MASK_DIR', str(tmp_path))
+    (tmp_path / 'CAM.txt').write_text('edge 0\nregion 10 12 0 5 # hot column\n')
+    mask = Masker.get_mask('CAM', 1, (20, 30))
+    assert mask.sum() == 10 and mask[0:5, 10:12].all()
+    boxes = Masker.mask_boxes('CAM', 1, (20, 30))
+    assert len(boxes['mask_boxes']) == 1 and 'eml_box' not in boxes
+    mask = Masker.get_mask('OTHER', 2, (200, 300))
+    assert mask[:50].all() and not mask[50:-50, 50:-50].any()
+    out, err = capsys.readouterr()
+    assert 'no bad pixel map for camera other' in out.lower()
+    (tmp_path / 'BAD.txt').write_text('column 3\n')
+    with pytest.raises(ValueError):
+        Masker.bad_pixel_map('BAD')
+
+def test_bad_pixel_detection(registry, tmp_path, monkeypatch):
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path))
+    monkeypatch.setattr(Configuration, 'MASK_DIR', str(tmp_path))
+    (tmp_path / 'CAM.txt').write_text('edge 0\n')
+    rng = np.random.default_rng(0)
+    dark = rng.normal(10., 1., size=(50, 60))
+    spread = rng.normal(2., 0.1, size=(50, 60))
+    dark[5, 7] = 100.
+    spread[9, 11] = 20.
+    flat = rng.normal(1., 0.01, size=(50, 60))
+    flat[30, 40] = 0.1
+    hot_flags = Masker.find_hot_pixels(dark, spread)
+    assert hot_flags[5, 7] == Masker.HOT and hot_flags[9, 11] == Masker.UNSTABLE
+    assert np.count_nonzero(hot_flags) == 2
+    assert np.count_nonzero(Masker.find_hot_pixels(np.ones((50, 60)), np.zeros((50, 60)))) == 0
+    Masker.update_bpm('CAM', 1, hot_flags, Masker.HOT | Masker.UNSTABLE)
+    Masker.update_bpm('CAM', 1, Masker.find_dead_pixels(flat), Masker.DEAD)
+    y, x, flags = Masker.read_bpm('CAM', 1, (50, 60))
+    assert sorted(zip(y, x, flags)) == [(5, 7, Masker.HOT), (9, 11, Masker.UNSTABLE), (30, 40, Masker.DEAD)]
+    mask = Masker.get_mask('CAM', 1, (50, 60))
+    assert mask[5, 7] and mask[30, 40] and mask.sum() == 3
+    other_flags = np.zeros((50, 60), dtype=np.uint8)
+    other_flags[20, 25] = Masker.HOT
+    Masker.update_bpm('CAM', 1, other_flags, Masker.HOT | Masker.UNSTABLE, 'other-dark')
+    y, x, flags = Masker.read_bpm('CAM', 1, (50, 60))
+    assert sorted(zip(y, x, flags)) == [(5, 7, Masker.HOT), (9, 11, Masker.UNSTABLE), (20, 25, Masker.HOT), (30, 40, Masker.DEAD)]
+    assert Masker.get_mask('CAM', 1, (50, 60))[5, 7] and Masker.get_mask('CAM', 1, (50, 60))[20, 25]
+    assert Masker.read_bpm_masters('CAM', 1, (50, 60)) == {'other-dark'}
+    mask = Masker.get_mask('CAM', 1, (50, 60))
+    Masker.update_bpm('CAM', 1, np.zeros((50, 60), dtype=np.uint8), Masker.HOT, 'other-dark')
+    assert Masker.get_mask('CAM', 1, (50, 60)) is mask
+
+def test_dead_pixels_vignetting(registry, tmp_path, monkeypatch):
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path))
+    yy, xx = np.mgrid[0:300, 0:400]
+    flat = 1.0 - 0.8 * (((yy - 150) / 150)**2 + ((xx - 200) / 200)**2) / 2
+    flat *= np.random.default_rng(1).normal(1., 0.01, size=flat.shape)
+    flat[100:200, 250] = 0.2
+    flat[280, 20] = 0.01
+    assert np.count_nonzero(flat < 0.5 * np.median(flat)) > 1000
+    flags = Masker.find_dead_pixels(flat)
+    assert np.count_nonzero(flags) == 101
+    assert flags[100:200, 250].all() and flags[280, 20] == Masker.DEAD
+    Masker.read_bpm('CAM', 1, flat.shape)
+    assert not (tmp_path / 'bpm').exists()
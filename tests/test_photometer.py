@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+
+from astropy.table import Table
+from config import Configuration
+from libraries.photometer import Photometer
+
+def test_match_catalogs(monkeypatch):
+    monkeypatch.setattr(Configuration, 'CATALOG', 'gaia-cone')
+    dec = 38.5
+    step = 1. / 3600 / np.cos(np.radians(dec))
+    source_table = Table({'ra': [326.0, 326.0 + 0.5 * step, 326.01, 326.02], 'dec': [dec, dec, dec, dec]})
+    query_table = Table({'ra': [326.0 + 0.1 * step, 326.01 + 0.7 * step, 326.03], 'dec': [dec, dec, dec], 'source_id': [1, 2, 3]})
+    match_table = Photometer.match_catalogs(source_table, query_table)
+    assert list(match_table['source_id']) == [1, 2]
+    assert list(match_table['idx']) == [0, 2]
+    assert np.allclose(match_table['sep'], [0.1, 0.7], atol=1e-3)
+    assert 'idx' not in query_table.colnames
+    assert len(Photometer.match_catalogs(source_table, query_table, radius=0.5)) == 1
+
+def test_match_catalogs_one_to_one(monkeypatch):
+    monkeypatch.setattr(Configuration, 'CATALOG', 'ps1')
+    source_table = Table({'ra': [10.0], 'dec': [0.0]})
+    query_table = Table({'raMean': [10.0 + 0.2 / 3600, 10.0 + 0.4 / 3600], 'decMean': [0.0, 0.0]})
+    match_table = Photometer.match_catalogs(source_table, query_table)
+    assert len(match_table) == 1
+    assert match_table['sep'][0] == pytest.approx(0.2, abs=1e-3)
+    assert len(Photometer.match_catalogs(source_table[:0], query_table)) == 0
+
+def test_extract_sky_sources(tmp_path, monkeypatch):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from libraries.masker import Masker
+    from photutils.datasets import make_100gaussians_image
+    (tmp_path / 'cache').mkdir()
+    monkeypatch.setattr(Configuration, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Configuration, 'MASK_DIR', str(tmp_path))
+    monkeypatch.setattr(Configuration, 'CAMERA', 'CAM')
+    monkeypatch.setattr(Masker, 'registry', {})
+    monkeypatch.setattr(Masker, 'maps', {})
+    (tmp_path / 'CAM.txt').write_text('edge 0\n')
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [326.1413, 38.5948]
+    wcs.wcs.crpix = [75., 50.]
+    wcs.wcs.cd = [[-0.6305 / 3600, 0.], [0., 0.6305 / 3600]]
+    fits.PrimaryHDU(make_100gaussians_image(), header=wcs.to_header()).writeto(tmp_path / 'a.fit')
+    pix_table = Photometer.extract_pix_sources(str(tmp_path / 'a.fit'))
+    sky_table = Photometer.extract_sky_sources(str(tmp_path / 'a.fit'))
+    assert len(sky_table) == len(pix_table) > 10
+    sky = wcs.pixel_to_world(sky_table['xcentroid'], sky_table['ycentroid'])
+    assert np.allclose(sky_table['ra'], sky.ra.deg) and np.allclose(sky_table['dec'], sky.dec.deg)
+    fits.PrimaryHDU(np.zeros((100, 150)), header=wcs.to_header()).writeto(tmp_path / 'b.fit')
+    empty_table = Photometer.extract_sky_sources(str(tmp_path / 'b.fit'))
+    assert len(empty_table) == 0 and 'ra' in empty_table.colnames
+
+def test_photometry_columns():
+    from astropy.table import MaskedColumn
+    table = Table({'res_aperture_sum': [1000., 5., -20.],
+        'phot_bp_n_obs': MaskedColumn([10, 0, 5], mask=[False, False, True]),
+        'phot_rp_n_obs': [12, 8, 9],
+        'phot_bp_mean_mag': [15.5, 16.0, 17.0], 'phot_rp_mean_mag': [14.7, 15.1, 16.2], 'phot_g_mean_mag': [15.0, 15.6, 16.6]})
+    Photometer.photometry_columns(table, 10., 2., 50., 100., 4.)
+    assert list(table['flux']) == [1000., 12., 12.]
+    assert list(table['flux_flag']) == [False, True, True]
+    assert list(table['color_flag']) == [False, True, True]
+    assert table['color'][0] == pytest.approx(0.8) and table['color'][1] == 0.
+    assert table['inst_mag'][0] == pytest.approx(-2.5 * np.log10(1000. / 4.))
+    assert table['flux_error'][0] == pytest.approx(np.sqrt(1000. + 50. * (1 + np.pi * 50. / 200.) * 4.))
+    assert table['delta_mag'][0] == pytest.approx(15.0 - table['inst_mag'][0])
+    assert table['delta_mag'][2] == pytest.approx(-table['inst_mag'][2])
+
+def test_photometry_columns_ps1():
+    table = Table({'res_aperture_sum': [500., 800.], 'nr': [3, 4], 'ni': [0, 2], 'rMeanPSFMag': [16.0, 15.0], 'iMeanPSFMag': [15.8, 14.6]})
+    Photometer.photometry_columns(table, 0., 1., 50., 100., 1., survey='ps1')
+    assert list(table['color_flag']) == [True, False]
+    assert table['color'][1] == pytest.approx(0.4)
+    assert table['delta_mag'][1] == pytest.approx(15.0 + 2.5 * np.log10(800.))
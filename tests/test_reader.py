@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+
+from astropy.io import fits
+from libraries.reader import Reader
+
+def test_read_header(object_frame):
+    header = Reader.read_header(object_frame)
+    assert header == fits.getheader(object_frame)
+
+def test_read_header_truncated(tmp_path):
+    bad_path = tmp_path / 'bad.fit'
+    bad_path.write_bytes(b'SIMPLE  =                    T' + b' ' * 50)
+    with pytest.raises(OSError):
+        Reader.read_header(bad_path)
+
+def test_open_frame(object_frame):
+    with Reader.open_frame(object_frame) as frame:
+        assert len(Reader.open_handles) == 1
+    assert len(Reader.open_handles) == 0
+    data, header = Reader.load_frame(object_frame)
+    assert isinstance(data, np.ndarray)
+    assert len(Reader.open_handles) == 0
+
+def test_query_directory(tmp_path, object_frame):
+    for i in range(3):
+        header = fits.getheader(object_frame)
+        header['EXPTIME'] = 30.0 * (i + 1)
+        fits.PrimaryHDU(np.zeros((4, 4)), header=header).writeto(tmp_path / f'frame-{i}.fit')
+    assert Reader.index_directory(tmp_path) == 3
+    assert Reader.index_directory(tmp_path) == 0
+    rows = Reader.query_directory(tmp_path, imagetyp='Light Frame', exptime=60.0)
+    assert [row['name'] for row in rows] == ['frame-1.fit']
+    (tmp_path / 'frame-2.fit').unlink()
+    assert len(Reader.query_directory(tmp_path)) == 2
+
+def test_read_directory(capsys, obj_dir):
+    frame_list, data_table = Reader.read_directory(obj_dir / 'raw')
+    out, err = capsys.readouterr()
+    assert frame_list == ['raw-0.fit', 'raw-1.fit', 'raw-2.fit']
+    assert out.count('raw-0.fit') == 1
@@ -1,9 +1,12 @@
 import pytest
 import os
 import astropy
+from astropy.io import fits
 import numpy as np
+import shutil
 
 from pathlib import Path
+from config import Configuration
 from libraries.reducer import Reducer
 
 def test_align_frames(obj_dir):
@@ -69,6 +72,14 @@ def test_reduce_objects_skip(capsys, obj_dir, flat_dir, dark_dir, bkg_method='fl
     skip_statement = "Skipping reduction on frame"
     assert skip_statement.lower() in out.lower()
 
+def test_reduce_objects_workers(tmp_path, obj_dir, flat_dir, dark_dir, bkg_method='flat'):
+    shutil.copytree(obj_dir / 'raw', tmp_path / 'raw')
+    (tmp_path / 'cal').mkdir()
+    Reducer.reduce_objects(obj_dir, flat_dir, dark_dir, bkg_method)
+    Reducer.reduce_objects(tmp_path, flat_dir, dark_dir, bkg_method, workers=2)
+    for frame in os.listdir(obj_dir / 'cal'):
+        assert (obj_dir / 'cal' / frame).read_bytes() == (tmp_path / 'cal' / frame).read_bytes()
+
 def test_solve_plates(capsys, obj_dir):
     assert isinstance(Reducer.solve_plates(obj_dir), list)
     out, err = capsys.readouterr()
@@ -84,3 +95,206 @@ def test_solve_plates(capsys, obj_dir):
 
 def test_scandir(obj_dir, helper):
     helper.show_files(obj_dir)
+
+def test_make_dark_provenance(capsys, tmp_path, dark_dir, monkeypatch):
+    monkeypatch.setattr(Configuration, 'CACHE_DIR', str(tmp_path / 'cache'))
+    (tmp_path / 'cache').mkdir()
+    new_dark_dir = tmp_path / 'dark'
+    shutil.copytree(dark_dir, new_dark_dir, ignore=shutil.ignore_patterns('master-dark.fit'))
+    Reducer.make_dark(new_dark_dir)
+    shutil.copy(new_dark_dir / 'dark-0.fit', new_dark_dir / 'dark-3.fit')
+    Reducer.make_dark(new_dark_dir)
+    os.remove(new_dark_dir / 'master-dark.fit')
+    Reducer.make_dark(new_dark_dir)
+    out, err = capsys.readouterr()
+    assert out.lower().count('creating master dark') == 2
+    assert 'restoring cached master' in out.lower()
+    assert len(os.listdir(tmp_path / 'cache')) == 2
+
+def test_make_stack_incremental(capsys, obj_dir):
+    Reducer.make_stack(obj_dir, incremental=True)
+    Reducer.make_stack(obj_dir, incremental=True)
+    out, err = capsys.readouterr()
+    assert 'adding 0 frames' in out.lower()
+
+def test_align_frames_workers(tmp_path, obj_dir):
+    for run in ('serial', 'parallel'):
+        shutil.copytree(obj_dir / 'wcs', tmp_path / run / 'wcs')
+        (tmp_path / run / 'align').mkdir()
+    Reducer.align_frames(tmp_path / 'serial')
+    Reducer.align_frames(tmp_path / 'parallel', workers=2)
+    for name in os.listdir(tmp_path / 'serial' / 'align'):
+        assert (tmp_path / 'serial' / 'align' / name).read_bytes() == (tmp_path / 'parallel' / 'align' / name).read_bytes()
+
+def test_align_frames_cached_reference(capsys, obj_dir):
+    Reducer.align_frames(obj_dir)
+    assert os.path.isfile(obj_dir / 'align' / 'reference.hdr')
+    Reducer.align_frames(obj_dir)
+    out, err = capsys.readouterr()
+    assert 'reading cached reference' in out.lower()
+
+def test_make_stack_weighted(obj_dir):
+    stack = Reducer.make_stack(obj_dir, weighting='seeing')
+    assert stack.header['WEIGHTNG'] == 'seeing'
+    with fits.open(obj_dir / 'align' / 'stack.fit') as frame:
+        assert frame['EXPOSURE'].data.shape == stack.data.shape
+        assert frame['WEIGHT'].data.shape == stack.data.shape
+
+def test_drizzle_stack(capsys, obj_dir):
+    stack = Reducer.drizzle_stack(obj_dir, scale=0.5)
+    assert stack.header['DRZSCALE'] == 0.5
+    assert os.path.isfile(obj_dir / 'align' / 'drizzle-weight.fit')
+    Reducer.drizzle_stack(obj_dir, scale=0.5)
+    out, err = capsys.readouterr()
+    assert 'reading extant drizzled stack' in out.lower()
+
+def write_stream_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    stars = rng.uniform(30, 170, size=(40, 2))
+    yy, xx = np.mgrid[0:200, 0:200]
+    for name in ('raw', 'cal', 'wcs', 'align', 'calib'):
+        (tmp_path / name).mkdir()
+    fits.PrimaryHDU(np.zeros((200, 200))).writeto(tmp_path / 'calib' / 'master-dark.fit')
+    fits.PrimaryHDU(np.ones((200, 200))).writeto(tmp_path / 'calib' / 'flatfield.fit')
+    for i, shift in enumerate([(0., 0.), (1.3, -0.7), (2.1, 0.4)]):
+        data = rng.normal(100., 2., size=(200, 200))
+        for (x, y), flux in zip(stars, rng.uniform(500, 5000, size=40)):
+            data += flux * np.exp(-((xx - x - shift[0])**2 + (yy - y - shift[1])**2) / (2 * 2.5**2))
+        fits.PrimaryHDU(data, header=fits.Header({'XBINNING': 4, 'EXPTIME': 60.})).writeto(tmp_path / 'raw' / f'ccd-{i}.fit')
+
+def test_stream_objects(tmp_path, fake_solver):
+    write_stream_frames(tmp_path)
+    stack = Reducer.stream_objects(tmp_path, flat_dir=tmp_path / 'calib', dark_dir=tmp_path / 'calib', keep=['align'])
+    assert stack.header['NCOMBINE'] == 3
+    assert os.listdir(tmp_path / 'cal') == [] and os.listdir(tmp_path / 'wcs') == []
+    assert sorted(os.listdir(tmp_path / 'align')) == ['a-wcs-red-ccd-0.fit', 'a-wcs-red-ccd-1.fit', 'a-wcs-red-ccd-2.fit', 'reference.hdr', 'stack-acc', 'stack.fit']
+    assert fits.getheader(tmp_path / 'align' / 'a-wcs-red-ccd-1.fit')['BKGMED'] == pytest.approx(100., abs=1.)
+    aligned = fits.getdata(tmp_path / 'align' / 'a-wcs-red-ccd-2.fit')
+    reference = fits.getdata(tmp_path / 'align' / 'a-wcs-red-ccd-0.fit')
+    peak = np.unravel_index(np.nanargmax(reference), reference.shape)
+    assert np.unravel_index(np.nanargmax(aligned), aligned.shape) in [(peak[0] + dy, peak[1] + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+    stack = Reducer.stream_objects(tmp_path, flat_dir=tmp_path / 'calib', dark_dir=tmp_path / 'calib')
+    assert stack.header['NCOMBINE'] == 3
+
+def test_align_frames_field_reference(tmp_path, obj_dir):
+    import pandas as pd
+    from libraries.aligner import Aligner
+    shutil.copytree(obj_dir / 'wcs', tmp_path / 'wcs')
+    (tmp_path / 'align').mkdir()
+    obj_list = sorted(os.listdir(tmp_path / 'wcs'))
+    header = fits.getheader(tmp_path / 'wcs' / obj_list[0])
+    centre = Aligner.read_wcs(header).pixel_to_world((header['NAXIS1'] - 1) / 2, (header['NAXIS2'] - 1) / 2)
+    fields = pd.DataFrame({'field_id': ['01.001'], 'ra': [centre.ra.deg], 'dec': [centre.dec.deg]})
+    Reducer.align_frames(tmp_path, reference='field', fields=fields)
+    aligned = sorted(name for name in os.listdir(tmp_path / 'align') if name.startswith('a-'))
+    assert aligned == ['a-' + obj for obj in obj_list]
+    assert fits.Header.fromtextfile(tmp_path / 'align' / 'reference.hdr')['REFFRAME'] == 'field 01.001'
+    Reducer.align_frames(tmp_path, reference='field', fields=fields)
+
+def test_align_frames_reference_strategy(capsys, tmp_path, obj_dir):
+    import pandas as pd
+    from libraries.aligner import Aligner
+    shutil.copytree(obj_dir / 'wcs', tmp_path / 'wcs')
+    (tmp_path / 'align').mkdir()
+    obj_list = sorted(os.listdir(tmp_path / 'wcs'))
+    Reducer.align_frames(tmp_path, reference='first')
+    (tmp_path / 'align' / 'stack-acc').mkdir()
+    assert fits.Header.fromtextfile(tmp_path / 'align' / 'reference.hdr')['REFSTRAT'] == 'first'
+    header = fits.getheader(tmp_path / 'wcs' / obj_list[0])
+    centre = Aligner.read_wcs(header).pixel_to_world((header['NAXIS1'] - 1) / 2, (header['NAXIS2'] - 1) / 2)
+    fields = pd.DataFrame({'field_id': ['01.001'], 'ra': [centre.ra.deg], 'dec': [centre.dec.deg]})
+    capsys.readouterr()
+    Reducer.align_frames(tmp_path, reference='field', fields=fields)
+    out, err = capsys.readouterr()
+    assert 'reference strategy changed from first to field' in out.lower()
+    reference_header = fits.Header.fromtextfile(tmp_path / 'align' / 'reference.hdr')
+    assert (reference_header['REFSTRAT'], reference_header['REFFRAME']) == ('field', 'field 01.001')
+    assert not os.path.isdir(tmp_path / 'align' / 'stack-acc')
+    for obj in obj_list:
+        assert fits.getheader(tmp_path / 'align' / ('a-' + obj))['REFFRAME'] == 'field 01.001'
+    Reducer.align_frames(tmp_path, reference='field', fields=fields)
+    out, err = capsys.readouterr()
+    assert 'reading cached reference' in out.lower()
+
+def test_stream_objects_interrupted(tmp_path, fake_solver, monkeypatch, capsys):
+    from libraries.aligner import Aligner
+    write_stream_frames(tmp_path)
+    align = Aligner.align
+    calls = []
+    def fail(frame_data, frame_header, reference_header, method=None):
+        calls.append(1)
+        if len(calls) == 2:
+            raise OSError('disk full')
+        return align(frame_data, frame_header, reference_header, method)
+    monkeypatch.setattr(Aligner, 'align', fail)
+    with pytest.raises(OSError):
+        Reducer.stream_objects(tmp_path, flat_dir=tmp_path / 'calib', dark_dir=tmp_path / 'calib')
+    frames = (tmp_path / 'align' / 'stack-acc' / 'frames.txt').read_text().splitlines()
+    assert frames[1:] == ['a-wcs-red-ccd-0.fit', 'a-wcs-red-ccd-1.fit']
+    monkeypatch.setattr(Aligner, 'align', align)
+    stack = Reducer.stream_objects(tmp_path, flat_dir=tmp_path / 'calib', dark_dir=tmp_path / 'calib')
+    assert stack.header['NCOMBINE'] == 3
+    out, err = capsys.readouterr()
+    assert out.lower().count('already stacked') == 2
+    with pytest.raises(ValueError):
+        Reducer.stream_objects(tmp_path, flat_dir=tmp_path / 'calib', dark_dir=tmp_path / 'calib', weighting='seeing')
+
+def test_master_key(tmp_path):
+    data = np.zeros((300, 300), dtype=np.float32)
+    fits.PrimaryHDU(data).writeto(tmp_path / 'a.fit')
+    key = Reducer.master_key('dark', [str(tmp_path / 'a.fit')])
+    (tmp_path / 'copy').mkdir()
+    shutil.copy(tmp_path / 'a.fit', tmp_path / 'copy' / 'a.fit')
+    assert Reducer.master_key('dark', [str(tmp_path / 'copy' / 'a.fit')]) == key
+    data[150, 137] = 1.
+    fits.PrimaryHDU(data).writeto(tmp_path / 'a.fit', overwrite=True)
+    assert os.path.getsize(tmp_path / 'a.fit') == os.path.getsize(tmp_path / 'copy' / 'a.fit')
+    assert Reducer.master_key('dark', [str(tmp_path / 'a.fit')]) != key
+
+def test_make_dark_bpm_from_cache(capsys, tmp_path, dark_dir, monkeypatch):
+    from libraries.masker import Masker
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path / 'library'))
+    (tmp_path / 'library').mkdir()
+    new_dark_dir = tmp_path / 'dark'
+    shutil.copytree(dark_dir, new_dark_dir, ignore=shutil.ignore_patterns('master-dark.fit'))
+    rng = np.random.default_rng(0)
+    for path in sorted(new_dark_dir.glob('*.fit')):
+        with fits.open(path, mode='update') as frame:
+            frame[0].data = frame[0].data + rng.normal(0., 1., size=frame[0].data.shape)
+            frame[0].data[7, 9] += 1e4
+    master_dark = Reducer.make_dark(new_dark_dir)
+    bpm_path = Masker.bpm_path(Configuration.CAMERA, master_dark.header.get('XBINNING', 1), master_dark.shape)
+    built = Masker.read_bpm(Configuration.CAMERA, master_dark.header.get('XBINNING', 1), master_dark.shape)
+    assert os.path.isfile(bpm_path) and len(built[0]) > 0
+    os.remove(bpm_path)
+    Reducer.make_dark(new_dark_dir)
+    out, err = capsys.readouterr()
+    assert 'reading extant master dark' in out.lower()
+    reused = Masker.read_bpm(Configuration.CAMERA, master_dark.header.get('XBINNING', 1), master_dark.shape)
+    assert all(np.array_equal(a, b) for a, b in zip(built, reused))
+    assert Masker.read_bpm_masters(Configuration.CAMERA, master_dark.header.get('XBINNING', 1), master_dark.shape) == {master_dark.header['CALKEY']}
+
+def test_make_dark_bpm_exposures(capsys, tmp_path, dark_dir, monkeypatch):
+    from libraries.masker import Masker
+    monkeypatch.setattr(Configuration, 'LIBRARY_DIR', str(tmp_path / 'library'))
+    (tmp_path / 'library').mkdir()
+    rng = np.random.default_rng(0)
+    hot_pixels = {'short': (7, 9), 'long': (20, 30)}
+    for name, exposure in (('short', 1.), ('long', 300.)):
+        shutil.copytree(dark_dir, tmp_path / name, ignore=shutil.ignore_patterns('master-dark.fit'))
+        for path in sorted((tmp_path / name).glob('*.fit')):
+            with fits.open(path, mode='update') as frame:
+                frame[0].data = frame[0].data + rng.normal(0., 1., size=frame[0].data.shape)
+                frame[0].data[hot_pixels[name]] += 1e4
+                frame[0].header['EXPOSURE'] = exposure
+    long_dark = Reducer.make_dark(tmp_path / 'long')
+    short_dark = Reducer.make_dark(tmp_path / 'short')
+    binning = long_dark.header.get('XBINNING', 1)
+    bpm_path = Masker.bpm_path(Configuration.CAMERA, binning, long_dark.shape)
+    y, x, flags = Masker.read_bpm(Configuration.CAMERA, binning, long_dark.shape)
+    assert set(hot_pixels.values()) <= set(zip(y, x))
+    assert Masker.read_bpm_masters(Configuration.CAMERA, binning, long_dark.shape) == {long_dark.header['CALKEY'], short_dark.header['CALKEY']}
+    mtime = os.stat(bpm_path).st_mtime_ns
+    Reducer.make_dark(tmp_path / 'long')
+    Reducer.make_dark(tmp_path / 'short')
+    assert os.stat(bpm_path).st_mtime_ns == mtime
@@ -0,0 +1,200 @@
+import pytest
+import os
+import numpy as np
+
+from astropy.io import fits
+from config import Configuration
+from libraries.solver import Solver
+from photutils.datasets import make_100gaussians_image
+
+def test_solve_frames(tmp_path, fake_solver, capsys):
+    cal_dir = tmp_path / 'cal'
+    wcs_dir = tmp_path / 'wcs'
+    cal_dir.mkdir()
+    wcs_dir.mkdir()
+    names = ['good-1.fit', 'good-2.fit', 'bad-1.fit', 'slow-1.fit']
+    for name in names:
+        fits.PrimaryHDU(np.zeros((10, 10))).writeto(cal_dir / name)
+    frame_paths = [str(cal_dir / name) for name in names]
+    wcs_paths = [str(wcs_dir / ('wcs-' + name)) for name in names]
+    statuses = Solver.solve_frames(frame_paths, wcs_paths, workers=4, timeout=2)
+    assert [statuses[name]['status'] for name in names] == ['solved', 'solved', 'failed', 'timeout']
+    assert sorted(os.listdir(wcs_dir)) == ['wcs-good-1.fit', 'wcs-good-2.fit']
+    assert sorted(os.listdir(cal_dir)) == sorted(names)
+    out, err = capsys.readouterr()
+    assert 'did not solve' in out.lower()
+    statuses = Solver.solve_frames(frame_paths[:1], wcs_paths[:1])
+    assert statuses['good-1.fit']['status'] == 'skipped'
+
+def test_solve_frames_missing_solver(tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    fits.PrimaryHDU(np.zeros((10, 10))).writeto(tmp_path / 'a.fit')
+    statuses = Solver.solve_frames([str(tmp_path / 'a.fit')], [str(tmp_path / 'wcs-a.fit')])
+    assert statuses['a.fit']['status'] == 'failed'
+
+def test_solve_frames_xyls(tmp_path, fake_solver):
+    wcs_dir = tmp_path / 'wcs'
+    wcs_dir.mkdir()
+    data = make_100gaussians_image()
+    header = fits.Header({'XBINNING': 2})
+    fits.PrimaryHDU(data, header=header).writeto(tmp_path / 'a.fit')
+    statuses = Solver.solve_frames([str(tmp_path / 'a.fit')], [str(wcs_dir / 'wcs-a.fit')], mode='xyls')
+    assert statuses['a.fit']['status'] == 'solved'
+    args = (wcs_dir / 'args.txt').read_text().split()
+    assert args[args.index('--scale-low') + 1] == '%.4f' % (0.6305 * 2 * 0.9)
+    assert int(args[-1]) >= Solver.MIN_SOURCES
+    with fits.open(wcs_dir / 'wcs-a.fit') as frame:
+        assert frame[0].header['CTYPE1'] == 'RA---TAN'
+        assert frame[0].header['XBINNING'] == 2
+        assert np.array_equal(frame[0].data, data)
+
+def test_extract_xyls(tmp_path):
+    data = make_100gaussians_image()
+    fits.PrimaryHDU(data).writeto(tmp_path / 'a.fit')
+    n_sources, shape = Solver.extract_xyls(tmp_path / 'a.fit', tmp_path / 'a.xyls', n_sources=20)
+    assert n_sources == 20
+    with fits.open(tmp_path / 'a.xyls') as xyls:
+        assert xyls[1].header['IMAGEW'] == shape[1]
+        flux = xyls[1].data['FLUX']
+        assert np.all(np.diff(flux) <= 0)
+
+def star_field(wcs, shift=(0., 0.), seed=0, shape=(300, 300)):
+    rng = np.random.default_rng(seed)
+    stars = rng.uniform(20, 280, size=(40, 2))
+    world = wcs.pixel_to_world(stars[:, 0], stars[:, 1])
+    x, y = wcs.world_to_pixel(world)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    data = rng.normal(100., 2., size=shape)
+    for xs, ys, flux in zip(x + shift[0], y + shift[1], rng.uniform(500, 5000, size=40)):
+        data += flux * np.exp(-((xx - xs)**2 + (yy - ys)**2) / (2 * 2.5**2))
+    return data
+
+def test_track_frames(tmp_path, fake_solver):
+    from astropy.wcs import WCS
+    cal_dir = tmp_path / 'cal'
+    wcs_dir = tmp_path / 'wcs'
+    cal_dir.mkdir()
+    wcs_dir.mkdir()
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [326.1413, 38.5948]
+    wcs.wcs.crpix = [150., 150.]
+    wcs.wcs.cd = [[-0.6305 / 3600, 0.], [0., 0.6305 / 3600]]
+    shifts = [(0., 0.), (1.3, -0.7), (2.9, -1.6)]
+    for i, shift in enumerate(shifts):
+        header = wcs.to_header() if i == 0 else None
+        fits.PrimaryHDU(star_field(wcs, shift), header=header).writeto(cal_dir / f'a-{i}.fit')
+    fits.PrimaryHDU(np.random.default_rng(5).normal(100., 2., size=(300, 300))).writeto(cal_dir / 'a-3.fit')
+    names = [f'a-{i}.fit' for i in range(4)]
+    frame_paths = [str(cal_dir / name) for name in names]
+    wcs_paths = [str(wcs_dir / ('wcs-' + name)) for name in names]
+    statuses = Solver.track_frames(frame_paths, wcs_paths)
+    assert [statuses[name]['status'] for name in names] == ['solved', 'tracked', 'tracked', 'solved']
+    for name, shift in zip(names[1:3], shifts[1:3]):
+        tracked = WCS(fits.getheader(wcs_dir / ('wcs-' + name)))
+        x, y = tracked.world_to_pixel(wcs.pixel_to_world(100., 200.))
+        assert x == pytest.approx(100. + shift[0], abs=0.1)
+        assert y == pytest.approx(200. + shift[1], abs=0.1)
+
+def test_solve_cache(tmp_path, fake_solver, monkeypatch):
+    monkeypatch.setattr(Configuration, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('FAKE_ARGS', str(tmp_path / 'args.txt'))
+    (tmp_path / 'cache').mkdir()
+    (tmp_path / 'wcs').mkdir()
+    header = fits.Header({'XBINNING': 2, 'OBJCTRA': '21 44 33.9', 'OBJCTDEC': '+38 35 41'})
+    for name in ('a.fit', 'b.fit'):
+        fits.PrimaryHDU(np.zeros((10, 10)), header=header).writeto(tmp_path / name)
+    Solver.solve_frames([str(tmp_path / 'a.fit')], [str(tmp_path / 'wcs' / 'wcs-a.fit')])
+    cache_path = Solver.cache_path(header)
+    assert os.path.isfile(cache_path)
+    assert cache_path.endswith('-2x2.wcs')
+    Solver.solve_frames([str(tmp_path / 'b.fit')], [str(tmp_path / 'wcs' / 'wcs-b.fit')])
+    first, second = (tmp_path / 'args.txt').read_text().splitlines()
+    assert '--verify' not in first
+    assert '--verify ' + cache_path in second
+    assert '--scale-low 0.7056' in second
+
+def test_xy_to_nested():
+    import astropy_healpix as ah
+    assert [Solver.xy_to_nested(healpix, 2) for healpix in range(4)] == [0, 2, 1, 3]
+    for nside in (2, 4, 8):
+        hp = ah.HEALPix(nside=nside, order='nested')
+        for base in (0, 5, 9):
+            xy = np.arange(base * nside**2, (base + 1) * nside**2)
+            nested = np.array([Solver.xy_to_nested(healpix, nside) for healpix in xy])
+            assert sorted(nested) == list(xy)
+            lon, lat = hp.healpix_to_lonlat(nested)
+            x, y = np.divmod(xy % nside**2, nside)
+            # --- x runs to the north-east and y to the north-west of the base pixel
+            assert lat[(x == nside - 1) & (y == nside - 1)][0] == lat.max()
+            assert lat[(x == 0) & (y == 0)][0] == lat.min()
+            east = lon[(x == nside - 1) & (y == 0)][0].deg
+            west = lon[(x == 0) & (y == nside - 1)][0].deg
+            assert (east - west + 180) % 360 - 180 > 0
+
+def write_indexes(index_dir):
+    for healpix in range(48):
+        fits.PrimaryHDU(header=fits.Header({'HEALPIX': healpix, 'HPNSIDE': 2})).writeto(index_dir / f'index-4210-{healpix:02d}.fits')
+    fits.PrimaryHDU(header=fits.Header({'HEALPIX': -1, 'HPNSIDE': 1})).writeto(index_dir / 'index-4110.fits')
+
+def test_select_indexes(tmp_path):
+    import astropy_healpix as ah
+    from astropy import units as u
+    write_indexes(tmp_path)
+    indexes = Solver.read_indexes(tmp_path)
+    assert len(indexes) == 49
+    assert Solver.read_indexes(tmp_path / 'missing') is None
+    index_paths = Solver.select_indexes(indexes, 326.1413, 38.5948, 1.0)
+    centre = ah.HEALPix(nside=2, order='nested').lonlat_to_healpix(326.1413 * u.deg, 38.5948 * u.deg)
+    healpix = [h for h in range(48) if Solver.xy_to_nested(h, 2) == centre][0]
+    assert str(tmp_path / 'index-4110.fits') in index_paths
+    assert str(tmp_path / f'index-4210-{healpix:02d}.fits') in index_paths
+    assert len(index_paths) <= 4
+    Solver.write_index_config(tmp_path / 'solve.cfg', indexes, 326.1413, 38.5948, 1.0)
+    lines = (tmp_path / 'solve.cfg').read_text().splitlines()
+    assert lines[0] == 'inparallel'
+    assert len(lines) == len(index_paths) + 1
+
+def test_solve_frames_indexes(tmp_path, fake_solver, monkeypatch):
+    (tmp_path / 'index').mkdir()
+    (tmp_path / 'wcs').mkdir()
+    write_indexes(tmp_path / 'index')
+    monkeypatch.setattr(Configuration, 'INDEX_DIR', str(tmp_path / 'index'))
+    read_indexes = Solver.read_indexes
+    scans = []
+    pointings = []
+    monkeypatch.setattr(Solver, 'read_indexes', lambda index_dir: scans.append(index_dir) or read_indexes(index_dir))
+    monkeypatch.setattr(Solver, 'write_index_config', lambda config_path, indexes, ra, dec, radius: pointings.append((ra, dec)))
+    header = fits.Header({'OBJCTRA': '21 44 33.9', 'OBJCTDEC': '+38 35 41'})
+    for name in ('good-1.fit', 'good-2.fit'):
+        fits.PrimaryHDU(np.zeros((10, 10)), header=header).writeto(tmp_path / name)
+    Solver.solve_frames([str(tmp_path / 'good-1.fit'), str(tmp_path / 'good-2.fit')], [str(tmp_path / 'wcs' / 'wcs-good-1.fit'), str(tmp_path / 'wcs' / 'wcs-good-2.fit')], workers=2)
+    assert len(scans) == 1
+    assert len(pointings) == 2
+    assert pointings[0] == Solver.read_pointing(header)
+    assert pointings[0][0] == pytest.approx(326.1413, abs=1e-3)
+
+def test_solve_frames_pointing(tmp_path, monkeypatch):
+    (tmp_path / 'wcs').mkdir()
+    commands = []
+    monkeypatch.setattr(Solver, 'run_solver', lambda command, timeout: commands.append(command) or (Solver.FAILED, ''))
+    header = fits.Header({'OBJCTRA': '05 34 31.9', 'OBJCTDEC': '+22 00 52'})
+    fits.PrimaryHDU(np.zeros((10, 10)), header=header).writeto(tmp_path / 'crab.fit')
+    Solver.solve_frames([str(tmp_path / 'crab.fit')], [str(tmp_path / 'wcs' / 'wcs-crab.fit')], mode='image')
+    command = commands[0]
+    ra = float(command[command.index('--ra') + 1])
+    dec = float(command[command.index('--dec') + 1])
+    assert (ra, dec) == Solver.read_pointing(header)
+    assert ra == pytest.approx(83.633, abs=1e-3)
+    assert ra != pytest.approx(Configuration.FIELD_RA)
+    assert command.count('--ra') == 1
+
+def test_solve_data(tmp_path, fake_solver):
+    data = make_100gaussians_image()
+    header = fits.Header({'XBINNING': 2})
+    status, wcs_header = Solver.solve_data(data, header, str(tmp_path))
+    assert status['status'] == 'solved'
+    assert wcs_header['CTYPE1'] == 'RA---TAN'
+    assert not any(name.startswith('solve-') for name in os.listdir(tmp_path))
+    status, wcs_header = Solver.solve_data(np.zeros((100, 100)), header, str(tmp_path))
+    assert status['status'] == 'failed' and wcs_header is None
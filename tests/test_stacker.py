@@ -0,0 +1,94 @@
+import pytest
+import os
+import numpy as np
+
+from astropy.io import fits
+from libraries.stacker import Stacker
+
+def write_frames(align_dir, start, stop, rng):
+    for i in range(start, stop):
+        data = rng.normal(100., 5., size=(20, 30))
+        data[0, 0] = np.nan
+        fits.PrimaryHDU(data).writeto(align_dir / f'a-{i:03d}.fit')
+
+def test_update_stack(tmp_path):
+    rng = np.random.default_rng(1)
+    write_frames(tmp_path, 0, 20, rng)
+    names = sorted(item.name for item in tmp_path.glob('a-*.fit'))
+    Stacker.update_stack(tmp_path, names[:10], method='average')
+    stack = Stacker.update_stack(tmp_path, names, method='average')
+    cube = np.array([fits.getdata(tmp_path / name) for name in names])
+    assert stack.header['NCOMBINE'] == 20
+    assert np.isnan(stack.data[0, 0])
+    assert np.allclose(stack.data[1:], np.mean(cube, axis=0)[1:], atol=1e-4)
+
+def test_update_stack_median(tmp_path):
+    rng = np.random.default_rng(2)
+    write_frames(tmp_path, 0, 200, rng)
+    names = sorted(item.name for item in tmp_path.glob('a-*.fit'))
+    stack = Stacker.update_stack(tmp_path, names, method='median')
+    cube = np.array([fits.getdata(tmp_path / name) for name in names])
+    assert np.nanmedian(np.abs(stack.data - np.median(cube, axis=0))) < 1.0
+
+def test_frame_weights():
+    qualities = [{'background': 100., 'rms': 5., 'fwhm': 3., 'exposure': 60.},
+                 {'background': 102., 'rms': 10., 'fwhm': 3., 'exposure': 60.},
+                 {'background': 98., 'rms': 5., 'fwhm': 6., 'exposure': 60.},
+                 {'background': 101., 'rms': 5., 'fwhm': 3., 'exposure': 60.},
+                 {'background': 500., 'rms': 5., 'fwhm': 3., 'exposure': 60.}]
+    assert np.allclose(Stacker.frame_weights(qualities, 'variance'), [1., 0.25, 1., 1., 0.])
+    assert np.allclose(Stacker.frame_weights(qualities, 'seeing'), [1., 0.25, 0.25, 1., 0.])
+    with pytest.raises(ValueError):
+        Stacker.frame_weights(qualities, 'airmass')
+
+def test_weighted_stack(tmp_path):
+    rng = np.random.default_rng(3)
+    truth = rng.uniform(0., 50., size=(40, 30))
+    levels = [(2., 100.), (4., 101.), (2., 99.), (2., 100.), (2., 100.), (2., 101.), (2., 99.), (2., 100.), (2., 100.), (2., 400.)]
+    for i, (rms, background) in enumerate(levels):
+        data = truth + rng.normal(0., rms, size=truth.shape)
+        data[5, 20] += 1e4 if i == 1 else 0.
+        data[:, :10] = np.nan if i == 0 else data[:, :10]
+        header = fits.Header({'BKGMED': background, 'BKGRMS': rms, 'FWHM': 3., 'EXPTIME': 60.})
+        fits.PrimaryHDU(data, header=header).writeto(tmp_path / f'a-{i:03d}.fit')
+    names = sorted(item.name for item in tmp_path.glob('a-*.fit'))
+    stack, exposure_map, weight_map = Stacker.weighted_stack(tmp_path, names, weighting='variance', mem_limit=4 * 9 * 30 * 4 * 8)
+    assert stack.header['NCOMBINE'] == 9
+    assert 'BKGMED' not in stack.header
+    assert np.isclose(exposure_map[0, 20], 540.) and np.isclose(exposure_map[0, 0], 480.)
+    assert np.isclose(exposure_map[5, 20], 480.)
+    assert np.isclose(weight_map[0, 20], 8.25)
+    assert np.abs(stack.data[5, 20] - truth[5, 20]) < 5.
+    assert np.std(stack.data - truth) < 2.
+
+def test_update_stack_interrupted(tmp_path, monkeypatch, capsys):
+    rng = np.random.default_rng(4)
+    write_frames(tmp_path, 0, 10, rng)
+    names = sorted(item.name for item in tmp_path.glob('a-*.fit'))
+    Stacker.update_stack(tmp_path, names[:3], method='average')
+    inode = os.stat(tmp_path / 'stack-acc' / 'mean.npy').st_ino
+    Stacker.update_stack(tmp_path, names[:4], method='average')
+    assert os.stat(tmp_path / 'stack-acc' / 'mean.npy').st_ino == inode
+    assert (tmp_path / 'stack-acc' / 'frames.txt').read_text().splitlines() == [Stacker.COMMITTED] + names[:4]
+    accumulate = Stacker.accumulate
+    calls = []
+    def crash(accumulators, data):
+        calls.append(1)
+        if len(calls) == 3:
+            raise OSError('disk full')
+        accumulate(accumulators, data)
+    monkeypatch.setattr(Stacker, 'accumulate', crash)
+    with pytest.raises(OSError):
+        Stacker.update_stack(tmp_path, names, method='average')
+    assert (tmp_path / 'stack-acc' / 'frames.txt').read_text().splitlines()[0] == Stacker.OPEN
+    monkeypatch.setattr(Stacker, 'accumulate', accumulate)
+    capsys.readouterr()
+    stack = Stacker.update_stack(tmp_path, names, method='average')
+    out, err = capsys.readouterr()
+    assert 'adding 10 frames to a stack of 0' in out.lower()
+    cube = np.array([fits.getdata(tmp_path / name) for name in names])
+    assert stack.header['NCOMBINE'] == 10
+    assert np.allclose(stack.data[1:], np.mean(cube, axis=0)[1:], atol=1e-4)
+    assert sorted(os.listdir(tmp_path / 'stack-acc')) == ['count.npy', 'frames.txt', 'm2.npy', 'mean.npy', 'median.npy']
+    with pytest.raises(ValueError):
+        Stacker.update_stack(tmp_path, [])